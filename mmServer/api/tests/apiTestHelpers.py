@@ -4,19 +4,29 @@
     the mmServer API.
 """
 import base64
+import cStringIO
 import uuid
 
 from django.utils import timezone
 
 import mock
 
+from PIL import Image
+
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils, encryption
+from mmServer.shared.lib    import utils, encryption, pictureStore
 
 import mmServer.api.views.message
 
 #############################################################################
 
+# The real rippleInterface.request() function, so that it can be restored
+# after install_mock_ripple_interface() has been called.
+
+_real_ripple_request = mmServer.api.views.message.rippleInterface.request
+
+#############################################################################
+
 def create_profile(name=None):
     """ Create and return a new Profile object.
 
@@ -85,16 +95,26 @@ def create_conversation(my_global_id, their_global_id,
 
 #############################################################################
 
-def create_picture():
+def create_picture(image_size=None):
     """ Create and return a new Picture object.
+
+        If 'image_size' is supplied, it should be a (width, height) tuple; the
+        picture will hold a real PNG image of that size.  Otherwise, the
+        picture will hold random data.
     """
-    picture_data = utils.random_string(min_length=10000, max_length=20000)
+    if image_size != None:
+        buffer = cStringIO.StringIO()
+        Image.new("RGB", image_size, (255, 0, 0)).save(buffer, format="png")
+        picture_data = buffer.getvalue()
+        buffer.close()
+    else:
+        picture_data = utils.random_string(min_length=10000, max_length=20000)
 
     picture = Picture()
     picture.picture_id       = utils.calc_unique_picture_id()
     picture.account_secret   = utils.random_string()
     picture.picture_filename = utils.random_string() + ".png"
-    picture.picture_data     = base64.b64encode(picture_data)
+    pictureStore.save_picture_data(picture, picture_data)
     picture.save()
 
     return picture
@@ -161,3 +181,13 @@ def install_mock_ripple_interface():
 
     return rippleMock
 
+#############################################################################
+
+def uninstall_mock_ripple_interface():
+    """ Restore the real rippleInterface.request() function.
+
+        This undoes the effect of a previous call to
+        install_mock_ripple_interface(), so that our unit tests can talk to a
+        fake rippled server.
+    """
+    mmServer.api.views.message.rippleInterface.request = _real_ripple_request
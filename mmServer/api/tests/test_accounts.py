@@ -2,6 +2,7 @@
 
     This module implements various unit tests for the "Account" endpoint.
 """
+import datetime
 import logging
 
 import django.test
@@ -10,9 +11,11 @@ from django.utils import timezone
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, transactionHandler
 from mmServer.api.tests     import apiTestHelpers
 
+import mmServer.api.views.account
+
 #############################################################################
 
 class AccountTestCase(django.test.TestCase):
@@ -135,6 +138,123 @@ class AccountTestCase(django.test.TestCase):
 
     # -----------------------------------------------------------------------
 
+    def test_get_account_transactions_after(self):
+        """ Test paging through an account's transactions using a cursor.
+        """
+        profile = apiTestHelpers.create_profile()
+
+        holding_account = _get_or_create_account(Account.TYPE_RIPPLE_HOLDING)
+        user_account    = _get_or_create_account(Account.TYPE_USER,
+                                                 profile.global_id)
+        other_account   = _get_or_create_account(Account.TYPE_USER,
+                                                 utils.random_string())
+
+        conversation = apiTestHelpers.create_conversation(
+                                profile.global_id, other_account.global_id)
+
+        # Create 25 transactions.  Several transactions share each timestamp,
+        # so that the cursor has to use the record ID to tell them apart.
+
+        start = datetime.datetime(2015, 3, 1, 12, 0, 0, 250000,
+                                  tzinfo=timezone.utc)
+
+        transactions = []
+        for i in range(25):
+            timestamp = start + datetime.timedelta(seconds=i / 3)
+            if i % 2 == 0:
+                transaction = _create_transaction(Transaction.TYPE_DEPOSIT, i,
+                                                  holding_account,
+                                                  user_account,
+                                                  timestamp=timestamp)
+            else:
+                message = Message()
+                message.conversation         = conversation
+                message.hash                 = utils.random_string()
+                message.timestamp            = timestamp
+                message.sender_global_id     = profile.global_id
+                message.recipient_global_id  = other_account.global_id
+                message.sender_account_id    = user_account.global_id
+                message.recipient_account_id = other_account.global_id
+                message.sender_text          = utils.random_string()
+                message.recipient_text       = utils.random_string()
+                message.status               = Message.STATUS_SENT
+                message.save()
+
+                transaction = _create_transaction(Transaction.TYPE_CHARGE, i,
+                                                  user_account, other_account,
+                                                  message=message,
+                                                  timestamp=timestamp)
+            transactions.append(transaction)
+
+        expected_ids = [t.id for t in sorted(transactions,
+                                             key=lambda t: (t.timestamp, t.id),
+                                             reverse=True)]
+
+        # Page through the transactions, ten at a time.
+
+        received_ids = []
+        after        = None
+        num_pages    = 0
+        while True:
+            url = "/api/account?global_id=" + profile.global_id \
+                + "&return=transactions&tpp=10"
+            if after != None:
+                url = url + "&after=" + after
+
+            headers = utils.calc_hmac_headers(
+                method="GET",
+                url="/api/account",
+                body="",
+                account_secret=profile.account_secret
+            )
+
+            response = self.client.get(url, **headers)
+            self.assertEqual(response.status_code, 200)
+
+            data = json.loads(response.content)
+            num_pages = num_pages + 1
+
+            for trans in data['transactions']:
+                received_ids.append(trans['transaction_id'])
+                if trans['type'] == "CHARGE_PAID":
+                    self.assertEqual(trans['other_account_global_id'],
+                                     other_account.global_id)
+                    self.assertIn("message_hash", trans)
+
+            if "next" not in data:
+                break
+            after = data['next']
+
+        self.assertEqual(num_pages, 3)
+        self.assertEqual(received_ids, expected_ids)
+
+        # Check that each page is loaded using a single query.
+
+        get_transactions = mmServer.api.views.account._get_transactions
+        cursor = mmServer.api.views.account._parse_cursor(after)
+
+        with self.assertNumQueries(1):
+            data = get_transactions(user_account, {'tz_offset' : None,
+                                                   'tpp'       : 10,
+                                                   'page'      : 0,
+                                                   'after'     : cursor})
+        self.assertEqual(len(data['transactions']), 5)
+
+        # Finally, check that an invalid cursor is rejected.
+
+        url = "/api/account?global_id=" + profile.global_id \
+            + "&return=transactions&after=xyz"
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/account",
+            body="",
+            account_secret=profile.account_secret
+        )
+
+        response = self.client.get(url, **headers)
+        self.assertEqual(response.status_code, 400)
+
     def test_get_account_transaction_totals(self):
         """ Test the logic of retrieving an account's transaction totals.
         """
@@ -256,3 +376,291 @@ class AccountTestCase(django.test.TestCase):
         self.assertEqual(totals['withdrawals'], 20)
         self.assertEqual(totals['charges_paid'], 1)
 
+
+    # -----------------------------------------------------------------------
+
+    def test_get_legacy_account_totals(self):
+        """ Test the totals returned by the legacy "GET api/account" call.
+        """
+        profile = apiTestHelpers.create_profile()
+
+        holding_account   = _get_or_create_account(Account.TYPE_RIPPLE_HOLDING)
+        messageme_account = _get_or_create_account(Account.TYPE_MESSAGEME)
+        user_account      = _get_or_create_account(Account.TYPE_USER,
+                                                   profile.global_id)
+        other_account     = _get_or_create_account(Account.TYPE_USER,
+                                                   utils.random_string())
+
+        # Create a variety of transactions involving the user's account.
+
+        _create_transaction(Transaction.TYPE_DEPOSIT, 100,
+                            holding_account, user_account)
+        _create_transaction(Transaction.TYPE_WITHDRAWAL, 20,
+                            user_account, holding_account)
+        _create_transaction(Transaction.TYPE_CHARGE, 1,
+                            user_account, messageme_account)
+        _create_transaction(Transaction.TYPE_CHARGE, 5,
+                            user_account, other_account)
+        _create_transaction(Transaction.TYPE_CHARGE, 7,
+                            other_account, user_account)
+        _create_transaction(Transaction.TYPE_ADJUSTMENT, 3,
+                            user_account, holding_account)
+        _create_transaction(Transaction.TYPE_ADJUSTMENT, 10,
+                            holding_account, user_account)
+        _create_transaction(Transaction.TYPE_DEPOSIT, 1000,
+                            holding_account, user_account,
+                            status=Transaction.STATUS_FAILED)
+
+        # Ask for the account totals, using the legacy parameters.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/account",
+            body="",
+            account_secret=profile.account_secret
+        )
+
+        response = self.client.get("/api/account" +
+                                   "?global_id=" + profile.global_id +
+                                   "&totals=yes",
+                                   **headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        data = json.loads(response.content)
+
+        self.assertEqual(data['account']['totals'],
+                         {'deposits'          : 100,
+                          'withdrawals'       : 20,
+                          'system_charges'    : 1,
+                          'recipient_charges' : 12,
+                          'adjustments'       : 7})
+
+        # Check that the totals by type are calculated using a single query,
+        # no matter how many transactions there are.
+
+        for i in range(20):
+            _create_transaction(Transaction.TYPE_CHARGE, 1,
+                                user_account, other_account)
+
+        with self.assertNumQueries(1):
+            totals = mmServer.api.views.account._get_totals_by_type(
+                                        user_account, {'tz_offset' : None})
+
+        self.assertEqual(totals['types'],
+                         [{'type' : "charges_paid",         'total' : 26},
+                          {'type' : "charges_received",     'total' : 7},
+                          {'type' : "deposits",             'total' : 100},
+                          {'type' : "withdrawals",          'total' : 20},
+                          {'type' : "adjustments_paid",     'total' : 3},
+                          {'type' : "adjustments_received", 'total' : 10}])
+
+    # -----------------------------------------------------------------------
+
+    def test_get_account_totals_by_date(self):
+        """ Test the calculation of an account's transaction totals by date.
+        """
+        holding_account = _get_or_create_account(Account.TYPE_RIPPLE_HOLDING)
+        user_account    = _get_or_create_account(Account.TYPE_USER,
+                                                 utils.random_string())
+        other_account   = _get_or_create_account(Account.TYPE_USER,
+                                                 utils.random_string())
+
+        # Create some transactions spread over three days, in UTC.  Note that
+        # the last transaction is reversed after it has been made.
+
+        def timestamp(day, hour, minute):
+            return datetime.datetime(2015, 3, day, hour, minute,
+                                     tzinfo=timezone.utc)
+
+        for type,amount,debit,credit,day,hour,minute in [
+            (Transaction.TYPE_DEPOSIT, 100, holding_account, user_account,
+             1, 10, 0),
+            (Transaction.TYPE_CHARGE,  2,   user_account, other_account,
+             1, 23, 50),
+            (Transaction.TYPE_CHARGE,  3,   user_account, other_account,
+             2, 0, 10),
+            (Transaction.TYPE_CHARGE,  5,   other_account, user_account,
+             2, 12, 0),
+            (Transaction.TYPE_CHARGE,  7,   user_account, other_account,
+             3, 9, 0)]:
+            transaction = Transaction()
+            transaction.timestamp       = timestamp(day, hour, minute)
+            transaction.created_by      = debit
+            transaction.status          = Transaction.STATUS_SUCCESS
+            transaction.type            = type
+            transaction.amount_in_drops = amount
+            transaction.debit_account   = debit
+            transaction.credit_account  = credit
+            transactionHandler.save_transaction(transaction)
+
+        transaction.status = Transaction.STATUS_FAILED
+        transactionHandler.save_transaction(transaction)
+
+        get_totals_by_date = mmServer.api.views.account._get_totals_by_date
+
+        # Check the totals in UTC, and in a timezone one hour behind UTC.  The
+        # totals should be calculated from the rollups using a single query.
+
+        with self.assertNumQueries(1):
+            totals = get_totals_by_date(user_account, {'tz_offset' : None})
+
+        self.assertEqual(totals['dates'], [{'date' : "2015-03-02",
+                                            'total' : 8},
+                                           {'date' : "2015-03-01",
+                                            'total' : 102}])
+
+        with self.assertNumQueries(1):
+            totals = get_totals_by_date(user_account,
+                                        {'tz_offset' : 60,
+                                         'type'      : "charges_paid"})
+
+        self.assertEqual(totals['dates'], [{'date' : "2015-03-01",
+                                            'total' : 5}])
+
+        totals = get_totals_by_date(user_account,
+                                    {'tz_offset' : -60,
+                                     'date'      : datetime.date(2015, 3, 2)})
+
+        self.assertEqual(totals['dates'], [{'date' : "2015-03-02",
+                                            'total' : 10}])
+
+        # Check that a timezone offset which doesn't line up with the rollups
+        # falls back to totalling the individual transactions.
+
+        totals = get_totals_by_date(user_account, {'tz_offset' : 5})
+
+        self.assertEqual(totals['dates'], [{'date' : "2015-03-02",
+                                            'total' : 8},
+                                           {'date' : "2015-03-01",
+                                            'total' : 102}])
+
+        totals = get_totals_by_date(user_account, {'tz_offset' : 25})
+
+        self.assertEqual(totals['dates'], [{'date' : "2015-03-02",
+                                            'total' : 5},
+                                           {'date' : "2015-03-01",
+                                            'total' : 105}])
+
+        # Finally, check that rebuilding the rollups doesn't change them.
+
+        rollups = set(TransactionRollup.objects.filter(account=user_account)
+                        .values_list("type", "direction", "period_start",
+                                     "total_in_drops", "num_transactions"))
+
+        transactionHandler.rebuild_rollups(user_account)
+
+        rebuilt = set(TransactionRollup.objects.filter(account=user_account)
+                        .values_list("type", "direction", "period_start",
+                                     "total_in_drops", "num_transactions"))
+
+        self.assertEqual(rebuilt, set(r for r in rollups if r[4] != 0))
+
+    # -----------------------------------------------------------------------
+
+    def test_get_account_totals_by_conversation(self):
+        """ Test the calculation of an account's totals by conversation.
+        """
+        holding_account = _get_or_create_account(Account.TYPE_RIPPLE_HOLDING)
+        my_profile      = apiTestHelpers.create_profile()
+        my_account      = _get_or_create_account(Account.TYPE_USER,
+                                                 my_profile.global_id)
+
+        # A deposit isn't associated with any conversation, so shouldn't be
+        # included in the results.
+
+        _create_transaction(Transaction.TYPE_DEPOSIT, 100,
+                            holding_account, my_account)
+
+        get_totals = mmServer.api.views.account._get_totals_by_conversation
+
+        # Pay a charge to a growing number of other users, checking that the
+        # number of queries doesn't grow along with the number of
+        # conversations.
+
+        expected = []
+        for num_conversations in [2, 20]:
+            while len(expected) < num_conversations:
+                index = len(expected)
+                their_profile = apiTestHelpers.create_profile(
+                                        name="User %02d" % index)
+                if index % 2 == 1:
+                    their_profile.name_visible = False
+                    their_profile.save()
+                their_account = _get_or_create_account(Account.TYPE_USER,
+                                                       their_profile.global_id)
+
+                conversation = apiTestHelpers.create_conversation(
+                                        my_profile.global_id,
+                                        their_profile.global_id)
+
+                message = Message()
+                message.conversation         = conversation
+                message.timestamp            = timezone.now()
+                message.sender_global_id     = my_profile.global_id
+                message.recipient_global_id  = their_profile.global_id
+                message.sender_account_id    = my_account.global_id
+                message.recipient_account_id = their_account.global_id
+                message.sender_text          = utils.random_string()
+                message.recipient_text       = utils.random_string()
+                message.status               = Message.STATUS_SENT
+                message.save()
+
+                for amount in [index, 1]:
+                    _create_transaction(Transaction.TYPE_CHARGE, amount,
+                                        my_account, their_account,
+                                        message=message)
+
+                if their_profile.name_visible:
+                    name = their_profile.name
+                else:
+                    name = None
+
+                expected.append({'global_id' : their_profile.global_id,
+                                 'name'      : name,
+                                 'total'     : index + 1})
+
+            with self.assertNumQueries(2):
+                totals = get_totals(my_account, {'tz_offset' : None})
+
+            self.assertItemsEqual(totals['conversations'], expected)
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _get_or_create_account(type, global_id=None):
+    """ Return the Account record with the given type and global ID.
+
+        The account is created if it doesn't already exist.
+    """
+    try:
+        return Account.objects.get(type=type, global_id=global_id)
+    except Account.DoesNotExist:
+        account = Account()
+        account.global_id        = global_id
+        account.type             = type
+        account.balance_in_drops = 0
+        account.save()
+        return account
+
+#############################################################################
+
+def _create_transaction(type, amount, debit_account, credit_account,
+                        status=Transaction.STATUS_SUCCESS, message=None,
+                        timestamp=None):
+    """ Create and return a new Transaction record with the given details.
+    """
+    transaction = Transaction()
+    transaction.timestamp       = timestamp or timezone.now()
+    transaction.created_by      = debit_account
+    transaction.status          = status
+    transaction.type            = type
+    transaction.amount_in_drops = amount
+    transaction.debit_account   = debit_account
+    transaction.credit_account  = credit_account
+    transaction.message         = message
+    transaction.save()
+    return transaction
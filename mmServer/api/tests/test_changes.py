@@ -6,15 +6,20 @@
 import base64
 import logging
 import random
+import StringIO
+import threading
+import time
 import uuid
 
-from django.utils import unittest, timezone
+from django.core.management import call_command
+from django.utils           import unittest, timezone
+from django.db              import connection, transaction
 import django.test
 
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils, encryption
+from mmServer.shared.lib    import utils, encryption, dbHelpers, changeNotifier
 from mmServer.api.tests     import apiTestHelpers
 
 #############################################################################
@@ -362,6 +367,11 @@ class ChangesTestCase(django.test.TestCase):
         self.assertEqual(response.status_code, 201)
         picture_id = response.content
 
+        # Use the new picture as the profile's picture.
+
+        profile.picture_id = picture_id
+        profile.save()
+
         # Now ask the "/changes" endpoint for the things that have changed
         # since the anchor was calculated.
 
@@ -404,10 +414,13 @@ class ChangesTestCase(django.test.TestCase):
 
         profile = apiTestHelpers.create_profile()
 
-        # Create a dummy picture.
+        # Create a dummy picture, and use it as the profile's picture.
 
         picture = apiTestHelpers.create_picture()
 
+        profile.picture_id = picture.picture_id
+        profile.save()
+
         # Ask the "/changes" endpoint for the current anchor value.
 
         headers = utils.calc_hmac_headers(
@@ -502,10 +515,13 @@ class ChangesTestCase(django.test.TestCase):
 
         profile = apiTestHelpers.create_profile()
 
-        # Create a dummy picture.
+        # Create a dummy picture, and use it as the profile's picture.
 
         picture = apiTestHelpers.create_picture()
 
+        profile.picture_id = picture.picture_id
+        profile.save()
+
         # Ask the "/changes" endpoint for the current anchor value.
 
         headers = utils.calc_hmac_headers(
@@ -979,3 +995,751 @@ class ChangesTestCase(django.test.TestCase):
 
         self.assertTrue(found)
 
+
+    # =======================================================================
+
+    def test_long_poll_timeout(self):
+        """ Test that a long-poll with no changes times out with no changes.
+        """
+        # Create a profile for the current user.
+
+        my_profile = apiTestHelpers.create_profile()
+
+        # Ask the "/changes" endpoint for the current anchor value.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=my_profile.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + my_profile.global_id
+        response = self.client.get(url, **headers)
+
+        self.assertEqual(response.status_code, 200)
+        anchor = json.loads(response.content)['next_anchor']
+
+        # Long-poll for changes.  As nothing changes, the request should time
+        # out and return an empty list of changes.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=my_profile.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + my_profile.global_id \
+                              + "&anchor=" + anchor + "&wait=1"
+
+        response = self.client.get(url, **headers)
+        if response.status_code != 200:
+            print response.content
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+        self.assertItemsEqual(data.keys(), ["changes", "next_anchor"])
+        self.assertEqual(data['changes'], [])
+
+    # =======================================================================
+
+    def test_long_poll_returns_existing_changes(self):
+        """ Test that a long-poll returns at once if there are changes.
+        """
+        # Create profiles for two users.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+
+        # Ask the "/changes" endpoint for the current anchor value.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id
+        response = self.client.get(url, **headers)
+
+        self.assertEqual(response.status_code, 200)
+        anchor = json.loads(response.content)['next_anchor']
+
+        # Create a conversation between these two users.
+
+        conversation = apiTestHelpers.create_conversation(profile_1.global_id,
+                                                          profile_2.global_id)
+
+        # Long-poll for changes.  The new conversation should be returned.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id \
+                              + "&anchor=" + anchor + "&wait=30"
+
+        response = self.client.get(url, **headers)
+        if response.status_code != 200:
+            print response.content
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+
+        found = False
+        for change in data['changes']:
+            if change['type'] == "conversation":
+                if change['data']['their_global_id'] == profile_2.global_id:
+                    found = True
+
+        self.assertTrue(found)
+
+    # =======================================================================
+
+    def test_event_stream(self):
+        """ Test that the "/changes" endpoint can stream Server-Sent Events.
+        """
+        # Create profiles for two users.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+
+        # Ask the "/changes" endpoint for the current anchor value.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id
+        response = self.client.get(url, **headers)
+
+        self.assertEqual(response.status_code, 200)
+        anchor = json.loads(response.content)['next_anchor']
+
+        # Create a conversation between these two users.
+
+        conversation = apiTestHelpers.create_conversation(profile_1.global_id,
+                                                          profile_2.global_id)
+
+        # Ask for a one-second stream of changes.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id \
+                              + "&anchor=" + anchor + "&wait=1"
+
+        response = self.client.get(url, HTTP_ACCEPT="text/event-stream",
+                                   **headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "text/event-stream")
+
+        # Check that the stream includes a "changes" event with the new
+        # conversation.
+
+        events = []
+        for event in "".join(response.streaming_content).split("\n\n"):
+            fields = {}
+            for line in event.split("\n"):
+                if line.startswith("event: "):
+                    fields['event'] = line[len("event: "):]
+                elif line.startswith("data: "):
+                    fields['data'] = json.loads(line[len("data: "):])
+            if fields.get("event") == "changes":
+                events.append(fields['data'])
+
+        self.assertEqual(len(events), 1)
+
+        found = False
+        for change in events[0]['changes']:
+            if change['type'] == "conversation":
+                if change['data']['their_global_id'] == profile_2.global_id:
+                    found = True
+
+        self.assertTrue(found)
+
+    # =======================================================================
+
+    def test_compact_change_log(self):
+        """ Test that compacting the change log doesn't lose any changes.
+        """
+        # Create profiles for two users, and a conversation between them.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+
+        conversation = apiTestHelpers.create_conversation(profile_1.global_id,
+                                                          profile_2.global_id)
+
+        # Update the second user's profile a few times.
+
+        for i in range(3):
+            profile_2.name = utils.random_string()
+            profile_2.save()
+
+        # Compact the change log.  Only the latest entry for the updated
+        # profile should remain.
+
+        num_deleted = ChangeLogEntry.objects.compact()
+        self.assertEqual(num_deleted, 2)
+
+        entries = ChangeLogEntry.objects.filter(
+                                    global_id=profile_1.global_id,
+                                    type=ChangeLogEntry.TYPE_PROFILE,
+                                    object_id=profile_2.id)
+        self.assertEqual(entries.count(), 1)
+
+        # Check that the "/changes" endpoint still returns the profile, with
+        # the latest name.
+
+        anchor = base64.urlsafe_b64encode(json.dumps({}))
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id \
+                              + "&anchor=" + anchor
+
+        response = self.client.get(url, **headers)
+        if response.status_code != 200:
+            print response.content
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+
+        names = []
+        for change in data['changes']:
+            if change['type'] == "profile":
+                names.append(change['data']['name'])
+
+        self.assertEqual(names, [profile_2.name])
+
+    # =======================================================================
+
+    def test_backfill_change_log(self):
+        """ Test that the "backfill_change_log" command rebuilds the log.
+        """
+        # Create profiles for two users, and a conversation between them.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+
+        conversation = apiTestHelpers.create_conversation(profile_1.global_id,
+                                                          profile_2.global_id)
+
+        # Throw away the change log, and then backfill it again.
+
+        ChangeLogEntry.objects.all().delete()
+
+        call_command("backfill_change_log", stdout=StringIO.StringIO())
+
+        # Check that the conversation is back in the change log.
+
+        entries = ChangeLogEntry.objects.filter(
+                                    type=ChangeLogEntry.TYPE_CONVERSATION,
+                                    object_id=conversation.id)
+        self.assertItemsEqual([entry.global_id for entry in entries],
+                              [profile_1.global_id, profile_2.global_id])
+
+        # Running the command a second time shouldn't add any more entries.
+
+        num_entries = ChangeLogEntry.objects.count()
+        call_command("backfill_change_log", stdout=StringIO.StringIO())
+        self.assertEqual(ChangeLogEntry.objects.count(), num_entries)
+
+    # =======================================================================
+
+    def test_unrelated_picture_not_returned(self):
+        """ Test that the "/changes" endpoint ignores other people's pictures.
+        """
+        # Create profiles for three users, with a conversation between the
+        # first two.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+        profile_3 = apiTestHelpers.create_profile()
+
+        conversation = apiTestHelpers.create_conversation(profile_1.global_id,
+                                                          profile_2.global_id)
+
+        # Ask the "/changes" endpoint for the current anchor value.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id
+        response = self.client.get(url, **headers)
+
+        self.assertEqual(response.status_code, 200)
+        anchor = json.loads(response.content)['next_anchor']
+
+        # Give the second and third users a new visible picture each.
+
+        picture_2 = apiTestHelpers.create_picture()
+        profile_2.picture_id         = picture_2.picture_id
+        profile_2.picture_id_visible = True
+        profile_2.save()
+
+        picture_3 = apiTestHelpers.create_picture()
+        profile_3.picture_id         = picture_3.picture_id
+        profile_3.picture_id_visible = True
+        profile_3.save()
+
+        # Ask the "/changes" endpoint for the things that have changed since
+        # the anchor was calculated.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/changes",
+            body="",
+            account_secret=profile_1.account_secret
+        )
+
+        url = "/api/changes?my_global_id=" + profile_1.global_id \
+                              + "&anchor=" + anchor
+
+        response = self.client.get(url, **headers)
+        if response.status_code != 200:
+            print response.content
+        self.assertEqual(response.status_code, 200)
+        data = json.loads(response.content)
+
+        # Check that only the conversation partner's picture was returned.
+
+        picture_ids = []
+        for change in data['changes']:
+            if change['type'] == "picture":
+                picture_ids.append(change['data']['picture_id'])
+
+        self.assertEqual(picture_ids, [picture_2.picture_id])
+
+    # =======================================================================
+
+    def test_profile_save_only_logs_changed_picture(self):
+        """ Test that a profile's picture is only logged when it changes.
+        """
+        profile = apiTestHelpers.create_profile()
+        picture = apiTestHelpers.create_picture()
+
+        def num_picture_entries():
+            return ChangeLogEntry.objects.filter(
+                            type=ChangeLogEntry.TYPE_PICTURE,
+                            object_id=picture.id).count()
+
+        # Giving the profile a picture should log the picture.
+
+        num_entries = num_picture_entries()
+
+        profile.picture_id = picture.picture_id
+        profile.save()
+
+        self.assertGreater(num_picture_entries(), num_entries)
+
+        # Changing some other part of the profile shouldn't log the picture,
+        # even if the profile has been reloaded.
+
+        num_entries = num_picture_entries()
+
+        profile.name = utils.random_string()
+        profile.save()
+
+        profile = Profile.objects.get(id=profile.id)
+        profile.bio = utils.random_string()
+        profile.save()
+
+        self.assertEqual(num_picture_entries(), num_entries)
+
+        # Hiding the picture should log it again.
+
+        profile.picture_id_visible = False
+        profile.save()
+
+        self.assertGreater(num_picture_entries(), num_entries)
+
+    # =======================================================================
+
+    def test_new_conversation_logs_partner_picture(self):
+        """ Test that a new conversation sends each user the other's picture.
+        """
+        # Create profiles for two users.  Only the second user's picture is
+        # visible.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+
+        picture_1 = apiTestHelpers.create_picture()
+        profile_1.picture_id         = picture_1.picture_id
+        profile_1.picture_id_visible = False
+        profile_1.save()
+
+        picture_2 = apiTestHelpers.create_picture()
+        profile_2.picture_id         = picture_2.picture_id
+        profile_2.picture_id_visible = True
+        profile_2.save()
+
+        # Start a conversation between the two users.
+
+        apiTestHelpers.create_conversation(profile_1.global_id,
+                                           profile_2.global_id)
+
+        # The first user should now be able to see the second user's picture,
+        # while the second user can't see the first user's picture.
+
+        self.assertTrue(ChangeLogEntry.objects.filter(
+                            global_id=profile_1.global_id,
+                            type=ChangeLogEntry.TYPE_PICTURE,
+                            object_id=picture_2.id).exists())
+
+        self.assertFalse(ChangeLogEntry.objects.filter(
+                            global_id=profile_2.global_id,
+                            type=ChangeLogEntry.TYPE_PICTURE,
+                            object_id=picture_1.id).exists())
+
+    # =======================================================================
+
+    @unittest.skipIf(dbHelpers.is_postgres(),
+                     "PostgreSQL only delivers notifications once the " +
+                     "test's transaction has been committed.")
+    def test_change_notifications(self):
+        """ Test that change notifications go to the change log recipients.
+        """
+        # Create profiles for three users, with a conversation between the
+        # first two.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+        profile_3 = apiTestHelpers.create_profile()
+
+        apiTestHelpers.create_conversation(profile_1.global_id,
+                                           profile_2.global_id)
+
+        # A change to the second user's profile should wake up the first
+        # user, who will see it in their change log.
+
+        with changeNotifier.Listener() as listener:
+            profile_2.name = utils.random_string()
+            profile_2.save()
+
+            self.assertTrue(listener.wait([profile_1.global_id], 0.1))
+
+        # A change to the third user's profile shouldn't.
+
+        with changeNotifier.Listener() as listener:
+            profile_3.name = utils.random_string()
+            profile_3.save()
+
+            self.assertFalse(listener.wait([profile_1.global_id], 0.1))
+
+#############################################################################
+
+@unittest.skipUnless(dbHelpers.is_postgres(),
+                     "Set MMS_TEST_DATABASE_URL to a PostgreSQL database " +
+                     "to run the concurrency tests.")
+class ChangesConcurrencyTestCase(django.test.TransactionTestCase):
+    """ Concurrency tests for the "changes" endpoint.
+
+        These tests only work with PostgreSQL, as they need the writers and
+        readers to run in parallel using separate database connections.
+    """
+    NUM_WRITERS             = 4
+    NUM_READERS             = 3
+    NUM_MESSAGES_PER_WRITER = 50
+
+    def test_no_lost_changes(self):
+        """ Test that syncing while messages are being sent delivers each once.
+
+            Several writer threads send messages while several reader threads
+            keep syncing, each from its own anchor.  Every reader should end
+            up with every committed message exactly once: no duplicates, and
+            no gaps.
+        """
+        # Create profiles for two users, and a conversation between them.
+
+        profile_1 = apiTestHelpers.create_profile()
+        profile_2 = apiTestHelpers.create_profile()
+
+        conversation = apiTestHelpers.create_conversation(profile_1.global_id,
+                                                          profile_2.global_id)
+
+        # The following helper function calls the "/changes" endpoint, and
+        # returns the new anchor along with the hashes of the messages which
+        # were received.
+
+        def sync(client, anchor=None):
+            headers = utils.calc_hmac_headers(
+                method="GET",
+                url="/api/changes",
+                body="",
+                account_secret=profile_1.account_secret
+            )
+
+            url = "/api/changes?my_global_id=" + profile_1.global_id
+            if anchor != None:
+                url = url + "&anchor=" + anchor
+
+            response = client.get(url, **headers)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.content)
+
+            hashes = []
+            for change in data.get("changes", []):
+                if change['type'] == "message":
+                    hashes.append(change['data']['hash'])
+
+            return data['next_anchor'],hashes
+
+        # Ask the "/changes" endpoint for the current anchor value.  Each
+        # reader starts from here.
+
+        start_anchor,hashes = sync(self.client)
+
+        # Start a number of writer threads, each of which sends a number of
+        # messages, and a number of reader threads, each of which keeps
+        # syncing until the writers have finished.
+
+        writers_done = threading.Event()
+        received     = [] # List of received hashes, for each reader.
+        errors       = []
+
+        def writer():
+            try:
+                for i in range(self.NUM_MESSAGES_PER_WRITER):
+                    message = Message()
+                    message.conversation          = conversation
+                    message.hash                  = uuid.uuid4().hex
+                    message.timestamp             = timezone.now()
+                    message.sender_global_id      = profile_2.global_id
+                    message.recipient_global_id   = profile_1.global_id
+                    message.sender_account_id     = utils.random_string()
+                    message.recipient_account_id  = utils.random_string()
+                    message.sender_text           = utils.random_string()
+                    message.recipient_text        = utils.random_string()
+                    message.system_charge_paid_by = "SENDER"
+                    message.status                = Message.STATUS_SENT
+                    message.save()
+            finally:
+                connection.close()
+
+        def reader(received_hashes):
+            try:
+                client = django.test.Client()
+                anchor = start_anchor
+                while not writers_done.is_set():
+                    anchor,hashes = sync(client, anchor)
+                    received_hashes.extend(hashes)
+
+                anchor,hashes = sync(client, anchor)
+                received_hashes.extend(hashes)
+            except Exception as e:
+                errors.append(e)
+            finally:
+                connection.close()
+
+        readers = []
+        for i in range(self.NUM_READERS):
+            received.append([])
+            thread = threading.Thread(target=reader, args=[received[-1]])
+            thread.start()
+            readers.append(thread)
+
+        writers = []
+        for i in range(self.NUM_WRITERS):
+            thread = threading.Thread(target=writer)
+            thread.start()
+            writers.append(thread)
+
+        for thread in writers:
+            thread.join()
+        writers_done.set()
+
+        for thread in readers:
+            thread.join()
+
+        self.assertEqual(errors, [])
+
+        # Check that each reader received every committed message exactly
+        # once, by comparing the update IDs of the messages it received with
+        # the update IDs of every message which was committed.
+
+        update_ids = dict(Message.objects.filter(conversation=conversation)
+                                         .values_list("hash", "update_id"))
+        self.assertEqual(len(update_ids),
+                         self.NUM_WRITERS * self.NUM_MESSAGES_PER_WRITER)
+
+        committed_ids = sorted(update_ids.values())
+        for received_hashes in received:
+            received_ids = sorted([update_ids[message_hash]
+                                   for message_hash in received_hashes])
+            self.assertEqual(received_ids, committed_ids)
+
+    # =======================================================================
+
+    def test_shared_listen_connection(self):
+        """ Test that concurrent listeners share one LISTEN connection.
+        """
+        NUM_LISTENERS = 5
+
+        # Start a number of threads, each of which waits for a change relevant
+        # to its own user.
+
+        results = []
+        started = threading.Semaphore(0)
+
+        def waiter(global_id):
+            with changeNotifier.Listener() as listener:
+                started.release()
+                results.append(listener.wait([global_id], 10))
+
+        waiters = []
+        for i in range(NUM_LISTENERS):
+            thread = threading.Thread(target=waiter, args=["user_%d" % i])
+            thread.start()
+            waiters.append(thread)
+
+        for i in range(NUM_LISTENERS):
+            started.acquire()
+
+        # Check that only one LISTEN connection has been opened.
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM pg_stat_activity" +
+                       " WHERE datname=current_database()" +
+                       " AND query LIKE 'LISTEN %%'")
+        self.assertEqual(cursor.fetchone()[0], 1)
+
+        # Send a notification for every user, and check that all the waiting
+        # threads were woken up.
+
+        changeNotifier.notify(["user_%d" % i for i in range(NUM_LISTENERS)])
+
+        for thread in waiters:
+            thread.join()
+
+        self.assertEqual(results, [True] * NUM_LISTENERS)
+
+    # =======================================================================
+
+    def test_listen_connection_failure(self):
+        """ Test that listeners are woken up if the LISTEN connection fails.
+        """
+        with changeNotifier.Listener() as listener:
+            # Kill the shared LISTEN connection from the database side.
+
+            cursor = connection.cursor()
+            cursor.execute("SELECT pg_terminate_backend(pid)" +
+                           " FROM pg_stat_activity" +
+                           " WHERE datname=current_database()" +
+                           " AND query LIKE 'LISTEN %%'")
+
+            # As notifications may have been missed, the listener should be
+            # woken up once the connection has been reopened.
+
+            self.assertTrue(listener.wait(["user"], 10))
+
+            # Notifications should then be delivered as normal.
+
+            changeNotifier.notify(["user"])
+            self.assertTrue(listener.wait(["user"], 10))
+
+    # =======================================================================
+
+    def test_high_water_does_not_block(self):
+        """ Test that an open writer doesn't block the update ID high water.
+        """
+        # Start a writer thread which allocates a change log sequence number,
+        # and then keeps its transaction open until we tell it to finish.
+
+        allocated = []
+        started   = threading.Event()
+        finish    = threading.Event()
+
+        def writer():
+            try:
+                with transaction.atomic():
+                    allocated.append(dbHelpers.next_update_id(ChangeLogEntry,
+                                                              "seq"))
+                    started.set()
+                    finish.wait(10)
+            finally:
+                connection.close()
+
+        thread = threading.Thread(target=writer)
+        thread.start()
+        try:
+            self.assertTrue(started.wait(10))
+
+            # Allocate and commit a higher sequence number.  The high water
+            # mark should be returned straight away, and stop short of the
+            # open writer's sequence number.
+
+            with transaction.atomic():
+                committed = dbHelpers.next_update_id(ChangeLogEntry, "seq")
+            self.assertTrue(committed > allocated[0])
+
+            start = time.time()
+            high_water = dbHelpers.update_id_high_water(ChangeLogEntry, "seq")
+            self.assertTrue(time.time() - start < 1)
+            self.assertTrue(high_water == None or high_water < allocated[0])
+        finally:
+            finish.set()
+            thread.join()
+
+        # Once the writer has finished, the high water mark should catch up.
+
+        self.assertEqual(dbHelpers.update_id_high_water(ChangeLogEntry, "seq"),
+                         committed)
+
+    # =======================================================================
+
+    def test_notify_many_partners(self):
+        """ Test that a change sent to many users is notified to all of them.
+
+            PostgreSQL rejects notification payloads of 8000 bytes or more, so
+            a change with this many recipients has to be split across several
+            notifications.  We use long global IDs, as real ones are.
+        """
+        NUM_PARTNERS = 250
+
+        profile = apiTestHelpers.create_profile()
+
+        partner_ids = []
+        for i in range(NUM_PARTNERS):
+            partner_id = utils.random_string(min_length=40, max_length=40)
+            apiTestHelpers.create_conversation(profile.global_id, partner_id)
+            partner_ids.append(partner_id)
+
+        # Change the profile, and check that the first and last partners are
+        # both woken up.
+
+        with changeNotifier.Listener() as listener_1:
+            with changeNotifier.Listener() as listener_2:
+                profile.name = utils.random_string()
+                profile.save()
+
+                self.assertTrue(listener_1.wait([partner_ids[0]], 10))
+                self.assertTrue(listener_2.wait([partner_ids[-1]], 10))
+
+        # Check that the change was added to every partner's change log.
+
+        self.assertEqual(ChangeLogEntry.objects.filter(
+                                    global_id__in=partner_ids,
+                                    type=ChangeLogEntry.TYPE_PROFILE,
+                                    object_id=profile.id).count(),
+                         NUM_PARTNERS)
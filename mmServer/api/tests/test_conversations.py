@@ -3,15 +3,18 @@
     This module implements various unit tests for the "conversation" resource's
     API endpoints.
 """
+import datetime
 import random
+from StringIO import StringIO
 
 from django.utils import timezone
+from django.core.management import call_command
 import django.test
 
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, messageHandler
 from mmServer.api.tests     import apiTestHelpers
 
 #############################################################################
@@ -290,11 +293,11 @@ class ConversationTestCase(django.test.TestCase):
     def test_sent_message_updates_conversation(self):
         """ Check that a message with status="sent" updates the conversation.
 
-            We create a pending message, and then make a "GET api/messages"
-            call, mocking out the Ripple interface to pretend that the message
-            was accepted into the Ripple ledger.  This will change the
-            message's status to "SENT", and should update the conversation with
-            the details of the newly-sent message.
+            We create a pending message, and then run the "reconcile_pending"
+            management command, mocking out the Ripple interface to pretend
+            that the message was accepted into the Ripple ledger.  This will
+            change the message's status to "SENT", and should update the
+            conversation with the details of the newly-sent message.
         """
         # Create two profiles for us to use.
 
@@ -335,17 +338,7 @@ class ConversationTestCase(django.test.TestCase):
         message.recipient_text       = utils.random_string()
         message.status               = Message.STATUS_PENDING
         message.error                = None
-        message.save()
-
-        # Calculate the HMAC authentication headers we need to make an
-        # authenticated request.
-
-        headers = utils.calc_hmac_headers(
-            method="GET",
-            url="/api/messages",
-            body="",
-            account_secret=my_profile.account_secret
-        )
+        messageHandler.save_message(message)
 
         # Install the mock version of the rippleInterface.request() function.
         # This prevents the rippleInterface module from submitting a message to
@@ -353,16 +346,12 @@ class ConversationTestCase(django.test.TestCase):
 
         rippleMock = apiTestHelpers.install_mock_ripple_interface()
 
-        # Ask the "GET /api/messages" endpoint to return the messages for this
-        # conversation.  All going well, the endpoint should check with the
-        # Ripple server, see that the message was validated, change the
-        # message status to "sent" and update the conversation to match.
-
-        url = "/api/messages?my_global_id=" + my_profile.global_id \
-            + "&their_global_id=" + their_profile.global_id
+        # Run a single pass of the reconciler.  All going well, this should
+        # check with the Ripple server, see that the message was validated,
+        # change the message status to "sent" and update the conversation to
+        # match.
 
-        response = self.client.get(url, **headers)
-        self.assertEqual(response.status_code, 200)
+        call_command("reconcile_pending", once=True)
 
         # Check that the conversation has been updated.
 
@@ -394,9 +383,7 @@ class ConversationTestCase(django.test.TestCase):
 
         conversation = \
             apiTestHelpers.create_conversation(my_profile.global_id,
-                                               their_profile.global_id,
-                                               num_unread_1=0,
-                                               num_unread_2=1)
+                                               their_profile.global_id)
 
         cur_last_message_1 = conversation.last_message_1
         cur_last_message_2 = conversation.last_message_2
@@ -423,7 +410,12 @@ class ConversationTestCase(django.test.TestCase):
         message.recipient_text       = utils.random_string()
         message.status               = Message.STATUS_SENT
         message.error                = None
-        message.save()
+        messageHandler.save_message(message)
+
+        # The recipient should now have one unread message.
+
+        conversation = Conversation.objects.get(id=conversation.id)
+        self.assertEqual(conversation.num_unread_2, cur_num_unread_2 + 1)
 
         # Prepare the body of our request.
 
@@ -458,5 +450,241 @@ class ConversationTestCase(django.test.TestCase):
         self.assertEqual(conversation.last_message_1, message.sender_text)
         self.assertEqual(conversation.last_message_2, message.recipient_text)
         self.assertEqual(conversation.num_unread_1, cur_num_unread_1)
-        self.assertEqual(conversation.num_unread_2, cur_num_unread_2 - 1)
+        self.assertEqual(conversation.num_unread_2, cur_num_unread_2)
+
+
+    # -----------------------------------------------------------------------
+
+    def test_read_conversation_then_message(self):
+        """ Check that reading a conversation and then a message is consistent.
+
+            We create a sent message, make a "PUT api/conversation" call to
+            mark the conversation as read, and then make a "PUT api/message"
+            call to mark the message itself as read.  The recipient's unread
+            message count should drop to zero, and stay there.
+        """
+        # Create two profiles, and a conversation between them.
+
+        my_profile    = apiTestHelpers.create_profile()
+        their_profile = apiTestHelpers.create_profile()
+
+        conversation = \
+            apiTestHelpers.create_conversation(my_profile.global_id,
+                                               their_profile.global_id)
+
+        # Create a dummy sent message from us to them.
+
+        message = Message()
+        message.conversation         = conversation
+        message.hash                 = utils.random_string()
+        message.timestamp            = timezone.now()
+        message.sender_global_id     = my_profile.global_id
+        message.recipient_global_id  = their_profile.global_id
+        message.sender_account_id    = utils.random_string()
+        message.recipient_account_id = utils.random_string()
+        message.sender_text          = utils.random_string()
+        message.recipient_text       = utils.random_string()
+        message.status               = Message.STATUS_SENT
+        message.error                = None
+        messageHandler.save_message(message)
+
+        conversation = Conversation.objects.get(id=conversation.id)
+        self.assertEqual(conversation.num_unread_2, 1)
+
+        # Ask the "PUT /api/conversation" endpoint to mark the conversation
+        # as read by the recipient.
+
+        request = json.dumps({'my_global_id'    : their_profile.global_id,
+                              'their_global_id' : my_profile.global_id,
+                              'action'          : "READ"})
+
+        headers = utils.calc_hmac_headers(
+            method="PUT",
+            url="/api/conversation",
+            body=request,
+            account_secret=their_profile.account_secret
+        )
+
+        response = self.client.put("/api/conversation",
+                                   request,
+                                   content_type="application/json",
+                                   **headers)
+        self.assertEqual(response.status_code, 200)
+
+        conversation = Conversation.objects.get(id=conversation.id)
+        self.assertEqual(conversation.num_unread_2, 0)
+
+        message = Message.objects.get(id=message.id)
+        self.assertEqual(message.status, Message.STATUS_READ)
+
+        # Now ask the "PUT /api/message" endpoint to mark the message as read.
+
+        request = json.dumps({'message' : {'hash' : message.hash,
+                                           'read' : True}})
+
+        headers = utils.calc_hmac_headers(
+            method="PUT",
+            url="/api/message",
+            body=request,
+            account_secret=their_profile.account_secret
+        )
+
+        response = self.client.put("/api/message",
+                                   request,
+                                   content_type="application/json",
+                                   **headers)
+        self.assertEqual(response.status_code, 200)
+
+        # The unread message count shouldn't have changed.
+
+        conversation = Conversation.objects.get(id=conversation.id)
+        self.assertEqual(conversation.num_unread_1, 0)
+        self.assertEqual(conversation.num_unread_2, 0)
+
+    # -----------------------------------------------------------------------
+
+    def test_rebuild_conversation_summaries(self):
+        """ Check that "rebuild_conversation_summaries" repairs conversations.
+
+            We create some messages, deliberately corrupt the conversation's
+            summary fields, and then check that the management command
+            recalculates them correctly.
+        """
+        # Create two profiles, and a conversation between them.
+
+        my_profile    = apiTestHelpers.create_profile()
+        their_profile = apiTestHelpers.create_profile()
+
+        conversation = \
+            apiTestHelpers.create_conversation(my_profile.global_id,
+                                               their_profile.global_id)
+
+        # Create some messages in each direction.  Two of our messages and one
+        # of theirs are unread, and their message is the latest.
+
+        to_create = [(my_profile,    Message.STATUS_READ),
+                     (my_profile,    Message.STATUS_SENT),
+                     (my_profile,    Message.STATUS_SENT),
+                     (their_profile, Message.STATUS_SENT)]
+
+        base_time = timezone.now()
+        messages  = []
+        for i,(sender,status) in enumerate(to_create):
+            if sender == my_profile:
+                recipient = their_profile
+            else:
+                recipient = my_profile
+
+            message = Message()
+            message.conversation         = conversation
+            message.hash                 = utils.random_string()
+            message.timestamp            = base_time + \
+                                           datetime.timedelta(seconds=i)
+            message.sender_global_id     = sender.global_id
+            message.recipient_global_id  = recipient.global_id
+            message.sender_account_id    = utils.random_string()
+            message.recipient_account_id = utils.random_string()
+            message.sender_text          = utils.random_string()
+            message.recipient_text       = utils.random_string()
+            message.status               = status
+            message.error                = None
+            message.save()
+            messages.append(message)
+
+        # Corrupt the conversation's summary fields.
+
+        conversation.last_message_1 = "WRONG"
+        conversation.last_message_2 = "WRONG"
+        conversation.num_unread_1   = 99
+        conversation.num_unread_2   = 99
+        conversation.save()
+
+        # Rebuild the conversation summaries.
+
+        call_command("rebuild_conversation_summaries", stdout=StringIO())
+
+        # Check that the conversation now matches its messages.
+
+        conversation = Conversation.objects.get(id=conversation.id)
+
+        self.assertEqual(conversation.num_unread_1, 1)
+        self.assertEqual(conversation.num_unread_2, 2)
+        self.assertEqual(conversation.last_timestamp, messages[-1].timestamp)
+        self.assertEqual(conversation.last_message_1,
+                         messages[-1].recipient_text)
+        self.assertEqual(conversation.last_message_2,
+                         messages[-1].sender_text)
+
+    # -----------------------------------------------------------------------
+
+    def test_rebuild_empty_conversation_summary(self):
+        """ Check that rebuilding clears the summary of an empty conversation.
+        """
+        # Create two profiles, and a conversation between them.
+
+        my_profile    = apiTestHelpers.create_profile()
+        their_profile = apiTestHelpers.create_profile()
+
+        conversation = \
+            apiTestHelpers.create_conversation(my_profile.global_id,
+                                               their_profile.global_id)
+
+        # Give the conversation a stale summary, even though it has no
+        # messages.
+
+        conversation.last_message_1 = "STALE"
+        conversation.last_message_2 = "STALE"
+        conversation.last_timestamp = timezone.now()
+        conversation.save()
+
+        # Rebuild the conversation summaries.
+
+        call_command("rebuild_conversation_summaries", stdout=StringIO())
+
+        # Check that the stale summary has been cleared.
+
+        conversation = Conversation.objects.get(id=conversation.id)
+
+        self.assertEqual(conversation.last_message_1, None)
+        self.assertEqual(conversation.last_message_2, None)
+        self.assertEqual(conversation.last_timestamp, None)
+
+    # -----------------------------------------------------------------------
+
+    def test_rebuild_conversation_summaries_queries(self):
+        """ Check that rebuilding doesn't query each conversation's messages.
+
+            The number of queries made to check the conversations shouldn't
+            depend on the number of conversations.
+        """
+        NUM_CONVERSATIONS = 5
+
+        my_profile = apiTestHelpers.create_profile()
 
+        for i in range(NUM_CONVERSATIONS):
+            their_profile = apiTestHelpers.create_profile()
+            conversation  = apiTestHelpers.create_conversation(
+                                                    my_profile.global_id,
+                                                    their_profile.global_id)
+
+            message = Message()
+            message.conversation         = conversation
+            message.hash                 = utils.random_string()
+            message.timestamp            = timezone.now()
+            message.sender_global_id     = my_profile.global_id
+            message.recipient_global_id  = their_profile.global_id
+            message.sender_account_id    = utils.random_string()
+            message.recipient_account_id = utils.random_string()
+            message.sender_text          = utils.random_string()
+            message.recipient_text       = utils.random_string()
+            message.status               = Message.STATUS_SENT
+            message.error                = None
+            messageHandler.save_message(message)
+
+        # Every conversation now matches its messages, so rebuilding the
+        # summaries should just read the messages and conversations.
+
+        with self.assertNumQueries(4):
+            num_changed = messageHandler.rebuild_conversations()
+
+        self.assertEqual(num_changed, 0)
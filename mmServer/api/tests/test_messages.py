@@ -9,13 +9,15 @@ import logging
 import random
 import uuid
 
+import mock
 from django.utils import unittest, timezone
+from django.core.management import call_command
 import django.test
 
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, transactionHandler
 
 from mmServer.api.tests import apiTestHelpers
 
@@ -133,12 +135,30 @@ class MessageTestCase(django.test.TestCase):
             account_secret=sender_profile.account_secret
         )
 
+        # Create a charge between the same two accounts which hasn't been
+        # linked to its message yet, as if another message was being sent at
+        # exactly the same time.
+
+        now = timezone.now()
+
+        other_charge = Transaction()
+        other_charge.timestamp       = now
+        other_charge.created_by      = sender_account
+        other_charge.status          = Transaction.STATUS_SUCCESS
+        other_charge.type            = Transaction.TYPE_CHARGE
+        other_charge.amount_in_drops = 0
+        other_charge.debit_account   = sender_account
+        other_charge.credit_account  = recipient_account
+        other_charge.message         = None
+        other_charge.save()
+
         # Ask the "POST /api/message" endpoint to create the message.
 
-        response = self.client.post("/api/message",
-                                    request,
-                                    content_type="application/json",
-                                    **headers)
+        with mock.patch("django.utils.timezone.now", return_value=now):
+            response = self.client.post("/api/message",
+                                        request,
+                                        content_type="application/json",
+                                        **headers)
         self.assertEqual(response.status_code, 202)
 
         # Check that a Message record has been created for this message.
@@ -181,9 +201,20 @@ class MessageTestCase(django.test.TestCase):
         # charge of 1 XRP.
 
         system_account = Account.objects.get(id=system_account.id) # Reload.
-        self.assertEqual(system_account.balance_in_drops,
+        self.assertEqual(transactionHandler.get_account_balance(system_account),
                          current_system_account_balance + 1 * XRP)
 
+        # Finally, check that both charges were linked back to the message.
+
+        charges = Transaction.objects.filter(message=message)
+        self.assertItemsEqual([t.amount_in_drops for t in charges],
+                              [2 * XRP, 1 * XRP])
+
+        # The other charge should have been left alone.
+
+        other_charge = Transaction.objects.get(id=other_charge.id)
+        self.assertIsNone(other_charge.message)
+
     # -----------------------------------------------------------------------
 
     #@unittest.skip("Disabled until we support actions again.")
@@ -732,14 +763,15 @@ class MessageTestCase(django.test.TestCase):
 
     # -----------------------------------------------------------------------
 
-    def test_get_messages_finalizes_pending_message(self):
-        """ Check that "GET api/messages" finalizes pending messages.
+    def test_reconciler_finalizes_pending_message(self):
+        """ Check that the "reconcile_pending" command finalizes messages.
 
-            We create a pending message, and then make a "GET api/messages"
-            call, mocking out the Ripple interface to pretend that the message
-            was accepted into the Ripple ledger.  We check to ensure that the
-            pending message is finalized and appears in the list of final
-            messages.
+            We create a pending message, and then run the "reconcile_pending"
+            management command, mocking out the Ripple interface to pretend
+            that the message was accepted into the Ripple ledger.  We check to
+            ensure that the pending message is finalized, and that the "GET
+            api/messages" endpoint returns it without contacting the Ripple
+            network itself.
         """
         # Create two profiles, for testing.
 
@@ -789,10 +821,23 @@ class MessageTestCase(django.test.TestCase):
 
         rippleMock = apiTestHelpers.install_mock_ripple_interface()
 
+        # Run a single pass of the reconciler.  All going well, this should
+        # check with the Ripple server, see that the message has been
+        # validated, and change the message status to "sent".
+
+        call_command("reconcile_pending", once=True)
+
+        # Check that the rippleInterface.request() function was called to check
+        # the transaction status.
+
+        self.assertEqual(rippleMock.call_count, 1)
+        rippleMock.assert_called_once_with('tx',
+                                           transaction=message.hash,
+                                           binary=False)
+
         # Ask the "GET api/messages" endpoint to return the messages for this
-        # conversation.  All going well, the endpoint should check with the
-        # Ripple server, see that the message has been validated, and change
-        # the message status to "sent".
+        # conversation, and check that the message is returned without the
+        # endpoint contacting the Ripple network.
 
         url = "/api/messages?my_global_id=%s&their_global_id=%s&num_msgs=-1" \
             % (sender_profile.global_id, recipient_profile.global_id)
@@ -804,13 +849,11 @@ class MessageTestCase(django.test.TestCase):
         self.assertEqual(response.status_code, 200)
         self.assertEqual(response['Content-Type'], "application/json")
 
-        # Check that the rippleInterface.request() function was called to check
-        # the transaction status.
-
         self.assertEqual(rippleMock.call_count, 1)
-        rippleMock.assert_called_once_with('tx',
-                                           transaction=message.hash,
-                                           binary=False)
+
+        data = json.loads(response.content)
+        self.assertEqual(len(data['messages']), 1)
+        self.assertEqual(data['messages'][0]['hash'], message.hash)
 
         # Get the updated Message record.
 
@@ -3,20 +3,40 @@
     This module implements various unit tests for the "picture" resource's API
     endpoints.
 """
+import StringIO
 import base64
+import cStringIO
+import os
 
 import django.test
+from django.conf       import settings
+from django.core.management import call_command
+from django.test.client import RequestFactory
+from django.test.utils import override_settings
 import simplejson as json
 
+import mock
+
+from PIL import Image
+
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, pictureCache, pictureStore
 from mmServer.api.tests     import apiTestHelpers
 
+import mmServer.api.views.picture
+
 #############################################################################
 
 class PictureTestCase(django.test.TestCase):
     """ Unit tests for the "Picture" resource.
     """
+    def tearDown(self):
+        """ Clean up after running a unit test.
+        """
+        pictureCache.clear()
+
+    # -----------------------------------------------------------------------
+
     def test_get_picture(self):
         """ Test the logic of retrieving a picture.
         """
@@ -34,8 +54,8 @@ class PictureTestCase(django.test.TestCase):
 
         # Check that the expected picture data was returned.
 
-        encoded_data = base64.b64encode(response.content)
-        self.assertEqual(picture.picture_data, encoded_data)
+        self.assertEqual(_response_data(response),
+                         pictureStore.load_picture_data(picture))
 
     # -----------------------------------------------------------------------
 
@@ -93,7 +113,10 @@ class PictureTestCase(django.test.TestCase):
         self.assertEqual(picture.picture_id,       picture_id)
         self.assertEqual(picture.account_secret,   account_secret)
         self.assertEqual(picture.picture_filename, picture_filename)
-        self.assertEqual(picture.picture_data,     encoded_data)
+        self.assertEqual(picture.picture_size,     len(picture_data))
+        self.assertIsNone(picture.picture_data)
+
+        self.assertEqual(pictureStore.load_picture_data(picture), picture_data)
 
     # -----------------------------------------------------------------------
 
@@ -141,7 +164,8 @@ class PictureTestCase(django.test.TestCase):
         updated_picture = Picture.objects.get(picture_id=picture.picture_id)
 
         self.assertEqual(updated_picture.picture_filename, new_picture_filename)
-        self.assertEqual(updated_picture.picture_data,     new_encoded_data)
+        self.assertEqual(pictureStore.load_picture_data(updated_picture),
+                         new_picture_data)
 
     # -----------------------------------------------------------------------
 
@@ -180,3 +204,495 @@ class PictureTestCase(django.test.TestCase):
         self.assertIsNotNone(picture)    # Picture should still exist...
         self.assertTrue(picture.deleted) # ...but be marked as deleted.
 
+
+    # -----------------------------------------------------------------------
+
+    def test_get_scaled_picture(self):
+        """ Check that scaled pictures are rendered once and then cached.
+        """
+        # Create a picture holding a real image.
+
+        picture = apiTestHelpers.create_picture(image_size=(400, 200))
+
+        # Ask for the picture to be scaled to one of the cached sizes, and
+        # check that it was.
+
+        response = self.client.get("/api/picture/" + picture.picture_id +
+                                   "?max_width=128&max_height=128")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], "image/png")
+
+        image_data = _response_data(response)
+        image      = Image.open(cStringIO.StringIO(image_data))
+        self.assertEqual(image.size, (128, 64))
+
+        # Ask for the same rendition again, and check that it is returned
+        # without being rendered again.
+
+        with mock.patch("mmServer.shared.lib.pictureCache._render") as render:
+            response2 = self.client.get("/api/picture/" + picture.picture_id +
+                                        "?max_width=128&max_height=128")
+
+        self.assertEqual(response2.status_code, 200)
+        self.assertEqual(_response_data(response2), image_data)
+        self.assertFalse(render.called)
+
+        # Update the picture, and check that the old rendition is no longer
+        # used.
+
+        picture.save()
+
+        with mock.patch("mmServer.shared.lib.pictureCache._render",
+                        return_value="NEW") as render:
+            response3 = self.client.get("/api/picture/" + picture.picture_id +
+                                        "?max_width=128&max_height=128")
+
+        self.assertEqual(_response_data(response3), "NEW")
+        self.assertTrue(render.called)
+
+    # -----------------------------------------------------------------------
+
+    def test_get_uncached_picture_size(self):
+        """ Check that only the configured picture sizes are cached.
+        """
+        picture = apiTestHelpers.create_picture(image_size=(400, 200))
+        pictureCache.clear()
+
+        # Ask for the picture to be scaled to a size which isn't cached, and
+        # check that it was.
+
+        response = self.client.get("/api/picture/" + picture.picture_id +
+                                   "?max_width=100&max_height=100")
+
+        self.assertEqual(response.status_code, 200)
+
+        image = Image.open(cStringIO.StringIO(_response_data(response)))
+        self.assertEqual(image.size, (100, 50))
+
+        # Nothing should have been added to the cache.
+
+        self.assertEqual(pictureCache._scan(), (0, []))
+
+    # -----------------------------------------------------------------------
+
+    def test_picture_cache_eviction(self):
+        """ Check that the least recently used renditions are evicted.
+        """
+        picture = apiTestHelpers.create_picture(image_size=(400, 400))
+
+        # Pre-render the picture, and check that every warm size was cached.
+
+        with override_settings(PICTURE_CACHE_WARM_SIZES=[(32, 32), (64, 64)]):
+            pictureCache.warm(picture)
+
+        sizes = {}
+        for dir_name,sub_dirs,file_names in os.walk(settings.PICTURE_CACHE_DIR):
+            for file_name in file_names:
+                path = os.path.join(dir_name, file_name)
+                size = file_name.split("-")[1].split(".")[0]
+                sizes[size] = (path, os.path.getsize(path))
+
+        self.assertEqual(sorted(sizes.keys()), ["32x32", "64x64"])
+
+        # Make the 32x32 rendition the least recently used one, and then add a
+        # new rendition which doesn't fit within our budget.  The least
+        # recently used rendition should be evicted to bring the cache down to
+        # its low-water mark.
+
+        os.utime(sizes['32x32'][0], (0, 0))
+
+        new_size = len(pictureCache._render(picture, 16, 16, "png"))
+        budget   = int((sizes['64x64'][1] + new_size) /
+                       pictureCache.EVICTION_LOW_WATER) + 1
+
+        self.assertGreater(sizes['32x32'][1] + sizes['64x64'][1] + new_size,
+                           budget)
+
+        with override_settings(PICTURE_CACHE_MAX_BYTES=budget,
+                               PICTURE_CACHE_WARM_SIZES=[(16, 16)]):
+            pictureCache.get_rendition(picture, 16, 16, "png")
+
+        self.assertFalse(os.path.exists(sizes['32x32'][0]))
+        self.assertTrue(os.path.exists(sizes['64x64'][0]))
+
+        total_bytes = pictureCache._scan()[0]
+        self.assertLessEqual(total_bytes,
+                             budget * pictureCache.EVICTION_LOW_WATER)
+
+    # -----------------------------------------------------------------------
+
+    def test_migrate_picture_data(self):
+        """ Check that legacy picture data is moved into the picture store.
+        """
+        # Create some pictures which hold their image data in the Picture
+        # record itself, as pictures used to.
+
+        legacy_pictures = {}
+        for i in range(5):
+            raw_data = utils.random_string(min_length=1000, max_length=2000)
+
+            picture = Picture()
+            picture.picture_id       = utils.calc_unique_picture_id()
+            picture.account_secret   = utils.random_string()
+            picture.picture_filename = utils.random_string() + ".png"
+            picture.picture_data     = base64.b64encode(raw_data)
+            picture.save()
+
+            legacy_pictures[picture.picture_id] = raw_data
+
+        # Check that the legacy pictures can still be retrieved.
+
+        picture_id = legacy_pictures.keys()[0]
+        response = self.client.get("/api/picture/" + picture_id)
+        self.assertEqual(response.content, legacy_pictures[picture_id])
+
+        # Move the image data into the picture store, in small batches.
+
+        call_command("migrate_picture_data", batch_size=2,
+                     stdout=StringIO.StringIO())
+
+        # Check that the pictures now refer to the picture store.
+
+        for picture_id,raw_data in legacy_pictures.items():
+            picture = Picture.objects.get(picture_id=picture_id)
+            self.assertIsNotNone(picture.picture_hash)
+            self.assertIsNone(picture.picture_data)
+            self.assertEqual(picture.picture_size, len(raw_data))
+            self.assertEqual(pictureStore.load_picture_data(picture), raw_data)
+
+    # -----------------------------------------------------------------------
+
+    def test_conditional_get_picture(self):
+        """ Check that a client can revalidate a cached picture.
+        """
+        picture = apiTestHelpers.create_picture()
+
+        # Retrieve the picture, and check that the response can be cached.
+
+        response = self.client.get("/api/picture/" + picture.picture_id)
+
+        self.assertEqual(response.status_code, 200)
+        etag = response['ETag']
+        self.assertEqual(etag, '"%s-%d"' % (picture.picture_id,
+                                            picture.update_id))
+        self.assertIn("max-age", response['Cache-Control'])
+
+        # Ask for the picture again, supplying the ETag.  The picture hasn't
+        # changed, so we should get a "304 Not Modified" response.
+
+        response = self.client.get("/api/picture/" + picture.picture_id,
+                                   HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+        # Update the picture, and check that the old ETag no longer matches.
+
+        picture.save()
+
+        response = self.client.get("/api/picture/" + picture.picture_id,
+                                   HTTP_IF_NONE_MATCH=etag)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    # -----------------------------------------------------------------------
+
+    def test_sendfile_picture(self):
+        """ Check that pictures can be sent by the front-end web server.
+        """
+        picture = apiTestHelpers.create_picture(image_size=(400, 200))
+        path    = pictureStore.picture_path(picture)
+
+        with override_settings(PICTURE_SENDFILE="X-Sendfile"):
+            response = self.client.get("/api/picture/" + picture.picture_id)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Sendfile'], path)
+        self.assertEqual(response.content, "")
+
+        with override_settings(PICTURE_SENDFILE="X-Accel-Redirect",
+                               PICTURE_STORE_URL="/internal/pictures/",
+                               PICTURE_CACHE_URL="/internal/cache/"):
+            response = self.client.get("/api/picture/" + picture.picture_id)
+            response2 = self.client.get("/api/picture/" + picture.picture_id +
+                                        "?max_width=128&max_height=128")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['X-Accel-Redirect'],
+                         "/internal/pictures/" +
+                         os.path.relpath(path, settings.PICTURE_STORE_DIR))
+
+        self.assertEqual(response2.status_code, 200)
+        self.assertTrue(response2['X-Accel-Redirect'].startswith(
+                                                        "/internal/cache/"))
+        self.assertEqual(response2['Content-Type'], "image/png")
+
+    # -----------------------------------------------------------------------
+
+    def test_upload_raw_picture(self):
+        """ Test the process of uploading a picture as a raw image.
+        """
+        account_secret = utils.random_string()
+        image_data     = _make_image((300, 200))
+
+        headers = utils.calc_hmac_headers(method="POST",
+                                          url="/api/picture",
+                                          body=image_data,
+                                          account_secret=account_secret)
+
+        response = self.client.post("/api/picture",
+                                    image_data,
+                                    content_type="image/png",
+                                    HTTP_ACCOUNT_SECRET=account_secret,
+                                    HTTP_PICTURE_FILENAME="avatar.png",
+                                    **headers)
+
+        self.assertEqual(response.status_code, 201)
+        picture_id = response.content
+
+        # Check that the picture has been created.
+
+        picture = Picture.objects.get(picture_id=picture_id)
+
+        self.assertEqual(picture.account_secret,   account_secret)
+        self.assertEqual(picture.picture_filename, "avatar.png")
+        self.assertEqual(picture.picture_size,     len(image_data))
+        self.assertEqual(pictureStore.load_picture_data(picture), image_data)
+
+        # Replace the picture with a new raw image.
+
+        new_image_data = _make_image((50, 50))
+
+        headers = utils.calc_hmac_headers(method="PUT",
+                                          url="/api/picture/" + picture_id,
+                                          body=new_image_data,
+                                          account_secret=account_secret)
+
+        response = self.client.put("/api/picture/" + picture_id,
+                                   new_image_data,
+                                   content_type="image/png",
+                                   **headers)
+
+        self.assertEqual(response.status_code, 200)
+
+        picture = Picture.objects.get(picture_id=picture_id)
+        self.assertEqual(picture.picture_filename, "avatar.png")
+        self.assertEqual(pictureStore.load_picture_data(picture),
+                         new_image_data)
+
+    # -----------------------------------------------------------------------
+
+    def test_upload_invalid_raw_picture(self):
+        """ Check that invalid raw picture uploads are rejected.
+        """
+        account_secret = utils.random_string()
+        image_data     = _make_image((300, 200))
+
+        # Upload a picture whose body doesn't match the Content-MD5 header.
+
+        headers = utils.calc_hmac_headers(method="POST",
+                                          url="/api/picture",
+                                          body=image_data,
+                                          account_secret=account_secret)
+
+        response = self.client.post("/api/picture",
+                                    image_data + "x",
+                                    content_type="image/png",
+                                    HTTP_ACCOUNT_SECRET=account_secret,
+                                    HTTP_PICTURE_FILENAME="avatar.png",
+                                    **headers)
+
+        self.assertEqual(response.status_code, 403)
+
+        # Upload a picture which isn't a valid image.
+
+        image_data = utils.random_string(min_length=1000, max_length=2000)
+
+        headers = utils.calc_hmac_headers(method="POST",
+                                          url="/api/picture",
+                                          body=image_data,
+                                          account_secret=account_secret)
+
+        response = self.client.post("/api/picture",
+                                    image_data,
+                                    content_type="image/png",
+                                    HTTP_ACCOUNT_SECRET=account_secret,
+                                    HTTP_PICTURE_FILENAME="avatar.png",
+                                    **headers)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Picture.objects.count(), 0)
+
+        # Check that no partial uploads were left behind.
+
+        for dir_name,sub_dirs,file_names in os.walk(
+                                                settings.PICTURE_STORE_DIR):
+            for file_name in file_names:
+                self.assertFalse(file_name.startswith("."))
+
+    # -----------------------------------------------------------------------
+
+    def test_upload_too_large_picture(self):
+        """ Check that pictures over PICTURE_MAX_UPLOAD_BYTES are rejected.
+        """
+        account_secret = utils.random_string()
+        image_data     = _make_image((300, 200))
+        max_bytes      = len(image_data) - 1
+
+        headers = utils.calc_hmac_headers(method="POST",
+                                          url="/api/picture",
+                                          body=image_data,
+                                          account_secret=account_secret)
+
+        # Upload the picture as a raw image.  This should be rejected based on
+        # its Content-Length header, before the image data is read.
+
+        with override_settings(PICTURE_MAX_UPLOAD_BYTES=max_bytes):
+            with mock.patch("mmServer.shared.lib.pictureStore.get_store") \
+                    as get_store:
+                response = self.client.post("/api/picture",
+                                            image_data,
+                                            content_type="image/png",
+                                            HTTP_ACCOUNT_SECRET=account_secret,
+                                            HTTP_PICTURE_FILENAME="avatar.png",
+                                            **headers)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertFalse(get_store.called)
+
+        # Upload the picture again, without a Content-Length header.  This
+        # should be rejected as soon as too much data has been read.
+
+        factory = RequestFactory()
+        request = factory.post("/api/picture",
+                               image_data,
+                               content_type="image/png",
+                               HTTP_ACCOUNT_SECRET=account_secret,
+                               HTTP_PICTURE_FILENAME="avatar.png",
+                               **headers)
+        del request.META['CONTENT_LENGTH']
+
+        with override_settings(PICTURE_MAX_UPLOAD_BYTES=max_bytes):
+            response = mmServer.api.views.picture.endpoint(request)
+
+        self.assertEqual(response.status_code, 413)
+
+        # Upload the picture as base64-encoded JSON data.
+
+        body = json.dumps({'account_secret'   : account_secret,
+                           'picture_filename' : "avatar.png",
+                           'picture_data'     : base64.b64encode(image_data)})
+
+        headers = utils.calc_hmac_headers(method="POST",
+                                          url="/api/picture",
+                                          body=body,
+                                          account_secret=account_secret)
+
+        with override_settings(PICTURE_MAX_UPLOAD_BYTES=max_bytes):
+            response = self.client.post("/api/picture",
+                                        body,
+                                        content_type="application/json",
+                                        **headers)
+
+        self.assertEqual(response.status_code, 413)
+        self.assertEqual(Picture.objects.count(), 0)
+
+        # Check that no partial uploads were left behind.
+
+        for dir_name,sub_dirs,file_names in os.walk(
+                                                settings.PICTURE_STORE_DIR):
+            for file_name in file_names:
+                self.assertFalse(file_name.startswith("."))
+
+    # -----------------------------------------------------------------------
+
+    def test_upload_unsigned_raw_picture(self):
+        """ Check that a badly-signed raw upload is rejected before it is read.
+        """
+        account_secret = utils.random_string()
+        image_data     = _make_image((300, 200))
+
+        headers = utils.calc_hmac_headers(method="POST",
+                                          url="/api/picture",
+                                          body=image_data,
+                                          account_secret=account_secret + "x")
+
+        with mock.patch("mmServer.shared.lib.pictureStore.get_store") \
+                as get_store:
+            response = self.client.post("/api/picture",
+                                        image_data,
+                                        content_type="image/png",
+                                        HTTP_ACCOUNT_SECRET=account_secret,
+                                        HTTP_PICTURE_FILENAME="avatar.png",
+                                        **headers)
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(get_store.called)
+
+    # -----------------------------------------------------------------------
+
+    def test_in_memory_picture_store(self):
+        """ Check that pictures can be kept in the in-memory picture store.
+        """
+        account_secret = utils.random_string()
+        image_data     = _make_image((300, 200))
+
+        with override_settings(
+                PICTURE_STORE="mmServer.shared.lib.pictureStore.PictureStore"):
+
+            # Upload a picture as a raw image, and then download it again.
+
+            headers = utils.calc_hmac_headers(method="POST",
+                                              url="/api/picture",
+                                              body=image_data,
+                                              account_secret=account_secret)
+
+            response = self.client.post("/api/picture",
+                                        image_data,
+                                        content_type="image/png",
+                                        HTTP_ACCOUNT_SECRET=account_secret,
+                                        HTTP_PICTURE_FILENAME="avatar.png",
+                                        **headers)
+
+            self.assertEqual(response.status_code, 201)
+            picture_id = response.content
+
+            response = self.client.get("/api/picture/" + picture_id)
+
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(_response_data(response), image_data)
+
+            # The image data shouldn't have been written to a file.
+
+            picture = Picture.objects.get(picture_id=picture_id)
+            self.assertIsNone(pictureStore.picture_path(picture))
+
+            # Asking for missing image data should raise a KeyError.
+
+            self.assertRaises(KeyError, pictureStore.get_store().get, "x")
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _response_data(response):
+    """ Return the body of the given response, which may be streamed.
+    """
+    if response.streaming:
+        return "".join(response.streaming_content)
+    else:
+        return response.content
+
+
+def _make_image(image_size):
+    """ Return the raw data for a PNG image of the given size.
+    """
+    buffer = cStringIO.StringIO()
+    Image.new("RGB", image_size, (0, 0, 255)).save(buffer, format="png")
+    image_data = buffer.getvalue()
+    buffer.close()
+    return image_data
@@ -3,14 +3,26 @@
     This module implements various unit tests for the "profile" resource's API
     endpoints.
 """
+import datetime
 import logging
-
+import time
+from StringIO import StringIO
+
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db              import connection
+from django.http            import HttpResponseNotFound
+from django.test.client     import RequestFactory
+from django.utils           import timezone, unittest
 import django.test
 
+import mock
+
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, nonceCache, dbHelpers
+from mmServer.shared.lib    import profileCache, changeNotifier
 from mmServer.api.tests     import apiTestHelpers
 
 #############################################################################
@@ -264,6 +276,197 @@ class ProfileTestCase(django.test.TestCase):
 
     # -----------------------------------------------------------------------
 
+    def test_reused_nonce(self):
+        """ Check that an authenticated request can't be replayed.
+        """
+        # Create a dummy profile for testing.
+
+        profile = apiTestHelpers.create_profile()
+
+        # Calculate the HMAC authentication headers we need to make an
+        # authenticated request.
+
+        headers = utils.calc_hmac_headers(
+            method="GET",
+            url="/api/profile/"+profile.global_id,
+            body="",
+            account_secret=profile.account_secret
+        )
+
+        # The first request using these headers should succeed.
+
+        response = self.client.get("/api/profile/" + profile.global_id,
+                                   **headers)
+        self.assertEqual(response.status_code, 200)
+
+        # Resending the same request should fail, as the nonce value has
+        # already been used.
+
+        response = self.client.get("/api/profile/" + profile.global_id,
+                                   **headers)
+        self.assertEqual(response.status_code, 403)
+
+        # The request should still fail if the nonce value isn't remembered in
+        # memory, as happens when the request is sent to a different server
+        # process.
+
+        nonceCache.clear()
+
+        response = self.client.get("/api/profile/" + profile.global_id,
+                                   **headers)
+        self.assertEqual(response.status_code, 403)
+
+    # -----------------------------------------------------------------------
+
+    def test_purge_nonce_values(self):
+        """ Check that old nonce values are purged from the database.
+        """
+        old_nonce    = utils.random_string()
+        recent_nonce = utils.random_string()
+
+        # Use a nonce value sixty days ago, and another one today.
+
+        sixty_days_ago = timezone.now() - datetime.timedelta(days=60)
+        with mock.patch("django.utils.timezone.now",
+                        return_value=sixty_days_ago):
+            self.assertTrue(nonceCache.use_nonce(old_nonce))
+
+        self.assertTrue(nonceCache.use_nonce(recent_nonce))
+
+        # Purge the nonce values older than thirty days.
+
+        output = StringIO()
+        with self.settings(KEEP_NONCE_VALUES_FOR=30):
+            call_command("purge_nonce_values", stdout=output)
+
+        if dbHelpers.is_postgres():
+            self.assertIn("Dropped 1 partitions and deleted 0 nonce values.",
+                          output.getvalue())
+        else:
+            self.assertIn("Dropped 0 partitions and deleted 1 nonce values.",
+                          output.getvalue())
+
+        # The old nonce value should now have been forgotten, while the recent
+        # one is still remembered.
+
+        nonceCache.clear()
+
+        self.assertTrue(nonceCache.use_nonce(old_nonce))
+        self.assertFalse(nonceCache.use_nonce(recent_nonce))
+
+        # Nothing should be purged if the nonce values are kept forever.
+
+        output = StringIO()
+        with self.settings(KEEP_NONCE_VALUES_FOR=None):
+            call_command("purge_nonce_values", stdout=output)
+
+        self.assertIn("nonce values are being kept forever",
+                      output.getvalue())
+
+    # -----------------------------------------------------------------------
+
+    @unittest.skipUnless(dbHelpers.is_postgres(),
+                         "Set MMS_TEST_DATABASE_URL to a PostgreSQL " +
+                         "database to run the nonce partition tests.")
+    def test_nonce_check_skips_old_partitions(self):
+        """ Check that a nonce value isn't checked against old partitions.
+        """
+        now = timezone.now()
+
+        # Create a partition for sixty days ago, and one for today.
+
+        old_name,old_start,old_end = \
+            nonceCache.partition_for(now - datetime.timedelta(days=60))
+        nonceCache.create_partition(old_name, old_start, old_end)
+
+        name,start,end = nonceCache.partition_for(now)
+        nonceCache.create_partition(name, start, end)
+
+        # Ask PostgreSQL how it would insert a new nonce value.  Only today's
+        # partition should be checked.
+
+        with self.settings(KEEP_NONCE_VALUES_FOR=30):
+            sql,params = nonceCache._build_partition_insert(
+                                        name, utils.random_string(), now)
+
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = "\n".join([row[0] for row in cursor.fetchall()])
+
+        self.assertIn(name, plan)
+        self.assertNotIn(old_name, plan)
+
+        # Keeping the nonce values forever isn't allowed on PostgreSQL.
+
+        with self.settings(KEEP_NONCE_VALUES_FOR=None):
+            self.assertRaises(ImproperlyConfigured, nonceCache.use_nonce,
+                              utils.random_string())
+
+    # -----------------------------------------------------------------------
+
+    def test_cached_account_secret(self):
+        """ Check that authentication copes with a changed account secret.
+        """
+        profile = apiTestHelpers.create_profile()
+        factory = RequestFactory()
+
+        def make_request(account_secret):
+            headers = utils.calc_hmac_headers(method="GET",
+                                              url="/api/test",
+                                              body="",
+                                              account_secret=account_secret)
+            return factory.get("/api/test", **headers)
+
+        # Authenticate a request, which caches the user's account secret.
+
+        request = make_request(profile.account_secret)
+        self.assertEqual(profileCache.authenticate(request, profile.global_id),
+                         None)
+        self.assertEqual(profileCache.get_account_secret(profile.global_id),
+                         profile.account_secret)
+
+        # Change the account secret behind the cache's back, as would happen
+        # if another server process changed it.  A request using the new
+        # secret should still be accepted, while the old secret is rejected.
+
+        old_secret = profile.account_secret
+        new_secret = old_secret + "x"
+        Profile.objects.filter(id=profile.id).update(account_secret=new_secret)
+
+        request = make_request(new_secret)
+        self.assertEqual(profileCache.authenticate(request, profile.global_id),
+                         None)
+
+        request = make_request(old_secret)
+        response = profileCache.authenticate(request, profile.global_id)
+        self.assertEqual(response.status_code, 403)
+
+        # Saving the profile should remove it from the cache, so the cached
+        # account secret can no longer be used.
+
+        profile = Profile.objects.get(id=profile.id)
+        profile.account_secret = utils.random_string()
+        profile.save()
+
+        request = make_request(new_secret)
+        response = profileCache.authenticate(request, profile.global_id)
+        self.assertEqual(response.status_code, 403)
+
+        request = make_request(profile.account_secret)
+        self.assertEqual(profileCache.authenticate(request, profile.global_id),
+                         None)
+
+        # Deleting the profile should also remove it from the cache.
+
+        profile.delete()
+
+        request  = make_request(profile.account_secret)
+        response = profileCache.authenticate(request, profile.global_id,
+                                             HttpResponseNotFound())
+        self.assertEqual(response.status_code, 404)
+
+    # -----------------------------------------------------------------------
+
     def test_create_profile(self):
         """ Test the process of creating a new user profile.
         """
@@ -512,3 +715,54 @@ class ProfileTestCase(django.test.TestCase):
         self.assertIsNotNone(profile) # Should simply mark profile as deleted.
         self.assertTrue(profile.deleted)
 
+
+#############################################################################
+
+class ProfileCacheTestCase(django.test.TransactionTestCase):
+    """ Unit tests for the profile cache.
+
+        These tests commit their changes, so that (on PostgreSQL) the change
+        notifications are actually delivered.
+    """
+    def test_account_secret_changed_elsewhere(self):
+        """ Check that a changed account secret is removed from the cache.
+        """
+        profile = apiTestHelpers.create_profile()
+        factory = RequestFactory()
+
+        def make_request(account_secret):
+            headers = utils.calc_hmac_headers(method="GET",
+                                              url="/api/test",
+                                              body="",
+                                              account_secret=account_secret)
+            return factory.get("/api/test", **headers)
+
+        # Authenticate a request, which caches the user's account secret.
+
+        old_secret = profile.account_secret
+        request    = make_request(old_secret)
+        self.assertEqual(profileCache.authenticate(request, profile.global_id),
+                         None)
+
+        # Change the account secret behind the cache's back, and send the
+        # notification which another server process would send when saving
+        # the profile.
+
+        new_secret = old_secret + "x"
+        Profile.objects.filter(id=profile.id).update(account_secret=new_secret)
+        changeNotifier.send(profileCache.CHANNEL, profile.global_id)
+
+        # The old account secret should stop being accepted as soon as the
+        # notification has been delivered.
+
+        deadline = time.time() + 10
+        while True:
+            request = make_request(old_secret)
+            if profileCache.authenticate(request, profile.global_id) != None:
+                break
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.05)
+
+        request = make_request(new_secret)
+        self.assertEqual(profileCache.authenticate(request, profile.global_id),
+                         None)
@@ -0,0 +1,183 @@
+""" mmServer.api.tests.test_query_plans
+
+    This module checks that the hot database queries made by the API can use
+    the database's indexes.
+
+    Each test seeds the database with a large number of messages and
+    transactions, and then asks PostgreSQL to EXPLAIN the queries made by the
+    busiest API endpoints.  The test fails if any of these queries would
+    sequentially scan the Message, Transaction or ChangeLogEntry tables.
+"""
+import datetime
+import re
+
+from django.db    import connection
+from django.utils import unittest, timezone
+import django.test
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import dbHelpers
+
+from mmServer.api.tests import apiTestHelpers
+
+import mmServer.api.views.account
+import mmServer.api.views.messages
+
+#############################################################################
+
+@unittest.skipUnless(dbHelpers.is_postgres(),
+                     "Set MMS_TEST_DATABASE_URL to a PostgreSQL database " +
+                     "to run the query plan tests.")
+class QueryPlanTestCase(django.test.TestCase):
+    """ Query plan tests for the hot API queries.
+
+        These tests only work with PostgreSQL, as they rely on PostgreSQL's
+        query planner.
+    """
+    NUM_USERS        = 200
+    NUM_MESSAGES     = 50000
+    NUM_TRANSACTIONS = 50000
+
+    def setUp(self):
+        """ Seed the database with a large dataset.
+
+            The messages, transactions and change log entries are generated
+            within the database, as creating this many records using the
+            Django ORM would take far too long.
+        """
+        # Create the users' accounts.
+
+        self.global_ids = []
+        for i in range(self.NUM_USERS):
+            self.global_ids.append("user_%d" % i)
+
+        Account.objects.bulk_create([
+            Account(type=Account.TYPE_USER, global_id=global_id,
+                    balance_in_drops=0)
+            for global_id in self.global_ids])
+
+        self.accounts = list(Account.objects.filter(type=Account.TYPE_USER)
+                                            .order_by("id"))
+        account_ids   = [account.id for account in self.accounts]
+
+        conversation = apiTestHelpers.create_conversation(self.global_ids[0],
+                                                          self.global_ids[1])
+
+        cursor = connection.cursor()
+
+        # Create the messages.  Each message is sent between a different pair
+        # of users, cycling through every possible pair.
+
+        cursor.execute("INSERT INTO " + Message._meta.db_table +
+                       " (conversation_id, hash, timestamp," +
+                       " sender_global_id, recipient_global_id," +
+                       " sender_account_id," +
+                       " recipient_account_id, sender_text, recipient_text," +
+                       " action_processed, message_charge, system_charge," +
+                       " system_charge_paid_by, status)" +
+                       " SELECT %s, 'msg_' || i, NOW(), sender, recipient," +
+                       " sender, recipient, '', '', FALSE, 0, 0, %s, %s" +
+                       " FROM (SELECT i, 'user_' || (i %% %s) AS sender," +
+                       " 'user_' || ((i + 1 + (i / %s) %% (%s - 1)) %% %s)" +
+                       " AS recipient FROM generate_series(1, %s) AS i) AS s",
+                       [conversation.id,
+                        Message.SYSTEM_CHARGE_PAID_BY_SENDER,
+                        Message.STATUS_SENT,
+                        self.NUM_USERS, self.NUM_USERS, self.NUM_USERS,
+                        self.NUM_USERS, self.NUM_MESSAGES])
+
+        # Create the transactions, between pairs of accounts, spread over the
+        # last few months.
+
+        cursor.execute("INSERT INTO " + Transaction._meta.db_table +
+                       " (timestamp, created_by_id, status, type," +
+                       " amount_in_drops, debit_account_id," +
+                       " credit_account_id)" +
+                       " SELECT NOW() - i * INTERVAL '1 minute', debit, %s," +
+                       " %s, 1, debit, credit" +
+                       " FROM (SELECT i, (%s::integer[])[1 + i %% %s]" +
+                       " AS debit, (%s::integer[])[1 + (i + 1 + (i / %s)" +
+                       " %% (%s - 1)) %% %s] AS credit" +
+                       " FROM generate_series(1, %s) AS i) AS s",
+                       [Transaction.STATUS_SUCCESS,
+                        Transaction.TYPE_CHARGE,
+                        account_ids, self.NUM_USERS,
+                        account_ids, self.NUM_USERS, self.NUM_USERS,
+                        self.NUM_USERS, self.NUM_TRANSACTIONS])
+
+        # Create a change log entry for each message, for both users.
+
+        for field in ["sender_global_id", "recipient_global_id"]:
+            cursor.execute("INSERT INTO " + ChangeLogEntry._meta.db_table +
+                           " (global_id, seq, type, object_id)" +
+                           " SELECT " + field + ", id, %s, id" +
+                           " FROM " + Message._meta.db_table,
+                           [ChangeLogEntry.TYPE_MESSAGE])
+
+        for model in [Account, Message, Transaction, ChangeLogEntry]:
+            cursor.execute("ANALYZE " + model._meta.db_table)
+
+    # -----------------------------------------------------------------------
+
+    def test_messages_query_plans(self):
+        """ Check the query plans for the "GET api/messages" endpoint.
+        """
+        build_query = mmServer.api.views.messages._build_query
+
+        my_global_id    = self.global_ids[0]
+        their_global_id = self.global_ids[1]
+
+        self.assertUsesIndexes(build_query(my_global_id, their_global_id,
+                                           None, 21))
+        self.assertUsesIndexes(build_query(my_global_id, their_global_id,
+                                           1000, 21))
+        self.assertUsesIndexes(build_query(my_global_id, None, None, 21))
+
+    # -----------------------------------------------------------------------
+
+    def test_changes_query_plan(self):
+        """ Check the query plan for the "GET api/changes" endpoint.
+        """
+        self.assertUsesIndexes(ChangeLogEntry.objects.filter(
+                                        global_id=self.global_ids[0],
+                                        seq__gt=1000,
+                                        seq__lte=2000)
+                                                     .order_by("seq"))
+
+    # -----------------------------------------------------------------------
+
+    def test_transactions_query_plans(self):
+        """ Check the query plans for the "GET api/account" endpoint.
+        """
+        build_query = mmServer.api.views.account._build_transactions_query
+
+        account = self.accounts[0]
+        params  = {'tz_offset' : None, 'tpp' : 20, 'page' : 0}
+
+        self.assertUsesIndexes(build_query(account, params))
+
+        params['type'] = "charges_paid"
+        self.assertUsesIndexes(build_query(account, params))
+
+        del params['type']
+        params['after'] = (timezone.now() - datetime.timedelta(days=10), 1)
+        self.assertUsesIndexes(build_query(account, params))
+
+    # -----------------------------------------------------------------------
+
+    def assertUsesIndexes(self, queryset):
+        """ Check that the given QuerySet doesn't scan any of the hot tables.
+        """
+        sql,params = queryset.query.sql_with_params()
+
+        cursor = connection.cursor()
+        cursor.execute("EXPLAIN " + sql, params)
+        plan = "\n".join([row[0] for row in cursor.fetchall()])
+
+        hot_tables = [Message._meta.db_table,
+                      Transaction._meta.db_table,
+                      ChangeLogEntry._meta.db_table]
+
+        for table in hot_tables:
+            if re.search(r"Seq Scan on %s\b" % table, plan):
+                self.fail("Sequential scan of %s:\n%s" % (table, plan))
@@ -0,0 +1,309 @@
+""" mmServer.api.tests.test_ripple
+
+    This module implements various unit tests for our communication with the
+    Ripple network.  Rather than mocking out the rippleInterface module, these
+    tests talk to one or more fake rippled servers running within the test
+    process.
+"""
+import threading
+import time
+
+from django.core.management import call_command
+import django.test
+
+import simplejson as json
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import utils, rippleInterface, fakeRippled
+from mmServer.api.tests     import apiTestHelpers
+
+#############################################################################
+
+class RippleTestCase(django.test.TestCase):
+    """ Unit tests for talking to rippled servers.
+    """
+    def setUp(self):
+        """ Prepare to run a test.
+        """
+        apiTestHelpers.uninstall_mock_ripple_interface()
+        rippleInterface.close_connections()
+        self.servers = []
+
+
+    def tearDown(self):
+        """ Clean up after running a test.
+        """
+        rippleInterface.close_connections()
+        for server in self.servers:
+            server.stop()
+
+
+    def start_server(self, **kwargs):
+        """ Start a fake rippled server with the given settings.
+        """
+        server = fakeRippled.FakeRippledServer(**kwargs)
+        server.start()
+        self.servers.append(server)
+        return server
+
+    # -----------------------------------------------------------------------
+
+    def test_payment_is_validated(self):
+        """ Check that a submitted payment is validated once a ledger closes.
+        """
+        server = self.start_server(validation_delay=2, ledger_interval=0.2)
+
+        with self.settings(RIPPLED_SERVER_URLS=[server.url]):
+            response = rippleInterface.request("sign",
+                                               tx_json={'TransactionType' :
+                                                            "Payment",
+                                                        'Account'         :
+                                                            "rSender",
+                                                        'Destination'     :
+                                                            "rRecipient",
+                                                        'Amount'          :
+                                                            "100"},
+                                               secret="sSecret",
+                                               fee_mult_max=1000000)
+            self.assertEqual(response['status'], "success")
+
+            response = rippleInterface.request("submit",
+                                               tx_blob=response['result']
+                                                               ['tx_blob'],
+                                               fail_hard=True)
+            self.assertEqual(response['status'], "success")
+
+            tx_hash = response['result']['tx_json']['hash']
+
+            response = rippleInterface.request("tx", transaction=tx_hash,
+                                                     binary=False)
+            self.assertEqual(response['status'], "success")
+            self.assertFalse(response['result']['validated'])
+
+            time.sleep(0.5)
+
+            response = rippleInterface.request("tx", transaction=tx_hash,
+                                                     binary=False)
+            self.assertEqual(response['status'], "success")
+            self.assertTrue(response['result']['validated'])
+            self.assertEqual(response['result']['meta']['TransactionResult'],
+                             "tesSUCCESS")
+
+            response = rippleInterface.request("tx", transaction="UNKNOWN",
+                                                     binary=False)
+            self.assertEqual(response['status'], "error")
+            self.assertEqual(response['error'], "txnNotFound")
+
+    # -----------------------------------------------------------------------
+
+    def test_connection_pool(self):
+        """ Check that concurrent requests share one connection to a server.
+        """
+        NUM_REQUESTS = 10
+
+        server = self.start_server(latency=0.05)
+
+        responses = []
+
+        def send_ping():
+            responses.append(rippleInterface.request("ping"))
+
+        with self.settings(RIPPLED_SERVER_URLS=[server.url]):
+            threads = []
+            for i in range(NUM_REQUESTS):
+                thread = threading.Thread(target=send_ping)
+                thread.start()
+                threads.append(thread)
+
+            for thread in threads:
+                thread.join()
+
+            response = rippleInterface.request("ping")
+            self.assertEqual(response['status'], "success")
+
+        self.assertEqual(len(responses), NUM_REQUESTS)
+        for response in responses:
+            self.assertEqual(response['status'], "success")
+
+        self.assertEqual(server.num_requests, NUM_REQUESTS + 1)
+        self.assertEqual(server.num_connections, 1)
+
+    # -----------------------------------------------------------------------
+
+    def test_request_timeout(self):
+        """ Check that a request gives up if the server doesn't respond.
+        """
+        server = self.start_server(drop_rate=1.0)
+
+        with self.settings(RIPPLED_SERVER_URLS=[server.url],
+                           RIPPLED_REQUEST_TIMEOUT=0.2):
+            start_time = time.time()
+            response   = rippleInterface.request("ping")
+            elapsed    = time.time() - start_time
+
+        self.assertEqual(response, None)
+        self.assertLess(elapsed, 1.0)
+
+    # -----------------------------------------------------------------------
+
+    def test_reconnect(self):
+        """ Check that we reconnect to a server after the connection drops.
+        """
+        server = self.start_server()
+
+        with self.settings(RIPPLED_SERVER_URLS=[server.url]):
+            response = rippleInterface.request("ping")
+            self.assertEqual(response['status'], "success")
+
+            # Restart the server on the same port, dropping our connection.
+
+            server.stop()
+            server.start()
+            time.sleep(0.2)
+
+            response = rippleInterface.request("ping")
+            self.assertEqual(response['status'], "success")
+
+        self.assertEqual(server.num_connections, 2)
+
+    # -----------------------------------------------------------------------
+
+    def test_deposit(self):
+        """ Check that a deposit goes through from start to finish.
+
+            We make a "POST api/transaction" call to deposit some funds, and
+            then run the "reconcile_pending" management command once the
+            Ripple transaction has been validated.  The user's account should
+            then be credited with the deposit.
+        """
+        server  = self.start_server(latency=0.01, ledger_interval=0.2)
+        profile = apiTestHelpers.create_profile()
+
+        request = json.dumps({'global_id'      : profile.global_id,
+                              'ripple_account' : utils.random_string(),
+                              'type'           : "DEPOSIT",
+                              'amount'         : 1000})
+
+        headers = utils.calc_hmac_headers(
+            method="POST",
+            url="/api/transaction",
+            body=request,
+            account_secret=profile.account_secret
+        )
+
+        with self.settings(RIPPLED_SERVER_URLS=[server.url]):
+            response = self.client.post("/api/transaction",
+                                        request,
+                                        content_type="application/json",
+                                        **headers)
+            self.assertEqual(response.status_code, 200)
+
+            data = json.loads(response.content)
+            self.assertEqual(data['status'], "PENDING")
+
+            time.sleep(0.3)
+            call_command("reconcile_pending", once=True)
+
+        transaction = Transaction.objects.get(id=data['transaction_id'])
+        self.assertEqual(transaction.status, Transaction.STATUS_SUCCESS)
+
+        account = Account.objects.get(type=Account.TYPE_USER,
+                                      global_id=profile.global_id)
+        self.assertEqual(account.balance_in_drops, 1000)
+
+    # -----------------------------------------------------------------------
+
+    def test_failover(self):
+        """ Check that a request is retried on another server if it fails.
+        """
+        failing_server = self.start_server(failure_rate=1.0)
+        working_server = self.start_server()
+
+        with self.settings(RIPPLED_SERVER_URLS=[failing_server.url,
+                                                working_server.url]):
+            for i in range(5):
+                response = rippleInterface.request("ping")
+                self.assertEqual(response['status'], "success")
+
+        # If every server fails, we should get back the last error.
+
+        with self.settings(RIPPLED_SERVER_URLS=[failing_server.url]):
+            response = rippleInterface.request("ping")
+            self.assertEqual(response['status'], "error")
+            self.assertEqual(response['error'], "tooBusy")
+
+    # -----------------------------------------------------------------------
+
+    def test_circuit_breaker(self):
+        """ Check that a server which stops responding is ejected.
+        """
+        dead_server    = self.start_server(drop_rate=1.0)
+        working_server = self.start_server()
+
+        with self.settings(RIPPLED_SERVER_URLS=[dead_server.url,
+                                                working_server.url],
+                           RIPPLED_REQUEST_TIMEOUT=0.2,
+                           RIPPLED_CIRCUIT_BREAKER_THRESHOLD=2,
+                           RIPPLED_CIRCUIT_BREAKER_COOLDOWN=60):
+            for i in range(10):
+                response = rippleInterface.request("ping")
+                self.assertEqual(response['status'], "success")
+
+            # The dead server should have been tried no more than twice
+            # before it was ejected.
+
+            self.assertLessEqual(dead_server.num_requests, 2)
+
+            num_requests = dead_server.num_requests
+            for i in range(10):
+                response = rippleInterface.request("ping")
+                self.assertEqual(response['status'], "success")
+            self.assertEqual(dead_server.num_requests, num_requests)
+
+    # -----------------------------------------------------------------------
+
+    def test_prefers_faster_server(self):
+        """ Check that requests are sent to the fastest server.
+        """
+        slow_server = self.start_server(latency=0.1)
+        fast_server = self.start_server(latency=0.001)
+
+        with self.settings(RIPPLED_SERVER_URLS=[slow_server.url,
+                                                fast_server.url]):
+            for i in range(20):
+                rippleInterface.request("ping")
+
+        # Each server is tried at most once before we know which is fastest.
+
+        self.assertLessEqual(slow_server.num_requests, 1)
+
+    # -----------------------------------------------------------------------
+
+    def test_hedged_request(self):
+        """ Check that a slow request is also sent to a second server.
+        """
+        server_1 = self.start_server(latency=0.001)
+        server_2 = self.start_server(latency=0.01)
+
+        # Send some requests to each server, so that we know how quickly they
+        # normally respond.  The first server is faster, so it will be tried
+        # first.
+
+        for server in [server_1, server_2]:
+            with self.settings(RIPPLED_SERVER_URLS=[server.url]):
+                for i in range(20):
+                    rippleInterface.request("ping")
+
+        # Now make the first server slow, and check that hedging the request
+        # lets the second server respond instead.
+
+        server_1.latency = 2.0
+
+        with self.settings(RIPPLED_SERVER_URLS=[server_1.url, server_2.url],
+                           RIPPLED_HEDGE_REQUESTS=True):
+            start_time = time.time()
+            response   = rippleInterface.request("ping")
+            elapsed    = time.time() - start_time
+
+        self.assertEqual(response['status'], "success")
+        self.assertLess(elapsed, 1.0)
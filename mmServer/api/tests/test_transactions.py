@@ -3,14 +3,16 @@
     This module implements various unit tests for the "Transaction" endpoint.
 """
 import logging
+from StringIO import StringIO
 
 import django.test
 from django.utils import timezone
+from django.core.management import call_command
 
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, transactionHandler
 from mmServer.api.tests     import apiTestHelpers
 
 #############################################################################
@@ -109,14 +111,15 @@ class AccountTestCase(django.test.TestCase):
 
     # -----------------------------------------------------------------------
 
-    def test_get_transaction_finalizes_pending_transaction(self):
-        """ Check that "GET api/transaction" finalizes a pending transaction.
+    def test_reconciler_finalizes_pending_transaction(self):
+        """ Check that "reconcile_pending" finalizes a pending transaction.
 
-            We create a pending transaction, and then make a "GET
-            api/transaction" call, mocking out the Ripple interface to pretend
-            that a transaction was accepted into the Ripple ledger.  We check
-            to ensure that the pending transaction was finalized and appears in
-            the list of final transactions.
+            We create a pending transaction, and then run the
+            "reconcile_pending" management command, mocking out the Ripple
+            interface to pretend that a transaction was accepted into the
+            Ripple ledger.  We then make a "GET api/transaction" call to
+            ensure that the transaction was finalized, and that the endpoint
+            didn't need to contact the Ripple network itself.
         """
         # Create a dummy profile for testing.
 
@@ -169,10 +172,16 @@ class AccountTestCase(django.test.TestCase):
 
         rippleMock = apiTestHelpers.install_mock_ripple_interface()
 
-        # Ask the "GET api/transaction" endpoint to check the status of the
-        # transaction.  All going well, the endpoint should check with the
-        # Ripple server, see that the transaction has gone through, and change
-        # the transaction's status to "SUCCESS".
+        # Run a single pass of the reconciler.  All going well, this should
+        # check with the Ripple server, see that the transaction has gone
+        # through, and change the transaction's status to "SUCCESS".
+
+        call_command("reconcile_pending", once=True)
+
+        self.assertEqual(rippleMock.call_count, 1)
+
+        # Ask the "GET api/transaction" endpoint for the status of the
+        # transaction.
 
         url = "/api/transaction?global_id=%s&transaction_id=%d" \
             % (profile.global_id, transaction.id)
@@ -189,21 +198,163 @@ class AccountTestCase(django.test.TestCase):
         self.assertItemsEqual(data.keys(), ["status"])
         self.assertEqual(data['status'], "SUCCESS")
 
-        # Check that the rippleInterface.request() function was called to check
-        # the transaction status.
+        # Check that the rippleInterface.request() function was only called
+        # by the reconciler, to check the transaction status.
 
         transaction_hash = transaction.ripple_transaction_hash
 
         self.assertEqual(rippleMock.call_count, 1)
-        rippleMock.asset_called_with('tx',
-                                     transaction=transaction_hash,
-                                     binary=False)
+        rippleMock.assert_called_once_with('tx',
+                                           transaction=transaction_hash,
+                                           binary=False)
 
         # Get the updated Transaction record.
 
         transaction = Transaction.objects.get(id=transaction.id)
 
-        # Finally, check that the transaction's status has been updated.
+        # Check that the transaction's status has been updated.
 
         self.assertEqual(transaction.status, Transaction.STATUS_SUCCESS)
 
+        # Finally, check that the user's account balance has been updated.
+
+        user_account = Account.objects.get(id=user_account.id)
+        self.assertEqual(user_account.balance_in_drops, 100)
+
+
+    # -----------------------------------------------------------------------
+
+    def test_account_balance_checkpoints(self):
+        """ Test that account balances are maintained and checkpointed.
+        """
+        # Create two accounts to transfer funds between.
+
+        account_1 = Account()
+        account_1.global_id        = utils.random_string()
+        account_1.type             = Account.TYPE_USER
+        account_1.balance_in_drops = 0
+        account_1.save()
+
+        account_2 = Account()
+        account_2.global_id        = utils.random_string()
+        account_2.type             = Account.TYPE_USER
+        account_2.balance_in_drops = 0
+        account_2.save()
+
+        def transfer(amount, status):
+            t = Transaction()
+            t.timestamp       = timezone.now()
+            t.created_by      = account_1
+            t.status          = status
+            t.type            = Transaction.TYPE_ADJUSTMENT
+            t.amount_in_drops = amount
+            t.debit_account   = account_1
+            t.credit_account  = account_2
+            transactionHandler.save_transaction(t)
+            return t
+
+        # Create some successful and pending transactions, and check that the
+        # balances only include the successful ones.
+
+        transfer(10, Transaction.STATUS_SUCCESS)
+        pending = transfer(20, Transaction.STATUS_PENDING)
+        transfer(30, Transaction.STATUS_SUCCESS)
+
+        account_2 = Account.objects.get(id=account_2.id)
+        self.assertEqual(account_2.balance_in_drops, 40)
+
+        # Take a checkpoint.  This should only cover the transactions before
+        # the pending one.
+
+        checkpoint = transactionHandler.create_checkpoint(account_2)
+        self.assertEqual(checkpoint.transaction_id, pending.id - 1)
+        self.assertEqual(checkpoint.balance_in_drops, 10)
+
+        # Complete the pending transaction, and check that both the stored
+        # and the calculated balances include it.
+
+        pending.status = Transaction.STATUS_SUCCESS
+        transactionHandler.save_transaction(pending)
+
+        account_1 = Account.objects.get(id=account_1.id)
+        account_2 = Account.objects.get(id=account_2.id)
+        self.assertEqual(account_1.balance_in_drops, -60)
+        self.assertEqual(account_2.balance_in_drops, 60)
+        self.assertEqual(transactionHandler.calc_account_balance(account_2), 60)
+
+        # Corrupt an account balance, and check that our management command
+        # finds and repairs it.
+
+        Account.objects.filter(id=account_2.id).update(balance_in_drops=999)
+
+        output = StringIO()
+        call_command("checkpoint_account_balances", fix=True, stdout=output)
+        self.assertIn("Fixed 1 account balances.", output.getvalue())
+
+        account_2 = Account.objects.get(id=account_2.id)
+        self.assertEqual(account_2.balance_in_drops, 60)
+
+        checkpoint = account_2.checkpoints.order_by("-transaction_id").first()
+        self.assertEqual(checkpoint.balance_in_drops, 60)
+
+    # -----------------------------------------------------------------------
+
+    def test_sharded_system_account_balance(self):
+        """ Test that the MessageMe system account's balance is sharded.
+        """
+        user_account = Account()
+        user_account.global_id        = utils.random_string()
+        user_account.type             = Account.TYPE_USER
+        user_account.balance_in_drops = 0
+        user_account.save()
+
+        system_account = Account()
+        system_account.global_id        = None
+        system_account.type             = Account.TYPE_MESSAGEME
+        system_account.balance_in_drops = 0
+        system_account.save()
+
+        # Charge the user a number of times, using a different shard key for
+        # each charge.
+
+        with self.settings(SYSTEM_ACCOUNT_BALANCE_SHARDS=4):
+            for i in range(20):
+                t = Transaction()
+                t.timestamp       = timezone.now()
+                t.created_by      = user_account
+                t.status          = Transaction.STATUS_SUCCESS
+                t.type            = Transaction.TYPE_CHARGE
+                t.amount_in_drops = 5
+                t.debit_account   = user_account
+                t.credit_account  = system_account
+                transactionHandler.save_transaction(t, shard_key=str(i))
+
+            # The charges should have gone into the shards rather than the
+            # system account itself.
+
+            system_account = Account.objects.get(id=system_account.id)
+            self.assertEqual(system_account.balance_in_drops, 0)
+            self.assertGreater(system_account.balance_shards.count(), 1)
+            self.assertEqual(
+                transactionHandler.get_account_balance(system_account), 100)
+
+            user_account = Account.objects.get(id=user_account.id)
+            self.assertEqual(user_account.balance_in_drops, -100)
+
+            # Fold the shards back into the system account, and check that the
+            # balance is still correct.  This should also be true for an
+            # Account object loaded before the shards were folded.
+
+            stale_account = system_account
+
+            output = StringIO()
+            call_command("checkpoint_account_balances", stdout=output)
+            self.assertIn("Found 0 incorrect account balances.",
+                          output.getvalue())
+
+            system_account = Account.objects.get(id=system_account.id)
+            self.assertEqual(system_account.balance_in_drops, 100)
+            self.assertEqual(
+                transactionHandler.get_account_balance(system_account), 100)
+            self.assertEqual(
+                transactionHandler.get_account_balance(stale_account), 100)
@@ -9,13 +9,14 @@ import operator
 
 from django.http                  import *
 from django.views.decorators.csrf import csrf_exempt
-from django.db.models             import Q, Sum, Min, Max
+from django.db                    import connection
+from django.db.models             import Q, Sum
 from django.utils                 import timezone
 
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, profileCache, dbHelpers
 
 #############################################################################
 
@@ -151,15 +152,19 @@ def account_GET(request):
     else:
         params['page'] = 0
 
-    # Get the user's profile, and check the HMAC authentication details.
+    if "after" in request.GET:
+        params['after'] = _parse_cursor(request.GET['after'])
+        if params['after'] == None:
+            return HttpResponseBadRequest("Invalid 'after' parameter value.")
 
-    try:
-        profile = Profile.objects.get(global_id=params['global_id'])
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("There is no profile for that global ID")
+    # Check the HMAC authentication details against the user's profile.
 
-    if not utils.check_hmac_authentication(request, profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("There is no profile for that " +
+                                            "global ID")
+    error_response = profileCache.authenticate(request, params['global_id'],
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
     # Get the user's Account record.  If it doesn't exist, create one.
 
@@ -213,15 +218,14 @@ def _legacy_account_GET(request):
     else:
         return HttpResponseBadRequest("Missing 'global_id' parameter.")
 
-    # Get the user's profile, and check the HMAC authentication details.
-
-    try:
-        profile = Profile.objects.get(global_id=global_id_param)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("There is no profile for that global ID")
+    # Check the HMAC authentication details against the user's profile.
 
-    if not utils.check_hmac_authentication(request, profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("There is no profile for that " +
+                                            "global ID")
+    error_response = profileCache.authenticate(request, global_id_param,
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
     # Get the user's Account record.  If it doesn't exist, create one.
 
@@ -250,22 +254,24 @@ def _legacy_account_GET(request):
     query = (Q(status=Transaction.STATUS_SUCCESS) &
              (Q(debit_account=account) | Q(credit_account=account)))
 
-    for transaction in Transaction.objects.filter(query):
-        if transaction.type == Transaction.TYPE_DEPOSIT:
-            totals['deposits'] += transaction.amount_in_drops
-        elif transaction.type == Transaction.TYPE_WITHDRAWAL:
-            totals['withdrawals'] += transaction.amount_in_drops
-        elif transaction.type == Transaction.TYPE_CHARGE and \
-             transaction.credit_account.type == Account.TYPE_MESSAGEME:
-            totals['system_charges'] += transaction.amount_in_drops
-        elif transaction.type == Transaction.TYPE_CHARGE and \
-             transaction.credit_account.type == Account.TYPE_USER:
-            totals['recipient_charges'] += transaction.amount_in_drops
-        elif transaction.type == Transaction.TYPE_ADJUSTMENT:
-            if transaction.debit_account == account:
-                totals['adjustments'] -= transaction.amount_in_drops
-            elif transaction.credit_account == account:
-                totals['adjustments'] += transaction.amount_in_drops
+    all_totals = _calc_totals(account, Transaction.objects.filter(query))
+
+    for (type,direction,credit_type),total in all_totals.items():
+        if type == Transaction.TYPE_DEPOSIT:
+            totals['deposits'] += total
+        elif type == Transaction.TYPE_WITHDRAWAL:
+            totals['withdrawals'] += total
+        elif type == Transaction.TYPE_CHARGE and \
+             credit_type == Account.TYPE_MESSAGEME:
+            totals['system_charges'] += total
+        elif type == Transaction.TYPE_CHARGE and \
+             credit_type == Account.TYPE_USER:
+            totals['recipient_charges'] += total
+        elif type == Transaction.TYPE_ADJUSTMENT:
+            if direction == _PAID:
+                totals['adjustments'] -= total
+            else:
+                totals['adjustments'] += total
 
     response['account']['totals'] = totals
 
@@ -324,29 +330,32 @@ def _get_transactions(account, params):
 
                 The page number of transactions to return.
 
-        Upon completion, we return a dictionary that looks like the following:
+        'params' may also have the following entry:
 
-            {'transactions' : [...]}
+            'after'
 
-        The 'transactions' entry will be a list of matching transactions as
-        requested by the caller, in descending order of timestamp.
-    """
-    query = _build_success_query()
-    query = query & _build_type_query(account, params)
+                If present, this will be a (timestamp, transaction_id) tuple,
+                as returned by _parse_cursor().  The page will start with the
+                transaction immediately after the given one, and 'page' is
+                ignored.
 
-    if "conversation" in params:
-        query = query & _build_conversation_query(params['conversation'])
+        Upon completion, we return a dictionary that looks like the following:
 
-    if "date" in params:
-        query = query & _build_date_query(params['date'], params['tz_offset'])
+            {'transactions' : [...],
+             'next'         : "..."}
 
-    results = Transaction.objects.filter(query).order_by("-timestamp")
+        The 'transactions' entry will be a list of matching transactions as
+        requested by the caller, in descending order of timestamp.  If the
+        page is full, 'next' will be the cursor to pass as the 'after'
+        parameter to retrieve the following page.
 
-    first = params['page'] * params['tpp']
-    last  = (params['page']+1) * params['tpp']
+        The page of transactions, along with the related accounts and
+        messages, is loaded using a single query.
+    """
+    results = _build_transactions_query(account, params)
 
     transactions = []
-    for transaction in results[first:last]:
+    for transaction in results:
         trans = {}
         trans['transaction_id'] = transaction.id
         trans['timestamp']      = utils.datetime_to_unix_timestamp(
@@ -358,19 +367,19 @@ def _get_transactions(account, params):
         elif transaction.type == Transaction.TYPE_WITHDRAWAL:
             trans['type'] = "WITHDRAWAL"
         elif transaction.type == Transaction.TYPE_CHARGE:
-            if transaction.debit_account == account:
+            if transaction.debit_account_id == account.id:
                 trans['type'] = "CHARGE_PAID"
             else:
                 trans['type'] = "CHARGE_RECEIVED"
         elif transaction.type == Transaction.TYPE_ADJUSTMENT:
-            if account == transaction.debit_account:
+            if transaction.debit_account_id == account.id:
                 trans['type'] = "ADJUSTMENT_PAID"
             else:
                 trans['type'] = "ADJUSTMENT_RECEIVED"
 
-        if transaction.debit_account == account:
+        if transaction.debit_account_id == account.id:
             other_account = transaction.credit_account
-        elif transaction.credit_account == account:
+        elif transaction.credit_account_id == account.id:
             other_account = transaction.debit_account
         else:
             raise RuntimeError("Should never happen")
@@ -384,7 +393,100 @@ def _get_transactions(account, params):
 
         transactions.append(trans)
 
-    return {'transactions' : transactions}
+    response = {'transactions' : transactions}
+    if len(transactions) == params['tpp'] and len(transactions) > 0:
+        response['next'] = _format_cursor(transaction)
+
+    return response
+
+#############################################################################
+
+def _build_transactions_query(account, params):
+    """ Build the query to return a page of transactions for an account.
+
+        The parameters are the same as for _get_transactions().  We return a
+        QuerySet which returns the requested page of Transaction records, with
+        the related accounts and messages, in descending order of timestamp.
+    """
+    if "after" in params:
+        first = 0
+        last  = params['tpp']
+    else:
+        first = params['page'] * params['tpp']
+        last  = (params['page']+1) * params['tpp']
+
+    query = _build_success_query()
+
+    if "conversation" in params:
+        query = query & _build_conversation_query(params['conversation'])
+
+    if "date" in params:
+        query = query & _build_date_query(params['date'], params['tz_offset'])
+
+    if "after" in params:
+        timestamp,transaction_id = params['after']
+        query = query & (Q(timestamp__lt=timestamp) |
+                         Q(timestamp=timestamp, id__lt=transaction_id))
+
+    if params.get("type") == None:
+        # The account can be on either side of the transaction.  Rather than
+        # using an OR, we find the transactions on each side separately, so
+        # that each side can walk its own index in timestamp order.
+        branches = []
+        for side in [Q(debit_account=account), Q(credit_account=account)]:
+            branches.append(Transaction.objects.filter(query & side)
+                                               .order_by("-timestamp", "-id")
+                                               [:last])
+        results = dbHelpers.filter_by_union(Transaction.objects.all(),
+                                            branches)
+    else:
+        query   = query & _build_type_query(account, params)
+        results = Transaction.objects.filter(query)
+
+    return results.select_related("debit_account", "credit_account",
+                                  "message") \
+                  .order_by("-timestamp", "-id")[first:last]
+
+#############################################################################
+
+def _format_cursor(transaction):
+    """ Return the pagination cursor for the given transaction.
+
+        The cursor is a string of the form "<timestamp>,<id>", where
+        <timestamp> is the transaction's unix timestamp including microseconds
+        and <id> is the transaction's record ID.  Together, these uniquely
+        identify the transaction's position in the list of transactions.
+    """
+    return "%d.%06d,%d" % (utils.datetime_to_unix_timestamp(
+                                                transaction.timestamp),
+                           transaction.timestamp.microsecond,
+                           transaction.id)
+
+#############################################################################
+
+def _parse_cursor(cursor):
+    """ Parse a pagination cursor returned by _format_cursor().
+
+        We return a (timestamp, transaction_id) tuple, where 'timestamp' is a
+        datetime.datetime object in UTC.  If the cursor is invalid, we return
+        None.
+    """
+    try:
+        timestamp,transaction_id = cursor.split(",")
+        seconds,dot,microseconds = timestamp.partition(".")
+        if not seconds.isdigit():
+            return None
+        if dot != "" and (not microseconds.isdigit() or
+                          len(microseconds) > 6):
+            return None
+
+        unix_epoch = datetime.datetime(1970, 1, 1, tzinfo=timezone.utc)
+        timestamp  = unix_epoch + datetime.timedelta(
+                            seconds=int(seconds),
+                            microseconds=int(microseconds.ljust(6, "0")))
+        return (timestamp, int(transaction_id))
+    except (ValueError, OverflowError):
+        return None
 
 #############################################################################
 
@@ -452,67 +554,21 @@ def _get_totals_by_type(account, params):
 
     transactions = Transaction.objects.filter(query)
 
-    types = []
-
-    # Calculate the charges paid.
-
-    matches = transactions.filter(type=Transaction.TYPE_CHARGE,
-                                  debit_account=account)
-    total = matches.aggregate(total=Sum('amount_in_drops'))['total']
-
-    if total != None:
-        types.append({'type'  : 'charges_paid',
-                      'total' : total})
-
-    # Calculate the charges received.
-
-    matches = transactions.filter(type=Transaction.TYPE_CHARGE,
-                                  credit_account=account)
-    total = matches.aggregate(total=Sum('amount_in_drops'))['total']
-
-    if total != None:
-        types.append({'type'  : 'charges_received',
-                      'total' : total})
+    # Calculate the totals for each type of transaction.  Note that each type
+    # is only included if there is at least one transaction of that type.
 
-    # Calculate the deposits.
+    all_totals = _calc_totals(account, transactions)
 
-    matches = transactions.filter(type=Transaction.TYPE_DEPOSIT,
-                                  credit_account=account)
-    total = matches.aggregate(total=Sum('amount_in_drops'))['total']
-
-    if total != None:
-        types.append({'type'  : 'deposits',
-                      'total' : total})
-
-    # Calculate the withdrawals.
-
-    matches = transactions.filter(type=Transaction.TYPE_WITHDRAWAL,
-                                  debit_account=account)
-    total = matches.aggregate(total=Sum('amount_in_drops'))['total']
-
-    if total != None:
-        types.append({'type'  : 'withdrawals',
-                      'total' : total})
-
-    # Calculate the adjustments paid.
-
-    matches = transactions.filter(type=Transaction.TYPE_ADJUSTMENT,
-                                  debit_account=account)
-    total = matches.aggregate(total=Sum('amount_in_drops'))['total']
-
-    if total != None:
-        types.append({'type'  : 'adjustments_paid',
-                      'total' : total})
-
-    # Calculate the adjustments received.
-
-    matches = transactions.filter(type=Transaction.TYPE_ADJUSTMENT,
-                                  credit_account=account)
-    total = matches.aggregate(total=Sum('amount_in_drops'))['total']
+    types = []
+    for type_name,type,direction in _TOTAL_TYPES:
+        total = None
+        for (t,d,credit_type),amount in all_totals.items():
+            if t == type and d == direction:
+                total = (total or 0) + amount
 
-    if total != None:
-        types.append({'type'  : 'adjustments_received',
-                      'total' : total})
+        if total != None:
+            types.append({'type'  : type_name,
+                          'total' : total})
 
     return {'types' : types}
 
@@ -580,35 +636,44 @@ def _get_totals_by_conversation(account, params):
 
     transactions = Transaction.objects.filter(query)
 
-    results = transactions.values('message__conversation').annotate(
-                                                total=Sum('amount_in_drops'))
+    # Total up the transactions for each conversation.  The conversation's
+    # global IDs are retrieved as part of the same query.
 
-    conversations = []
-    for entry in results:
-        total           = entry['total']
-        conversation_id = entry['message__conversation']
+    results = transactions.filter(message__conversation__isnull=False) \
+                          .values("message__conversation",
+                                  "message__conversation__global_id_1",
+                                  "message__conversation__global_id_2") \
+                          .annotate(total=Sum("amount_in_drops")) \
+                          .order_by()
 
-        if conversation_id != None:
-            try:
-                conversation = Conversation.objects.get(id=conversation_id)
-            except Conversation.DoesNotExist:
-                continue # Should never happen.
+    totals = [] # List of (other_global_id, total) tuples.
+    for entry in results:
+        global_id_1 = entry['message__conversation__global_id_1']
+        global_id_2 = entry['message__conversation__global_id_2']
 
-        if conversation.global_id_1 == account.global_id:
-            other_global_id = conversation.global_id_2
-        elif conversation.global_id_2 == account.global_id:
-            other_global_id = conversation.global_id_1
+        if global_id_1 == account.global_id:
+            other_global_id = global_id_2
+        elif global_id_2 == account.global_id:
+            other_global_id = global_id_1
         else:
             continue # Should never happen.
 
-        try:
-            other_profile = Profile.objects.get(global_id=other_global_id)
-        except Profile.DoesNotExist:
-            other_profile = None
+        totals.append((other_global_id, entry['total']))
+
+    # Load the names of the other parties in these conversations, using a
+    # single query.
 
-        other_name = None # initially.
-        if other_profile != None and other_profile.name_visible:
-            other_name = other_profile.name
+    names = {} # Maps global ID to the user's visible name.
+    if len(totals) > 0:
+        for global_id,name in \
+                Profile.objects.filter(global_id__in=[t[0] for t in totals],
+                                       name_visible=True) \
+                               .values_list("global_id", "name"):
+            names[global_id] = name
+
+    conversations = []
+    for other_global_id,total in totals:
+        other_name = names.get(other_global_id)
 
         if other_name != None:
             sort_key = other_name
@@ -678,103 +743,178 @@ def _get_totals_by_date(account, params):
         The entries will be in reverse date order -- that is, the most recent
         date will be first in the list.
     """
-    # Build the queryset of matching transactions.
+    if params['tz_offset'] != None:
+        tz_offset = params['tz_offset']
+    else:
+        tz_offset = 0
 
-    query = _build_success_query()
-    query = query & _build_type_query(account, params)
+    # If we can, calculate the totals from the account's transaction rollups.
+    # Otherwise, we have to look at the individual transactions.
 
-    if "conversation" in params:
-        query = query & _build_conversation_query(params['conversation'])
+    if ("conversation" not in params and
+            tz_offset % TransactionRollup.PERIOD_MINUTES == 0):
+        totals = _calc_date_totals_from_rollups(account, params, tz_offset)
+    else:
+        totals = _calc_date_totals_from_transactions(account, params,
+                                                     tz_offset)
 
-    if "date" in params:
-        query = query & _build_date_query(params['date'], params['tz_offset'])
+    dates = []
+    for sDate in sorted(totals.keys(), reverse=True):
+        dates.append({'date'  : sDate,
+                      'total' : totals[sDate]})
 
-    transactions = Transaction.objects.filter(query)
+    return {'dates' : dates}
 
-    # If there are no matching transactions, return an empty dictionary.  This
-    # avoids problems with calculating the minimum and maximum date based on an
-    # empty list of transactions.
+#############################################################################
 
-    if transactions.count() == 0:
-        return {'dates' : []}
+def _calc_date_totals_from_rollups(account, params, tz_offset):
+    """ Calculate the daily totals for an account using its rollups.
 
-    # Find the minimum and maximum timestamps for these transactions, in UTC.
+        'account' and 'params' are the parameters passed to
+        _get_totals_by_date(), and 'tz_offset' is the user's timezone offset in
+        minutes, which must be a multiple of TransactionRollup.PERIOD_MINUTES.
+        The matching rollups are grouped by date in the user's local timezone
+        and summed within the database, using a single query.
 
-    min_timestamp_in_utc = transactions.aggregate(min=Min('timestamp'))['min']
-    max_timestamp_in_utc = transactions.aggregate(max=Max('timestamp'))['max']
+        We return a dictionary mapping each date, as a "YYYY-MM-DD" string, to
+        the total value of the matching transactions on that date.  Dates with
+        no matching transactions are omitted.
+    """
+    rollups = TransactionRollup.objects.filter(account=account)
 
-    # Calculate the difference between UTC and the user's local time.  If the
-    # caller didn't specify a timezone offset, we set the difference to zero so
-    # that all our calculations are done in UTC.
+    if params.get("type") != None:
+        for type_name,type,direction in _TOTAL_TYPES:
+            if params['type'] == type_name:
+                rollups = rollups.filter(type=type, direction=direction)
+                break
+        else:
+            raise RuntimeError("Should never happen")
 
-    if params['tz_offset'] != None:
-        timezone_offset = datetime.timedelta(minutes=params['tz_offset'])
+    if "date" in params:
+        rollups = rollups.filter(
+                        _build_date_query(params['date'], tz_offset,
+                                          field="period_start"))
+
+    if dbHelpers.is_postgres():
+        local_date = "DATE((period_start AT TIME ZONE 'UTC') - " \
+                   + "%s * INTERVAL '1 minute')"
+        local_date_params = [tz_offset]
     else:
-        timezone_offset = datetime.timedelta(minutes=0)
+        local_date = "DATE(period_start, %s)"
+        local_date_params = ["%+d minutes" % -tz_offset]
+
+    results = rollups.extra(select={'local_date' : local_date},
+                            select_params=local_date_params) \
+                     .values("local_date") \
+                     .annotate(total=Sum("total_in_drops"),
+                               num=Sum("num_transactions")) \
+                     .order_by()
+
+    totals = {}
+    for row in results:
+        if row['num'] == 0:
+            continue # Every transaction on this date has been reversed.
+
+        if isinstance(row['local_date'], datetime.date):
+            sDate = row['local_date'].strftime("%Y-%m-%d")
+        else:
+            sDate = row['local_date']
 
-    # Convert the minimum and maximum timestamps into the user's local time
-    # zone.
+        totals[sDate] = row['total']
 
-    min_timestamp_in_user_time = min_timestamp_in_utc - timezone_offset
-    max_timestamp_in_user_time = max_timestamp_in_utc - timezone_offset
+    return totals
 
-    # Calculate the start of the first day, in UTC.
+#############################################################################
 
-    start_of_first_day_in_user_time = \
-        datetime.datetime(min_timestamp_in_user_time.year,
-                          min_timestamp_in_user_time.month,
-                          min_timestamp_in_user_time.day,
-                          0, 0, 0)
+def _calc_date_totals_from_transactions(account, params, tz_offset):
+    """ Calculate the daily totals for an account from its transactions.
 
-    start_of_first_day_in_utc = start_of_first_day_in_user_time \
-                              + timezone_offset
+        This is used when the totals can't be calculated from the account's
+        transaction rollups, because the results are limited to a single
+        conversation or because the user's timezone offset doesn't line up
+        with the rollup periods.  The parameters and return value are the same
+        as for _calc_date_totals_from_rollups().
 
-    # Calculate the start of the last day, in UTC.
+        The matching transactions are loaded using a single query, and are
+        then grouped by date.
+    """
+    query = _build_success_query()
+    query = query & _build_type_query(account, params)
 
-    start_of_last_day_in_user_time = \
-        datetime.datetime(max_timestamp_in_user_time.year,
-                          max_timestamp_in_user_time.month,
-                          max_timestamp_in_user_time.day,
-                          0, 0, 0)
+    if "conversation" in params:
+        query = query & _build_conversation_query(params['conversation'])
 
-    start_of_last_day_in_utc = start_of_last_day_in_user_time \
-                              + timezone_offset
+    if "date" in params:
+        query = query & _build_date_query(params['date'], tz_offset)
 
-    # Now calculate the total for each day in turn.
+    timezone_offset = datetime.timedelta(minutes=tz_offset)
 
-    dates = []
-    start_of_current_day_in_utc = start_of_first_day_in_utc
-    while start_of_current_day_in_utc <= start_of_last_day_in_utc:
+    totals = {}
+    for timestamp,amount in Transaction.objects.filter(query) \
+                                    .values_list("timestamp",
+                                                 "amount_in_drops") \
+                                    .iterator():
+        sDate = (timestamp - timezone_offset).strftime("%Y-%m-%d")
+        totals[sDate] = totals.get(sDate, 0) + amount
 
-        start_of_current_day_in_user_time = start_of_current_day_in_utc \
-                                          - timezone_offset
+    return totals
 
-        sDate = start_of_current_day_in_user_time.strftime("%Y-%m-%d")
+#############################################################################
 
-        start_of_day = datetime.datetime(start_of_current_day_in_utc.year,
-                                         start_of_current_day_in_utc.month,
-                                         start_of_current_day_in_utc.day,
-                                         start_of_current_day_in_utc.hour,
-                                         start_of_current_day_in_utc.minute,
-                                         start_of_current_day_in_utc.second,
-                                         start_of_current_day_in_utc.microsecond,
-                                         timezone.utc)
-        start_of_next_day = start_of_day + datetime.timedelta(days=1)
+# The direction of a transaction, relative to the account we're calculating
+# totals for.  _PAID means that the account was debited, and _RECEIVED means
+# that the account was credited.
 
-        matches = transactions.filter(timestamp__gte=start_of_day,
-                                      timestamp__lt=start_of_next_day)
-        total = matches.aggregate(tot=Sum('amount_in_drops'))['tot']
+_PAID     = TransactionRollup.DIRECTION_PAID
+_RECEIVED = TransactionRollup.DIRECTION_RECEIVED
 
-        if total != None:
-            dates.append({'date'  : sDate,
-                          'total' : total})
+# The types of transaction totals returned by _get_totals_by_type(), in the
+# order they are returned.  Each list item is a (type_name, type, direction)
+# tuple.
 
-        start_of_current_day_in_utc = start_of_current_day_in_utc \
-                                    + datetime.timedelta(days=1)
+_TOTAL_TYPES = [
+    ("charges_paid",         Transaction.TYPE_CHARGE,     _PAID),
+    ("charges_received",     Transaction.TYPE_CHARGE,     _RECEIVED),
+    ("deposits",             Transaction.TYPE_DEPOSIT,    _RECEIVED),
+    ("withdrawals",          Transaction.TYPE_WITHDRAWAL, _PAID),
+    ("adjustments_paid",     Transaction.TYPE_ADJUSTMENT, _PAID),
+    ("adjustments_received", Transaction.TYPE_ADJUSTMENT, _RECEIVED),
+]
 
-    dates.reverse()
+#############################################################################
 
-    return {'dates' : dates}
+def _calc_totals(account, transactions):
+    """ Calculate the totals for the given transactions, using a single query.
+
+        'account' is the Account record we're calculating totals for, and
+        'transactions' is a QuerySet of Transaction records involving that
+        account.  The transactions are grouped by type, by direction, and by
+        the type of the account which was credited, and each group is summed
+        within the database.
+
+        We return a dictionary mapping (type, direction, credit_type) tuples
+        to the total value of that group of transactions, in drops.  'type' is
+        the transaction type, 'direction' is _PAID or _RECEIVED, and
+        'credit_type' is the type of account which was credited.  Note that a
+        group will only be present if there is at least one transaction in it.
+    """
+    debit_column = "%s.%s" % (connection.ops.quote_name(
+                                    Transaction._meta.db_table),
+                              connection.ops.quote_name("debit_account_id"))
+
+    results = transactions.extra(
+                    select={'direction' : "CASE WHEN %s = %%s " % debit_column
+                                        + "THEN %s ELSE %s END"},
+                    select_params=[account.id, _PAID, _RECEIVED]) \
+                          .values("type", "direction", "credit_account__type") \
+                          .annotate(total=Sum("amount_in_drops")) \
+                          .order_by()
+
+    totals = {}
+    for row in results:
+        key = (row['type'], row['direction'], row['credit_account__type'])
+        totals[key] = row['total']
+    return totals
 
 #############################################################################
 
@@ -830,7 +970,7 @@ def _build_conversation_query(conversation):
 
 #############################################################################
 
-def _build_date_query(date, tz_offset):
+def _build_date_query(date, tz_offset, field="timestamp"):
     """ Build a query to return transactions with a given date.
 
         The parameters are as follows:
@@ -846,6 +986,10 @@ def _build_date_query(date, tz_offset):
                 minutes.  If no timezone offset was specified, this will be set
                 to None.
 
+            'field'
+
+                The name of the timestamp field to check.
+
         We return a Django "Q" object which only returns those transctions
         generated on the given day, allowing for the specified timezone offset
         (if any).
@@ -856,5 +1000,6 @@ def _build_date_query(date, tz_offset):
         start_of_day = start_of_day + datetime.timedelta(minutes=tz_offset)
     start_of_next_day = start_of_day + datetime.timedelta(days=1)
 
-    return Q(timestamp__gte=start_of_day, timestamp__lt=start_of_next_day)
+    return Q(**{field + "__gte" : start_of_day,
+                field + "__lt"  : start_of_next_day})
 
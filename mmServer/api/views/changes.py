@@ -6,10 +6,12 @@
 import base64
 import logging
 import os.path
+import time
 import uuid
 
 from django.http                  import *
 from django.views.decorators.csrf import csrf_exempt
+from django.conf                  import settings
 from django.utils                 import timezone
 from django.db.models             import Max, Q
 
@@ -17,12 +19,17 @@ import simplejson as json
 
 from mmServer.shared.models import *
 from mmServer.shared.lib    import rippleInterface, encryption
-from mmServer.shared.lib    import utils, dbHelpers, messageHandler
+from mmServer.shared.lib    import utils, dbHelpers
+from mmServer.shared.lib    import changeNotifier, profileCache
 
 #############################################################################
 
 logger = logging.getLogger(__name__)
 
+# How often to send a keep-alive comment while streaming changes, in seconds.
+
+STREAM_KEEPALIVE_INTERVAL = 15
+
 #############################################################################
 
 @csrf_exempt
@@ -45,7 +52,9 @@ def endpoint(request):
 def changes_GET(request):
     """ Respond to the "GET /api/changes" API request.
 
-        This is used to poll for changes to our data.
+        This is used to poll for changes to our data.  The caller can
+        optionally wait for changes to be made, either by long-polling or by
+        asking for a stream of Server-Sent Events.
     """
     if not utils.has_hmac_headers(request):
         return HttpResponseForbidden()
@@ -65,21 +74,16 @@ def changes_GET(request):
     else:
         anchor = None
 
-    try:
-        my_profile = Profile.objects.get(global_id=my_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("User doesn't have a profile")
-
-    if not utils.check_hmac_authentication(request,
-                                           my_profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("User doesn't have a profile")
+    error_response = profileCache.authenticate(request, my_global_id,
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
     # If we've been asked to return only the latest anchor value, do so.
 
     if anchor == None:
-        with dbHelpers.exclusive_access(Profile, Picture, Conversation,
-                                        Message):
-            next_anchor = _calc_anchor()
+        next_anchor = _encode_anchor(_calc_anchor())
 
         return HttpResponse(json.dumps({'next_anchor' : next_anchor}),
                             mimetype="application/json")
@@ -90,149 +94,58 @@ def changes_GET(request):
     if anchor == None:
         return HttpResponseBadRequest("Invalid anchor")
 
-    # Check any pending messages.  If a pending message changes status, the
-    # message will be included in the list of changes.
+    # Parse the optional 'wait' parameter.  If this is supplied, we wait for up
+    # to this many seconds for a relevant change to be made.
 
-    messageHandler.check_pending_messages()
+    if "wait" in request.GET:
+        try:
+            wait = int(request.GET['wait'])
+        except ValueError:
+            return HttpResponseBadRequest("Invalid 'wait' parameter.")
+        wait = max(0, min(wait, settings.CHANGES_MAX_WAIT))
+    else:
+        wait = 0
 
-    # Get ready to start collecting updates.
+    # If the client has asked for a stream of Server-Sent Events, return a
+    # streaming response which sends the changes as they happen.
 
-    changes = []
+    if "text/event-stream" in request.META.get("HTTP_ACCEPT", ""):
+        if wait == 0:
+            wait = settings.CHANGES_MAX_WAIT
 
-    with dbHelpers.exclusive_access(Profile, Picture, Conversation, Message):
-
-        # Get a list of all the global IDs that this user has conversed with.
-
-        other_global_ids = []
-        for c in Conversation.objects.filter(global_id_1=my_global_id):
-            other_global_ids.append(c.global_id_2)
-        for c in Conversation.objects.filter(global_id_2=my_global_id):
-            other_global_ids.append(c.global_id_1)
-
-        # Add any new or updated profiles for these users to the list of
-        # changes.
-
-        query = Profile.objects.filter(global_id__in=other_global_ids)
-        if "Profile" in anchor:
-            query = query.filter(update_id__gt=anchor['Profile'])
-
-        for profile in query.order_by("update_id"):
-            profile_data = {}
-            profile_data['global_id'] = profile.global_id
-            if profile.deleted:
-                profile_data['deleted'] = True
-            else:
-                if profile.name_visible:
-                    profile_data['name'] = profile.name
-                if profile.address_1_visible:
-                    profile_data['address_1'] = profile.address_1
-                if profile.address_2_visible:
-                    profile_data['address_2'] = profile.address_2
-                if profile.city_visible:
-                    profile_data['city'] = profile.city
-                if profile.state_province_or_region_visible:
-                    profile_data['state_province_or_region'] = \
-                        profile.state_province_or_region
-                if profile.zip_or_postal_code_visible:
-                    profile_data['zip_or_postal_code'] = \
-                        profile.zip_or_postal_code
-                if profile.country_visible:
-                    profile_data['country'] = profile.country
-                if profile.bio_visible:
-                    profile_data['bio'] = profile.bio
-                if profile.picture_id_visible:
-                    profile_data['picture_id'] = profile.picture_id
-
-            changes.append({'type' : "profile",
-                            'data' : profile_data})
-
-        # Add any new or updated pictures.
-
-        query = Picture.objects.all()
-        if "Picture" in anchor:
-            query = query.filter(update_id__gt=anchor['Picture'])
-
-        for picture in query.order_by("update_id"):
-            picture_data = {}
-            picture_data['picture_id'] = picture.picture_id
-            if picture.deleted:
-                picture_data['deleted'] = True
-            picture_data['filename'] = picture.picture_filename
-
-            changes.append({'type' : "picture",
-                            'data' : picture_data})
+        response = StreamingHttpResponse(
+                            _stream_changes(my_global_id, anchor, wait),
+                            content_type="text/event-stream")
+        response['Cache-Control'] = "no-cache"
+        return response
 
-        # Add any new or updated conversations involving this user.
+    # Collect the changes since the supplied anchor.  If there aren't any and
+    # the caller wants to wait, keep waiting until a relevant change is made or
+    # we time out.
 
-        query = Conversation.objects.filter(Q(global_id_1=my_global_id) |
-                                            Q(global_id_2=my_global_id))
-        if "Conversation" in anchor:
-            query = query.filter(update_id__gt=anchor['Conversation'])
-
-        for conversation in query.order_by("update_id"):
-            if conversation.last_timestamp != None:
-                timestamp = utils.datetime_to_unix_timestamp(
-                                                conversation.last_timestamp)
-            else:
-                timestamp = None
-
-            data = {}
-            data['my_global_id'] = my_global_id
-            if conversation.global_id_1 == my_global_id:
-                data['my_global_id']    = conversation.global_id_1
-                data['their_global_id'] = conversation.global_id_2
-                data['hidden']          = conversation.hidden_1
-                data['num_unread']      = conversation.num_unread_1
-                data['last_message']    = conversation.last_message_1
-            else:
-                data['my_global_id']    = conversation.global_id_2
-                data['their_global_id'] = conversation.global_id_1
-                data['hidden']          = conversation.hidden_2
-                data['num_unread']      = conversation.num_unread_2
-                data['last_message']    = conversation.last_message_2
-            data['last_timestamp'] = timestamp
-
-            changes.append({'type' : "conversation",
-                            'data' : data})
+    if wait == 0:
+        changes,new_anchor = _collect_changes(my_global_id, anchor)
+    else:
+        deadline = time.time() + wait
+        with changeNotifier.Listener() as listener:
+            while True:
+                changes,new_anchor = _collect_changes(my_global_id, anchor)
+                if len(changes) > 0:
+                    break
 
-        # Add any new or updated messages involving this user.
+                # Nothing has changed for this user up to the new anchor, so
+                # we can safely start from there next time.
+
+                anchor = new_anchor
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+
+                if not listener.wait([my_global_id], remaining):
+                    break
 
-        query = Message.objects.filter(Q(sender_global_id=my_global_id) |
-                                       Q(recipient_global_id=my_global_id))
-        if "Message" in anchor:
-            query = query.filter(update_id__gt=anchor['Message'])
-
-        for message in query.order_by("update_id"):
-            timestamp = utils.datetime_to_unix_timestamp(message.timestamp)
-            status    = Message.STATUS_MAP[message.status]
-
-            msg_data = {}
-            msg_data['hash']                  = message.hash
-            msg_data['timestamp']             = timestamp
-            msg_data['sender_global_id']      = message.sender_global_id
-            msg_data['recipient_global_id']   = message.recipient_global_id
-            msg_data['sender_account_id']     = message.sender_account_id
-            msg_data['recipient_account_id']  = message.recipient_account_id
-            msg_data['sender_text']           = message.sender_text
-            msg_data['recipient_text']        = message.recipient_text
-            msg_data['action']                = message.action
-            msg_data['action_params']         = message.action_params
-            msg_data['action_processed']      = message.action_processed
-            msg_data['message_charge']        = message.message_charge
-            msg_data['system_charge']         = message.system_charge
-            msg_data['system_charge_paid_by'] = message.system_charge_paid_by
-            msg_data['status']              = Message.STATUS_MAP[message.status]
-
-            if message.error != None:
-                msg_data['error'] = message.error
-
-            changes.append({'type' : "message",
-                            'data' : msg_data})
-
-        # Finally, calculate the updated anchor value for this state of the
-        # system.
-
-        next_anchor = _calc_anchor()
+    next_anchor = _encode_anchor(new_anchor)
 
     # Return the accumulated results back to the caller.
 
@@ -246,30 +159,251 @@ def changes_GET(request):
 ##                                                                         ##
 #############################################################################
 
+def _collect_changes(my_global_id, anchor):
+    """ Collect the changes relevant to the given user since the given anchor.
+
+        'my_global_id' is the global ID of the current user, and 'anchor' is
+        the parsed anchor dictionary for the changes the caller has already
+        seen.
+
+        We return a (changes, new_anchor) tuple, where 'changes' is a list of
+        the changes to send back to the caller, and 'new_anchor' is the anchor
+        dictionary for the changes which have now been seen.
+    """
+    # Calculate the updated anchor value for this state of the system.  Note
+    # that we have to do this before taking our snapshot of the database, so
+    # that the snapshot includes every change up to the new anchor; see
+    # dbHelpers.update_id_high_water() for details.  Any change log entries
+    # beyond this anchor will be returned by the next call.
+
+    new_anchor = _calc_anchor()
+
+    # Get ready to start collecting updates.
+
+    changes = []
+
+    with dbHelpers.snapshot():
+
+        # Find the change log entries for this user since the given anchor.
+        # Note that an object may have been changed more than once; we only
+        # need to return its current state once, ordered by its most recent
+        # change.
+
+        query = ChangeLogEntry.objects.filter(
+                    global_id=my_global_id,
+                    seq__gt=anchor.get("ChangeLog", 0),
+                    seq__lte=new_anchor.get("ChangeLog", 0))
+
+        changed_ids = {} # Maps object type to list of changed object IDs.
+        seen        = set() # Set of (type, object_id) tuples.
+
+        for object_type,object_id in query.order_by("-seq") \
+                                          .values_list("type", "object_id"):
+            if (object_type, object_id) not in seen:
+                seen.add((object_type, object_id))
+                changed_ids.setdefault(object_type, []).append(object_id)
+
+        for ids in changed_ids.values():
+            ids.reverse() # Oldest change first.
+
+        # Add any new or updated profiles to the list of changes.
+
+        ids      = changed_ids.get(ChangeLogEntry.TYPE_PROFILE, [])
+        profiles = Profile.objects.in_bulk(ids)
+        for id in ids:
+            if id in profiles:
+                changes.append({'type' : "profile",
+                                'data' : _profile_data(profiles[id])})
+
+        # Add any new or updated pictures used by this user or by the people
+        # they have a conversation with.
+
+        ids      = changed_ids.get(ChangeLogEntry.TYPE_PICTURE, [])
+        pictures = Picture.objects.defer("picture_data").in_bulk(ids)
+        for id in ids:
+            if id in pictures:
+                changes.append({'type' : "picture",
+                                'data' : _picture_data(pictures[id])})
+
+        # Add any new or updated conversations involving this user.
+
+        ids           = changed_ids.get(ChangeLogEntry.TYPE_CONVERSATION, [])
+        conversations = Conversation.objects.in_bulk(ids)
+        for id in ids:
+            if id in conversations:
+                data = _conversation_data(conversations[id], my_global_id)
+                changes.append({'type' : "conversation",
+                                'data' : data})
+
+        # Add any new or updated messages involving this user.
+
+        ids      = changed_ids.get(ChangeLogEntry.TYPE_MESSAGE, [])
+        messages = Message.objects.in_bulk(ids)
+        for id in ids:
+            if id in messages:
+                changes.append({'type' : "message",
+                                'data' : _message_data(messages[id])})
+
+    return (changes, new_anchor)
+
+#############################################################################
+
+def _profile_data(profile):
+    """ Return the publically-visible parts of the given profile.
+    """
+    profile_data = {}
+    profile_data['global_id'] = profile.global_id
+    if profile.deleted:
+        profile_data['deleted'] = True
+    else:
+        if profile.name_visible:
+            profile_data['name'] = profile.name
+        if profile.address_1_visible:
+            profile_data['address_1'] = profile.address_1
+        if profile.address_2_visible:
+            profile_data['address_2'] = profile.address_2
+        if profile.city_visible:
+            profile_data['city'] = profile.city
+        if profile.state_province_or_region_visible:
+            profile_data['state_province_or_region'] = \
+                profile.state_province_or_region
+        if profile.zip_or_postal_code_visible:
+            profile_data['zip_or_postal_code'] = profile.zip_or_postal_code
+        if profile.country_visible:
+            profile_data['country'] = profile.country
+        if profile.bio_visible:
+            profile_data['bio'] = profile.bio
+        if profile.picture_id_visible:
+            profile_data['picture_id'] = profile.picture_id
+    return profile_data
+
+#############################################################################
+
+def _picture_data(picture):
+    """ Return the details of the given picture to include in our changes.
+    """
+    picture_data = {}
+    picture_data['picture_id'] = picture.picture_id
+    if picture.deleted:
+        picture_data['deleted'] = True
+    picture_data['filename'] = picture.picture_filename
+    return picture_data
+
+#############################################################################
+
+def _conversation_data(conversation, my_global_id):
+    """ Return the given conversation, as seen by the given user.
+    """
+    if conversation.last_timestamp != None:
+        timestamp = utils.datetime_to_unix_timestamp(
+                                        conversation.last_timestamp)
+    else:
+        timestamp = None
+
+    data = {}
+    if conversation.global_id_1 == my_global_id:
+        data['my_global_id']    = conversation.global_id_1
+        data['their_global_id'] = conversation.global_id_2
+        data['hidden']          = conversation.hidden_1
+        data['num_unread']      = conversation.num_unread_1
+        data['last_message']    = conversation.last_message_1
+    else:
+        data['my_global_id']    = conversation.global_id_2
+        data['their_global_id'] = conversation.global_id_1
+        data['hidden']          = conversation.hidden_2
+        data['num_unread']      = conversation.num_unread_2
+        data['last_message']    = conversation.last_message_2
+    data['last_timestamp'] = timestamp
+    return data
+
+#############################################################################
+
+def _message_data(message):
+    """ Return the details of the given message to include in our changes.
+    """
+    msg_data = {}
+    msg_data['hash']                  = message.hash
+    msg_data['timestamp']             = utils.datetime_to_unix_timestamp(
+                                                        message.timestamp)
+    msg_data['sender_global_id']      = message.sender_global_id
+    msg_data['recipient_global_id']   = message.recipient_global_id
+    msg_data['sender_account_id']     = message.sender_account_id
+    msg_data['recipient_account_id']  = message.recipient_account_id
+    msg_data['sender_text']           = message.sender_text
+    msg_data['recipient_text']        = message.recipient_text
+    msg_data['action']                = message.action
+    msg_data['action_params']         = message.action_params
+    msg_data['action_processed']      = message.action_processed
+    msg_data['message_charge']        = message.message_charge
+    msg_data['system_charge']         = message.system_charge
+    msg_data['system_charge_paid_by'] = message.system_charge_paid_by
+    msg_data['status']                = Message.STATUS_MAP[message.status]
+
+    if message.error != None:
+        msg_data['error'] = message.error
+
+    return msg_data
+
+#############################################################################
+
+def _stream_changes(my_global_id, anchor, duration):
+    """ Generate a stream of Server-Sent Events for the given user's changes.
+
+        'my_global_id' is the global ID of the current user, 'anchor' is the
+        parsed anchor dictionary for the changes the caller has already seen,
+        and 'duration' is the number of seconds to keep the stream open for.
+
+        Each time a relevant change is made, we send a "changes" event with the
+        same JSON data as a normal call to "GET /api/changes".  The event ID is
+        set to the new anchor value.  If nothing changes for a while, we send a
+        comment line to keep the connection alive.
+    """
+    deadline = time.time() + duration
+    with changeNotifier.Listener() as listener:
+        while True:
+            changes,new_anchor = _collect_changes(my_global_id, anchor)
+            anchor = new_anchor
+
+            if len(changes) > 0:
+                next_anchor = _encode_anchor(new_anchor)
+                data = json.dumps({'changes'     : changes,
+                                   'next_anchor' : next_anchor})
+                yield "id: %s\nevent: changes\ndata: %s\n\n" % (next_anchor,
+                                                               data)
+
+            while True:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return
+
+                if listener.wait([my_global_id],
+                                 min(remaining, STREAM_KEEPALIVE_INTERVAL)):
+                    break
+                else:
+                    yield ": keepalive\n\n"
+
+#############################################################################
+
 def _calc_anchor():
     """ Calculate and return the current anchor value.
 
-        Note that this function assumes that we have exclusive database access
-        to the Profile, Picture, Conversation and Message tables.
+        We return a dictionary which maps "ChangeLog" to the highest change
+        log sequence number which can safely be reported.  Note that this
+        function must be called before taking a snapshot of the database.
     """
-    anchor = {} # Maps model name to current update ID.
+    anchor = {}
 
-    max_value = Profile.objects.all().aggregate(Max('update_id'))
-    if max_value['update_id__max'] != None:
-        anchor['Profile'] = max_value['update_id__max']
+    seq = dbHelpers.update_id_high_water(ChangeLogEntry, "seq")
+    if seq != None:
+        anchor['ChangeLog'] = seq
 
-    max_value = Picture.objects.all().aggregate(Max('update_id'))
-    if max_value['update_id__max'] != None:
-        anchor['Picture'] = max_value['update_id__max']
-
-    max_value = Conversation.objects.all().aggregate(Max('update_id'))
-    if max_value['update_id__max'] != None:
-        anchor['Conversation'] = max_value['update_id__max']
+    return anchor
 
-    max_value = Message.objects.all().aggregate(Max('update_id'))
-    if max_value['update_id__max'] != None:
-        anchor['Message'] = max_value['update_id__max']
+#############################################################################
 
+def _encode_anchor(anchor):
+    """ Convert the given anchor dictionary into an opaque anchor string.
+    """
     return base64.urlsafe_b64encode(json.dumps(anchor))
 
 #############################################################################
@@ -277,7 +411,7 @@ def _calc_anchor():
 def _parse_anchor(anchor):
     """ Extract the various update IDs from the given anchor value.
 
-        We return a dictionary mapping model names to update IDs.
+        We return the anchor dictionary encoded into the anchor value.
 
         If the anchor can't be parsed, we return None.
     """
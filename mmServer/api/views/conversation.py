@@ -8,12 +8,14 @@ import uuid
 
 from django.http                  import *
 from django.views.decorators.csrf import csrf_exempt
+from django.db.models             import F
 from django.utils                 import timezone
 
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils, encryption
+from mmServer.shared.lib    import utils, encryption, profileCache
+from mmServer.shared.lib    import messageHandler
 
 #############################################################################
 
@@ -62,13 +64,9 @@ def conversation_GET(request):
     else:
         their_global_id = request.GET['their_global_id']
 
-    try:
-        my_profile = Profile.objects.get(global_id=my_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseForbidden()
-
-    if not utils.check_hmac_authentication(request, my_profile.account_secret):
-        return HttpResponseForbidden()
+    error_response = profileCache.authenticate(request, my_global_id)
+    if error_response != None:
+        return error_response
 
     # Get the requested conversation, if it exists.
 
@@ -139,13 +137,9 @@ def conversation_POST(request):
     else:
         their_global_id = data['their_global_id']
 
-    try:
-        my_profile = Profile.objects.get(global_id=my_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseForbidden()
-
-    if not utils.check_hmac_authentication(request, my_profile.account_secret):
-        return HttpResponseForbidden()
+    error_response = profileCache.authenticate(request, my_global_id)
+    if error_response != None:
+        return error_response
 
     # See if we already have a conversation between these two users.
 
@@ -220,13 +214,9 @@ def conversation_PUT(request):
     if action not in ["NEW_MESSAGE", "READ", "HIDE", "UNHIDE"]:
         return HttpResponseBadRequest()
 
-    try:
-        my_profile = Profile.objects.get(global_id=my_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseForbidden()
-
-    if not utils.check_hmac_authentication(request, my_profile.account_secret):
-        return HttpResponseForbidden()
+    error_response = profileCache.authenticate(request, my_global_id)
+    if error_response != None:
+        return error_response
 
     # Get the requested conversation, if it exists.
 
@@ -240,43 +230,40 @@ def conversation_PUT(request):
         except:
             return HttpResponseNotFound()
 
-    # Update the conversation as appropriate.
+    # Update the conversation as appropriate.  Note that we only update the
+    # fields which have changed, and the unread message counts are adjusted
+    # rather than overwritten, so that we don't lose any changes made to the
+    # conversation at the same time.
 
     if action == "NEW_MESSAGE":
 
         if message == None:
             return HttpResponseBadRequest()
 
-        conversation.last_message   = message
-        conversation.last_timestamp = timezone.now()
-
         if conversation.global_id_1 == my_global_id:
-            conversation.num_unread_2 = conversation.num_unread_2 + 1
+            conversation.apply_update(last_timestamp=timezone.now(),
+                                      num_unread_2=F("num_unread_2") + 1)
         else:
-            conversation.num_unread_1 = conversation.num_unread_1 + 1
+            conversation.apply_update(last_timestamp=timezone.now(),
+                                      num_unread_1=F("num_unread_1") + 1)
 
     elif action == "READ":
 
-        if conversation.global_id_1 == my_global_id:
-            conversation.num_unread_1 = 0
-        else:
-            conversation.num_unread_2 = 0
+        messageHandler.mark_conversation_read(conversation, my_global_id)
 
     elif action == "HIDE":
 
         if conversation.global_id_1 == my_global_id:
-            conversation.hidden_1 = True
+            conversation.apply_update(hidden_1=True)
         else:
-            conversation.hidden_2 = True
+            conversation.apply_update(hidden_2=True)
 
     elif action == "UNHIDE":
 
         if conversation.global_id_1 == my_global_id:
-            conversation.hidden_1 = False
+            conversation.apply_update(hidden_1=False)
         else:
-            conversation.hidden_2 = False
-
-    conversation.save()
+            conversation.apply_update(hidden_2=False)
 
     # Finally, tell the caller the good news.
 
@@ -15,7 +15,7 @@ from django.utils                 import timezone
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, profileCache
 
 #############################################################################
 
@@ -48,13 +48,10 @@ def conversations_GET(request, global_id):
     if not utils.has_hmac_headers(request):
         return HttpResponseForbidden()
 
-    try:
-        profile = Profile.objects.get(global_id=global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseNotFound()
-
-    if not utils.check_hmac_authentication(request, profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseNotFound()
+    error_response = profileCache.authenticate(request, global_id, no_profile)
+    if error_response != None:
+        return error_response
 
     conversations = [] # List of matching conversations.
 
@@ -11,12 +11,14 @@ import uuid
 from django.http                  import *
 from django.views.decorators.csrf import csrf_exempt
 from django.utils                 import timezone
+from django.db                    import transaction as db_transaction
 
 import simplejson as json
 
 from mmServer.shared.models import *
 from mmServer.shared.lib    import utils, rippleInterface, encryption
 from mmServer.shared.lib    import messageHandler, transactionHandler
+from mmServer.shared.lib    import profileCache
 
 #############################################################################
 
@@ -65,21 +67,15 @@ def message_GET(request):
 
     # Check the caller's authentication.
 
-    try:
-        my_profile = Profile.objects.get(global_id=my_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("User doesn't have a profile")
-
-    if not utils.check_hmac_authentication(request,
-                                           my_profile.account_secret):
-        return HttpResponseForbidden()
-
-    # If we have any pending messages, check them now.  This will have the
-    # effect of updating the desired message if it was pending.
-
-    messageHandler.check_pending_messages()
+    no_profile     = HttpResponseBadRequest("User doesn't have a profile")
+    error_response = profileCache.authenticate(request, my_global_id,
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
-    # Now get the desired message.
+    # Get the desired message.  Note that pending messages are checked by the
+    # "reconcile_pending" management command, so we simply return the
+    # message's current status.
 
     try:
         msg = Message.objects.get(hash=message_hash)
@@ -221,14 +217,12 @@ def message_POST(request):
     else:
         system_charge_paid_by = data['system_charge_paid_by']
 
-    try:
-        senders_profile = Profile.objects.get(global_id=sender_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("The sender doesn't have a profile!")
-
-    if not utils.check_hmac_authentication(request,
-                                           senders_profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("The sender doesn't have a " +
+                                            "profile!")
+    error_response = profileCache.authenticate(request, sender_global_id,
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
     # Get the Conversation for these two users.  If there is no Conversation
     # record for these two users, create one now.
@@ -258,48 +252,33 @@ def message_POST(request):
         conversation.num_unread_2   = 0
         conversation.save()
 
-    # Create the various transactions needed to pay the charges for this
-    # message.  If one of the accounts doesn't have enough funds to pay the
-    # charge, then we reject the message.
-
-    transactions = []
+    # Get the sender's account, the recipient's account and the MessageMe
+    # system account, creating them if necessary.
 
-    with dbHelpers.exclusive_access(Account, Transaction):
+    sender_account = transactionHandler.get_or_create_account(
+                                Account.TYPE_USER, sender_global_id)
+    recipient_account = transactionHandler.get_or_create_account(
+                                Account.TYPE_USER, recipient_global_id)
+    system_account = transactionHandler.get_or_create_account(
+                                Account.TYPE_MESSAGEME)
 
-        # Get the sender's account, creating it if necessary.
-
-        try:
-            sender_account = Account.objects.get(type=Account.TYPE_USER,
-                                                 global_id=sender_global_id)
-        except Account.DoesNotExist:
-            sender_account = Account()
-            sender_account.type             = Account.TYPE_USER
-            sender_account.global_id        = sender_global_id
-            sender_account.balance_in_drops = 0
-            sender_account.save()
+    # Create the various transactions needed to pay the charges for this
+    # message.  If one of the accounts doesn't have enough funds to pay the
+    # charge, then we reject the message.  Note that we only lock the accounts
+    # involved in this message, so that other users can send messages at the
+    # same time.
 
-        # Get the recipient's account, creating it if necessary.
+    transactions     = []
+    charge_timestamp = timezone.now()
 
-        try:
-            recipient_account = Account.objects.get(type=Account.TYPE_USER,
-                                                 global_id=recipient_global_id)
-        except Account.DoesNotExist:
-            recipient_account = Account()
-            recipient_account.type             = Account.TYPE_USER
-            recipient_account.global_id        = recipient_global_id
-            recipient_account.balance_in_drops = 0
-            recipient_account.save()
+    with db_transaction.atomic():
 
-        # Get the MessageMe system account, creating it if necessary.
+        locked = transactionHandler.lock_accounts([sender_account,
+                                                   recipient_account,
+                                                   system_account])
 
-        try:
-            system_account = Account.objects.get(type=Account.TYPE_MESSAGEME)
-        except Account.DoesNotExist:
-            system_account = Account()
-            system_account.type             = Account.TYPE_MESSAGEME
-            system_account.global_id        = None
-            system_account.balance_in_drops = 0
-            system_account.save()
+        sender_account    = locked[sender_account.id]
+        recipient_account = locked[recipient_account.id]
 
         # Create the appropriate transactions, making sure the sender and/or
         # the recipient can afford to pay for the message.  How we do this
@@ -318,7 +297,7 @@ def message_POST(request):
 
             if system_charge > 0:
                 t = Transaction()
-                t.timestamp               = timezone.now()
+                t.timestamp               = charge_timestamp
                 t.created_by              = sender_account
                 t.status                  = Transaction.STATUS_SUCCESS
                 t.type                    = Transaction.TYPE_CHARGE
@@ -329,7 +308,6 @@ def message_POST(request):
                 t.message                 = None # Initially.
                 t.description             = None
                 t.error                   = None
-                t.save()
 
                 transactions.append(t)
 
@@ -338,7 +316,7 @@ def message_POST(request):
 
             if message_charge > 0:
                 t = Transaction()
-                t.timestamp               = timezone.now()
+                t.timestamp               = charge_timestamp
                 t.created_by              = sender_account
                 t.status                  = Transaction.STATUS_SUCCESS
                 t.type                    = Transaction.TYPE_CHARGE
@@ -349,21 +327,9 @@ def message_POST(request):
                 t.message                 = None # Initially.
                 t.description             = None
                 t.error                   = None
-                t.save()
 
                 transactions.append(t)
 
-            # Update the various account balances.
-
-            if system_charge > 0 or message_charge > 0:
-                transactionHandler.update_account_balance(sender_account)
-
-            if system_charge > 0:
-                transactionHandler.update_account_balance(system_account)
-
-            if message_charge > 0:
-                transactionHandler.update_account_balance(recipient_account)
-
         elif system_charge_paid_by == "RECIPIENT":
 
             # Make sure the sender can afford to pay the message charge.
@@ -381,7 +347,7 @@ def message_POST(request):
 
             if message_charge > 0:
                 t = Transaction()
-                t.timestamp               = timezone.now()
+                t.timestamp               = charge_timestamp
                 t.created_by              = sender_account
                 t.status                  = Transaction.STATUS_SUCCESS
                 t.type                    = Transaction.TYPE_CHARGE
@@ -392,7 +358,6 @@ def message_POST(request):
                 t.message                 = None # Initially.
                 t.description             = None
                 t.error                   = None
-                t.save()
 
                 transactions.append(t)
 
@@ -400,7 +365,7 @@ def message_POST(request):
 
             if system_charge > 0:
                 t = Transaction()
-                t.timestamp               = timezone.now()
+                t.timestamp               = charge_timestamp
                 t.created_by              = recipient_account
                 t.status                  = Transaction.STATUS_SUCCESS
                 t.type                    = Transaction.TYPE_CHARGE
@@ -411,20 +376,14 @@ def message_POST(request):
                 t.message                 = None # Initially.
                 t.description             = None
                 t.error                   = None
-                t.save()
 
                 transactions.append(t)
 
-            # Update the various account balances.
-
-            if message_charge > 0:
-                transactionHandler.update_account_balance(sender_account)
-
-            if message_charge > 0 or system_charge > 0:
-                transactionHandler.update_account_balance(recipient_account)
+        # Insert the charge transactions, updating the account balances to
+        # match.
 
-            if system_charge > 0:
-                transactionHandler.update_account_balance(system_account)
+        transactionHandler.create_transactions(transactions,
+                                               shard_key=sender_global_id)
 
     # If the message has a "SEND_XRP" action associated with it, attempt to
     # transfer the funds to the recipient.  In this case, the message becomes
@@ -445,9 +404,11 @@ def message_POST(request):
 
         error = None # initially.
 
+        account_secret = profileCache.get_account_secret(sender_global_id)
+
         response = rippleInterface.request("sign",
                                            tx_json=transaction,
-                                           secret=senders_profile.account_secret,
+                                           secret=account_secret,
                                            fee_mult_max=1000000)
         if response == None:
             error = "Ripple server failed to respond when signing " \
@@ -512,18 +473,17 @@ def message_POST(request):
     message.system_charge_paid_by = system_charge_paid_by
     message.status                = message_status
     message.error                 = message_error
-    message.save()
 
-    # Update the underlying conversation.
+    # Save the message, updating the underlying conversation to match.
 
-    messageHandler.update_conversation(conversation)
+    messageHandler.save_message(message)
 
     # Link the charge transactions back to the message, now that we've created
     # the Message record.
 
-    for transaction in transactions:
-        transaction.message = message
-        transaction.save()
+    if len(transactions) > 0:
+        Transaction.objects.filter(id__in=[t.id for t in transactions]) \
+                           .update(message=message)
 
     # Finally, tell the caller the good news.
 
@@ -573,26 +533,20 @@ def message_PUT(request):
 
     # Check that the recipient is the one trying to update the message.
 
-    try:
-        recipients_profile = Profile.objects.get(
-                                        global_id=message.recipient_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("The recipient doesn't have a profile!")
-
-    if not utils.check_hmac_authentication(request,
-                                           recipients_profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("The recipient doesn't have a " +
+                                            "profile!")
+    error_response = profileCache.authenticate(request,
+                                               message.recipient_global_id,
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
-    # We're good to go.  Update the message.
+    # We're good to go.  Update the message, along with the underlying
+    # conversation if appropriate.
 
     if processed: message.action_processed = True
     if read:      message.status           = Message.STATUS_READ
-    message.save()
-
-    # Finally, update the underlying conversation if appropriate.
-
-    if read:
-        messageHandler.update_conversation(message.conversation)
+    messageHandler.save_message(message)
 
     return HttpResponse(status=200)
 
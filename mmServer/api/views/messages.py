@@ -11,13 +11,12 @@ import uuid
 from django.http                  import *
 from django.views.decorators.csrf import csrf_exempt
 from django.utils                 import timezone
-from django.db.models             import Max, Q
 
 import simplejson as json
 
 from mmServer.shared.models import *
 from mmServer.shared.lib    import rippleInterface, encryption
-from mmServer.shared.lib    import utils, dbHelpers, messageHandler
+from mmServer.shared.lib    import utils, dbHelpers, profileCache
 
 #############################################################################
 
@@ -75,52 +74,41 @@ def messages_GET(request):
 
     # Check the caller's authentication.
 
-    try:
-        my_profile = Profile.objects.get(global_id=my_global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("User doesn't have a profile")
-
-    if not utils.check_hmac_authentication(request,
-                                           my_profile.account_secret):
-        return HttpResponseForbidden()
-
-    # Check any pending messages.  If these change status to "sent", we will
-    # include them in the list of returned messages.
+    no_profile     = HttpResponseBadRequest("User doesn't have a profile")
+    error_response = profileCache.authenticate(request, my_global_id,
+                                               no_profile)
+    if error_response != None:
+        return error_response
 
-    messageHandler.check_pending_messages()
+    # Perform the actual grabbing of the data within a consistent snapshot of
+    # the database.  This lets us see a consistent set of messages without
+    # preventing other clients from changing the data while we read it.
 
-    # Perform the actual grabbing of the data with an exclusive table lock.
-    # This prevents other clients from changing the data until we're finished.
-
-    with dbHelpers.exclusive_access(Message):
-
-        # Construct a database query to retrieve the desired set of messages.
-        # Note that we process the messages in reverse, starting with the most
-        # recent matching message.
+    with dbHelpers.snapshot():
 
-        if their_global_id != None:
-            filter = ((Q(sender_global_id=my_global_id) &
-                       Q(recipient_global_id=their_global_id)) |
-                      (Q(sender_global_id=their_global_id) &
-                       Q(recipient_global_id=my_global_id)))
-        else:
-            filter = (Q(sender_global_id=my_global_id) |
-                      Q(recipient_global_id=my_global_id))
+        # If we've been asked for the messages before a given message, find
+        # that message.
 
-        query = Message.objects.filter(filter).order_by("-id")
         if from_msg != None:
             try:
-                msg = Message.objects.get(hash=from_msg)
-            except msg.DoesNotExist:
-                msg = None
-
-            if msg == None:
+                before_id = Message.objects.values_list("id", flat=True) \
+                                           .get(hash=from_msg)
+            except Message.DoesNotExist:
                 return HttpResponseBadRequest("'from_msg' not a message hash")
+        else:
+            before_id = None
 
-            query = query.filter(id__lt=msg.id)
+        # Construct a database query to retrieve the desired set of messages.
+        # Note that we process the messages in reverse, starting with the most
+        # recent matching message.  We ask for one more message than we need,
+        # so we can tell if there are more messages to come.
 
         if num_msgs != -1:
-            query = query[:num_msgs+1]
+            limit = num_msgs + 1
+        else:
+            limit = None
+
+        query = _build_query(my_global_id, their_global_id, before_id, limit)
 
         # Collect the list of messages to return.
 
@@ -164,3 +152,65 @@ def messages_GET(request):
                                     'has_more' : has_more}),
                         mimetype="application/json")
 
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _build_query(my_global_id, their_global_id, before_id, limit):
+    """ Build the database query to retrieve a list of messages.
+
+        The parameters are as follows:
+
+            'my_global_id'
+
+                The global ID of the user asking for the messages.
+
+            'their_global_id'
+
+                If not None, only the messages between the two users will be
+                included.  Otherwise, every message sent or received by the
+                user will be included.
+
+            'before_id'
+
+                If not None, only messages with a record ID lower than this
+                will be included.
+
+            'limit'
+
+                The maximum number of messages to return, or None if there is
+                no limit.
+
+        We return a QuerySet which returns the matching Message records, most
+        recent first.
+
+        The messages sent by the user and the messages received by the user
+        are found using two separate queries, combined using a UNION, so that
+        each query can be answered by walking an index in record ID order.
+    """
+    if their_global_id != None:
+        branches = [
+            Message.objects.filter(sender_global_id=my_global_id,
+                                   recipient_global_id=their_global_id),
+            Message.objects.filter(sender_global_id=their_global_id,
+                                   recipient_global_id=my_global_id)]
+    else:
+        branches = [Message.objects.filter(sender_global_id=my_global_id),
+                    Message.objects.filter(recipient_global_id=my_global_id)]
+
+    for i in range(len(branches)):
+        if before_id != None:
+            branches[i] = branches[i].filter(id__lt=before_id)
+        branches[i] = branches[i].order_by("-id")
+        if limit != None:
+            branches[i] = branches[i][:limit]
+
+    query = dbHelpers.filter_by_union(Message.objects.all(), branches)
+    query = query.order_by("-id")
+    if limit != None:
+        query = query[:limit]
+
+    return query
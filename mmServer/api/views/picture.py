@@ -4,13 +4,13 @@
     application.
 """
 import base64
-import cStringIO
+import hashlib
 import logging
-import io
-import math
 import os.path
 import uuid
+from wsgiref.util import FileWrapper
 
+from django.conf                  import settings
 from django.http                  import *
 from django.views.decorators.csrf import csrf_exempt
 
@@ -19,7 +19,7 @@ import simplejson as json
 from PIL import Image
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils
+from mmServer.shared.lib    import utils, pictureCache, pictureStore
 
 #############################################################################
 
@@ -74,57 +74,61 @@ def picture_GET(request, picture_id):
     else:
         max_height = None
 
+    # Note that we don't load the picture's legacy image data unless we need
+    # it.
+
     try:
-        picture = Picture.objects.get(picture_id=picture_id)
+        picture = Picture.objects.defer("picture_data") \
+                                 .get(picture_id=picture_id)
     except Picture.DoesNotExist:
         return HttpResponseNotFound()
 
+    # If the client already has this version of the picture, tell it so.
+
+    etag = '"%s-%d"' % (picture.picture_id, picture.update_id)
+    if _etag_matches(request, etag):
+        response = HttpResponseNotModified()
+        _add_cache_headers(response, etag)
+        return response
+
     basename,extension = os.path.splitext(picture.picture_filename)
     extension = extension.lower()
     if extension.startswith("."):
         imageType = extension[1:]
 
-    try:
-        image_data = base64.b64decode(picture.picture_data)
-    except TypeError:
-        return HttpResponseBadRequest() # ???
+    content_type = "image/" + imageType
 
     if (max_width != None) or (max_height != None):
-        # Scale the image to fit within the given maximum dimension(s).
-        image = Image.open(io.BytesIO(image_data))
-        width,height = image.size
-
-        if max_width != None and max_height != None:
-            if width > height:
-                if max_width != None and width > max_width:
-                    scale_factor = float(max_width) / float(width)
-                    height       = int(math.ceil(height * scale_factor))
-                    width        = max_width
-            else:
-                if max_height != None and height > max_height:
-                    scale_factor = float(max_height) / float(height)
-                    width        = int(math.ceil(width * scale_factor))
-                    height       = max_height
-        elif max_width != None:
-            if width > max_width:
-                scale_factor = float(max_width) / float(width)
-                height       = int(math.ceil(height * scale_factor))
-                width        = max_width
-        elif max_height != None:
-            if height > max_height:
-                scale_factor = float(max_height) / float(height)
-                width        = int(math.ceil(width * scale_factor))
-                height       = max_height
-
-        scaled_image = image.resize((width, height), Image.LANCZOS)
-
-        buffer = cStringIO.StringIO()
-        scaled_image.save(buffer, format=imageType)
-        image_data = buffer.getvalue()
-        buffer.close()
-
-    return HttpResponse(image_data,
-                        mimetype="image/" + imageType)
+        # Scale the image to fit within the given maximum dimension(s).  The
+        # scaled image is cached, so we only have to do this once.
+        try:
+            path = pictureCache.get_rendition_path(picture, max_width,
+                                                   max_height, imageType)
+        except TypeError:
+            return HttpResponseBadRequest() # ???
+
+        response = None
+        if path != None:
+            response = _file_response(path, content_type)
+        if response == None:
+            # The rendition couldn't be cached -> render it directly.
+            image_data = pictureCache.get_rendition(picture, max_width,
+                                                    max_height, imageType)
+            response = HttpResponse(image_data, content_type=content_type)
+    else:
+        response = None
+        path     = pictureStore.picture_path(picture)
+        if path != None:
+            response = _file_response(path, content_type)
+        if response == None:
+            try:
+                image_data = pictureStore.load_picture_data(picture)
+            except TypeError:
+                return HttpResponseBadRequest() # ???
+            response = HttpResponse(image_data, content_type=content_type)
+
+    _add_cache_headers(response, etag)
+    return response
 
 #############################################################################
 
@@ -136,9 +140,15 @@ def picture_POST(request):
     if not utils.has_hmac_headers(request):
         return HttpResponseForbidden()
 
+    if request.META['CONTENT_TYPE'].startswith("image/"):
+        return _picture_POST_raw(request)
+
     if request.META['CONTENT_TYPE'] != "application/json":
         return HttpResponseBadRequest("Request must be in JSON format.")
 
+    if _content_length(request) > _max_json_body_size():
+        return _too_large_response()
+
     data = json.loads(request.body)
 
     if "account_secret" not in data:
@@ -161,6 +171,9 @@ def picture_POST(request):
     except TypeError:
         return HttpResponseBadRequest("Picture data not in base64 encoding.")
 
+    if len(raw_data) > settings.PICTURE_MAX_UPLOAD_BYTES:
+        return _too_large_response()
+
     if not utils.check_hmac_authentication(request, account_secret):
         return HttpResponseForbidden()
 
@@ -170,9 +183,11 @@ def picture_POST(request):
     picture.picture_id = picture_id
     picture.account_secret = account_secret
     picture.picture_filename = picture_filename
-    picture.picture_data     = picture_data
+    pictureStore.save_picture_data(picture, raw_data)
     picture.save()
 
+    pictureCache.warm(picture)
+
     return HttpResponse(picture_id, status=201)
 
 #############################################################################
@@ -190,6 +205,12 @@ def picture_PUT(request, picture_id):
     except Picture.DoesNotExist:
         return HttpResponseNotFound()
 
+    if request.META['CONTENT_TYPE'].startswith("image/"):
+        return _picture_PUT_raw(request, picture)
+
+    if _content_length(request) > _max_json_body_size():
+        return _too_large_response()
+
     if not utils.check_hmac_authentication(request, picture.account_secret):
         return HttpResponseForbidden()
 
@@ -213,10 +234,15 @@ def picture_PUT(request, picture_id):
     except TypeError:
         return HttpResponseBadRequest("Picture data not in base64 encoding.")
 
+    if len(raw_data) > settings.PICTURE_MAX_UPLOAD_BYTES:
+        return _too_large_response()
+
     picture.picture_filename = picture_filename
-    picture.picture_data     = picture_data
+    pictureStore.save_picture_data(picture, raw_data)
     picture.save()
 
+    pictureCache.warm(picture)
+
     return HttpResponse(status=200)
 
 #############################################################################
@@ -242,3 +268,242 @@ def picture_DELETE(request, picture_id):
 
     return HttpResponse(status=200)
 
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The number of bytes to read at a time when receiving a raw picture upload.
+
+_UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# The number of bytes allowed in a JSON-format picture upload, in addition to
+# the base64-encoded picture data.
+
+_JSON_OVERHEAD_BYTES = 4096
+
+#############################################################################
+
+def _picture_POST_raw(request):
+    """ Respond to a "POST /api/picture" request with a raw image body.
+
+        Rather than being base64-encoded within a JSON object, the image data
+        makes up the entire request body, and the account secret and picture
+        filename are supplied in the "Account-Secret" and "Picture-Filename"
+        HTTP headers.
+    """
+    headers = utils.normalize_request_headers(request)
+
+    if "ACCOUNT_SECRET" not in headers:
+        return HttpResponseBadRequest("Missing 'Account-Secret' header.")
+    else:
+        account_secret = headers['ACCOUNT_SECRET']
+
+    # Reject a badly-signed request before reading the image data.
+
+    if not utils.check_hmac_signature(request, account_secret):
+        return HttpResponseForbidden()
+
+    if "PICTURE_FILENAME" not in headers:
+        return HttpResponseBadRequest("Missing 'Picture-Filename' header.")
+    else:
+        picture_filename = headers['PICTURE_FILENAME']
+
+    upload,error_response = _receive_upload(request, account_secret)
+    if error_response != None:
+        return error_response
+
+    picture_id = uuid.uuid4().hex
+
+    picture = Picture()
+    picture.picture_id = picture_id
+    picture.account_secret = account_secret
+    picture.picture_filename = picture_filename
+    pictureStore.save_picture_upload(picture, upload)
+    picture.save()
+
+    pictureCache.warm(picture)
+
+    return HttpResponse(picture_id, status=201)
+
+#############################################################################
+
+def _picture_PUT_raw(request, picture):
+    """ Respond to a "PUT /api/picture/<PICTURE_ID>" request with a raw body.
+
+        The image data makes up the entire request body.  The picture's
+        filename can optionally be changed using the "Picture-Filename" HTTP
+        header.
+    """
+    # Reject a badly-signed request before reading the image data.
+
+    if not utils.check_hmac_signature(request, picture.account_secret):
+        return HttpResponseForbidden()
+
+    headers = utils.normalize_request_headers(request)
+
+    upload,error_response = _receive_upload(request, picture.account_secret)
+    if error_response != None:
+        return error_response
+
+    if "PICTURE_FILENAME" in headers:
+        picture.picture_filename = headers['PICTURE_FILENAME']
+    pictureStore.save_picture_upload(picture, upload)
+    picture.save()
+
+    pictureCache.warm(picture)
+
+    return HttpResponse(status=200)
+
+#############################################################################
+
+def _receive_upload(request, account_secret):
+    """ Receive the raw image data making up the body of the given request.
+
+        The request body is read one chunk at a time and written to the
+        picture store as it arrives, calculating the body's MD5 digest as we
+        go.  Once the whole body has been read, we check the request's HMAC
+        authentication and check that the body holds a valid image; only the
+        image's header is parsed to do this.
+
+        The body may be at most PICTURE_MAX_UPLOAD_BYTES long.  A request whose
+        Content-Length header is too large is rejected before anything is
+        read, and we stop reading as soon as the body goes over the limit.
+
+        We return an (upload, error_response) tuple.  If the image data was
+        received, 'upload' will be a pictureStore.Upload object holding the
+        image data, ready to be committed, and 'error_response' will be None.
+        Otherwise, 'upload' will be None and 'error_response' will be the
+        HttpResponse object to return to the caller.
+    """
+    max_bytes = settings.PICTURE_MAX_UPLOAD_BYTES
+
+    if _content_length(request) > max_bytes:
+        return (None, _too_large_response())
+
+    upload = pictureStore.get_store().open_upload()
+    try:
+        body_md5   = hashlib.md5()
+        body_bytes = 0
+        while True:
+            chunk = request.read(_UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            body_bytes = body_bytes + len(chunk)
+            if body_bytes > max_bytes:
+                upload.abort()
+                return (None, _too_large_response())
+            body_md5.update(chunk)
+            upload.write(chunk)
+
+        if not utils.check_hmac_authentication(request, account_secret,
+                                               body_md5=body_md5.hexdigest()):
+            upload.abort()
+            return (None, HttpResponseForbidden())
+
+        # Note that Image.open() only reads the image header; the image data
+        # itself isn't decoded until it is needed.
+
+        f = upload.open()
+        try:
+            Image.open(f)
+        except IOError:
+            upload.abort()
+            return (None, HttpResponseBadRequest("Invalid image data."))
+        finally:
+            f.close()
+    except:
+        upload.abort()
+        raise
+
+    return (upload, None)
+
+#############################################################################
+
+def _content_length(request):
+    """ Return the length of the given request's body, from its headers.
+
+        We return zero if the request has no valid Content-Length header.
+    """
+    try:
+        return int(request.META.get("CONTENT_LENGTH") or 0)
+    except ValueError:
+        return 0
+
+#############################################################################
+
+def _max_json_body_size():
+    """ Return the maximum length of a JSON-format picture upload request.
+
+        The picture data is base64-encoded, which makes it a third larger; we
+        also allow some room for the rest of the JSON object.
+    """
+    return settings.PICTURE_MAX_UPLOAD_BYTES * 4 / 3 + _JSON_OVERHEAD_BYTES
+
+#############################################################################
+
+def _too_large_response():
+    """ Return the HttpResponse to send back if an uploaded picture is too big.
+    """
+    return HttpResponse("Picture too large.", status=413)
+
+#############################################################################
+
+def _etag_matches(request, etag):
+    """ Return True if the request's "If-None-Match" header matches 'etag'.
+    """
+    if_none_match = request.META.get("HTTP_IF_NONE_MATCH")
+    if if_none_match == None:
+        return False
+
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag.startswith("W/"):
+            tag = tag[2:]
+        if tag == "*" or tag == etag:
+            return True
+
+    return False
+
+#############################################################################
+
+def _add_cache_headers(response, etag):
+    """ Add the HTTP headers which let a client cache a picture.
+    """
+    response['ETag']          = etag
+    response['Cache-Control'] = "public, max-age=%d" % settings.PICTURE_MAX_AGE
+
+#############################################################################
+
+def _file_response(path, content_type):
+    """ Return an HttpResponse which sends the contents of the given file.
+
+        If the PICTURE_SENDFILE setting is set, the file is sent by the
+        front-end web server; otherwise, we stream the file's contents back to
+        the caller.  We return None if the file can't be sent.
+    """
+    if settings.PICTURE_SENDFILE == "X-Sendfile":
+        response = HttpResponse(content_type=content_type)
+        response['X-Sendfile'] = path
+        return response
+    elif settings.PICTURE_SENDFILE == "X-Accel-Redirect":
+        for root_dir,root_url in [
+                (settings.PICTURE_STORE_DIR, settings.PICTURE_STORE_URL),
+                (settings.PICTURE_CACHE_DIR, settings.PICTURE_CACHE_URL)]:
+            root_dir = os.path.join(root_dir, "")
+            if path.startswith(root_dir):
+                response = HttpResponse(content_type=content_type)
+                response['X-Accel-Redirect'] = root_url + path[len(root_dir):]
+                return response
+
+    try:
+        f = open(path, "rb")
+    except IOError:
+        return None # The file has been removed.
+
+    response = StreamingHttpResponse(FileWrapper(f),
+                                     content_type=content_type)
+    response['Content-Length'] = os.fstat(f.fileno()).st_size
+    return response
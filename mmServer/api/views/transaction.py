@@ -14,8 +14,9 @@ from django.utils                 import timezone
 import simplejson as json
 
 from mmServer.shared.models import *
-from mmServer.shared.lib    import utils, transactionHandler, encryption
-from mmServer.shared.lib    import rippleInterface
+from mmServer.shared.lib    import utils, encryption
+from mmServer.shared.lib    import rippleInterface, transactionHandler
+from mmServer.shared.lib    import profileCache
 
 #############################################################################
 
@@ -62,15 +63,13 @@ def transaction_GET(request):
     else:
         return HttpResponseBadRequest("Missing 'transaction_id' parameter.")
 
-    # Get the user's profile, and check the HMAC authentication details.
+    # Check the HMAC authentication details against the user's profile.
 
-    try:
-        profile = Profile.objects.get(global_id=global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("There is no profile for that global ID")
-
-    if not utils.check_hmac_authentication(request, profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("There is no profile for that " +
+                                            "global ID")
+    error_response = profileCache.authenticate(request, global_id, no_profile)
+    if error_response != None:
+        return error_response
 
     # Get the desired Transaction record.
 
@@ -84,22 +83,9 @@ def transaction_GET(request):
     if transaction.created_by.global_id != global_id:
         return HttpResponseBadRequest("You didn't create this transaction!")
 
-    # If the transaction is pending, ask the Ripple network for the current
-    # transaction status.
-
-    cur_status = transaction.status
-
-    if cur_status == Transaction.STATUS_PENDING:
-        transactionHandler.check_pending_ripple_transaction(transaction)
-
-    # If the transaction went through, update the affected account balances.
-
-    if (cur_status == Transaction.STATUS_PENDING and
-        transaction.status == Transaction.STATUS_SUCCESS):
-        transactionHandler.update_account_balance(transaction.debit_account)
-        transactionHandler.update_account_balance(transaction.credit_account)
-
-    # Calculate the response to send back to the caller.
+    # Calculate the response to send back to the caller.  Note that pending
+    # transactions are checked by the "reconcile_pending" management command,
+    # so we simply return the transaction's current status.
 
     response = {'status' : Transaction.STATUS_MAP[transaction.status]}
 
@@ -162,15 +148,13 @@ def transaction_POST(request):
     else:
         description = None
 
-    # Get the user's profile, and check the HMAC authentication details.
-
-    try:
-        profile = Profile.objects.get(global_id=global_id)
-    except Profile.DoesNotExist:
-        return HttpResponseBadRequest("There is no profile for that global ID")
+    # Check the HMAC authentication details against the user's profile.
 
-    if not utils.check_hmac_authentication(request, profile.account_secret):
-        return HttpResponseForbidden()
+    no_profile     = HttpResponseBadRequest("There is no profile for that " +
+                                            "global ID")
+    error_response = profileCache.authenticate(request, global_id, no_profile)
+    if error_response != None:
+        return error_response
 
     # Get the user's Account record.  If it doesn't exist, create one.
 
@@ -237,9 +221,11 @@ def transaction_POST(request):
         # Ask the Ripple network to sign our transaction, using the user's
         # account secret.
 
+        account_secret = profileCache.get_account_secret(global_id)
+
         response = rippleInterface.request("sign",
                                            tx_json=ripple_transaction,
-                                           secret=profile.account_secret,
+                                           secret=account_secret,
                                            fee_mult_max=1000000)
         if response == None:
             error = "Ripple server failed to respond when signing " \
@@ -343,7 +329,7 @@ def transaction_POST(request):
 
     # Save our transaction, and get the internal ID for the transaction.
 
-    transaction.save()
+    transactionHandler.save_transaction(transaction)
     transaction_id = transaction.id
 
     # Finally, return our response back to the caller.
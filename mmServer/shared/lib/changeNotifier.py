@@ -0,0 +1,497 @@
+""" mmServer.shared.lib.changeNotifier
+
+    This module lets API clients wait for changes to the data, rather than
+    repeatedly polling for them.
+
+    Whenever a Profile, Picture, Conversation or Message record is saved, we
+    send out a notification listing the global IDs of the users who should see
+    that change (the same users who have the change added to their change
+    log).  A waiting request can then listen for these notifications, and
+    wake up as soon as a change relevant to its user has been made.
+
+    On PostgreSQL, the notifications are sent using NOTIFY, and received using
+    LISTEN.  Each server process keeps a single, shared LISTEN connection, no
+    matter how many requests are waiting; a background dispatcher thread reads
+    the notifications from this connection and passes them on to every
+    subscriber.  Because PostgreSQL only delivers a notification once the
+    transaction which sent it has been committed, a listener is never woken up
+    before the change is visible.
+
+    If the shared connection fails, the dispatcher reconnects and then tells
+    every subscriber that notifications may have been missed, by passing them
+    a payload of None.
+
+    For other database engines (ie, SQLite when running the unit tests or
+    developing locally), the notifications are passed directly to the
+    subscribers within the current process.  This only works when the changes
+    are made by the same process that is waiting for them.
+"""
+import logging
+import os
+import select
+import threading
+import time
+
+from django.db import connection
+
+import simplejson as json
+
+from mmServer.shared.lib import dbHelpers
+
+#############################################################################
+
+logger = logging.getLogger(__name__)
+
+#############################################################################
+
+# The name of the PostgreSQL channel used to send our change notifications.
+
+CHANNEL = "mmserver_changes"
+
+# The payload used for a change which is relevant to every user.
+
+EVERYONE = "*"
+
+# The maximum size of a notification payload, in bytes.  PostgreSQL rejects
+# payloads of 8000 bytes or more, so we stay well below this; a change with
+# more recipients than will fit is sent as several notifications.
+
+MAX_PAYLOAD_SIZE = 7000
+
+# The number of seconds to wait before trying to reopen our shared LISTEN
+# connection after it has failed.
+
+RECONNECT_DELAY = 1
+
+#############################################################################
+
+def notify(global_ids):
+    """ Notify any waiting listeners that the data has changed.
+
+        'global_ids' should be a list of the global IDs of the users who should
+        see this change.  If the change is relevant to every user, 'global_ids'
+        should be set to None.
+
+        If there are too many global IDs to fit into a single notification,
+        they are split across as many notifications as needed.
+
+        Note that, on PostgreSQL, the notification will only be delivered once
+        the current transaction has been committed.
+    """
+    if global_ids == None:
+        send(CHANNEL, EVERYONE)
+        return
+
+    for payload in _build_payloads(sorted(set(global_ids))):
+        send(CHANNEL, payload)
+
+#############################################################################
+
+def send(channel, payload):
+    """ Send a notification to everyone subscribed to the given channel.
+
+        'payload' should be a string.  As with notify(), the notification will
+        only be delivered on PostgreSQL once the current transaction has been
+        committed.
+    """
+    if dbHelpers.is_postgres():
+        cursor = connection.cursor()
+        cursor.execute("SELECT pg_notify(%s, %s)", [channel, payload])
+    else:
+        _dispatch(channel, payload)
+
+#############################################################################
+
+def subscribe(channel, callback):
+    """ Start receiving the notifications sent to the given channel.
+
+        'callback' is a function which will be called, with the notification's
+        payload as its only parameter, for each notification sent to the given
+        channel from now on.  If notifications may have been missed, the
+        callback is called with a payload of None.
+
+        On PostgreSQL, the callback is called by our dispatcher thread, so it
+        should return quickly.
+    """
+    _check_pid()
+
+    with _lock:
+        _subscribers.setdefault(channel, []).append(callback)
+        if dbHelpers.is_postgres():
+            try:
+                _listen(channel)
+            except:
+                _remove_subscriber(channel, callback)
+                raise
+
+#############################################################################
+
+def unsubscribe(channel, callback):
+    """ Stop calling the given callback for notifications sent to a channel.
+    """
+    with _lock:
+        _remove_subscriber(channel, callback)
+
+#############################################################################
+
+def stop():
+    """ Close our shared LISTEN connection, if it is open.
+
+        Our subscribers are kept; the connection will be reopened the next
+        time someone subscribes.  This is used by the unit tests, as the test
+        database can't be dropped while our connection is still open.
+    """
+    with _lock:
+        _disconnect()
+
+#############################################################################
+
+class Listener(object):
+    """ A context manager which listens for change notifications.
+
+        Entering the context starts listening for change notifications, and
+        leaving the context stops listening.  Note that a listener will only
+        receive notifications sent after the context has been entered, so the
+        caller should check for changes after entering the context and before
+        calling wait(); this ensures that no change can be missed.
+    """
+    def __init__(self):
+        """ Standard initialiser.
+        """
+        self._condition = threading.Condition()
+        self._payloads  = []
+
+
+    def __enter__(self):
+        """ Enter our context.
+        """
+        subscribe(CHANNEL, self._receive)
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Leave our context.
+        """
+        unsubscribe(CHANNEL, self._receive)
+
+
+    def wait(self, global_ids, timeout):
+        """ Wait for a change relevant to any of the given users.
+
+            'global_ids' is a list of the global IDs of the users we are
+            interested in, and 'timeout' is the maximum number of seconds to
+            wait for.
+
+            We return True if a relevant change notification was received (or
+            notifications may have been missed), or False if we timed out.
+        """
+        global_ids = set(global_ids)
+        deadline   = time.time() + timeout
+
+        with self._condition:
+            while True:
+                payloads = self._payloads
+                self._payloads = []
+                for payload in payloads:
+                    if payload == None or _is_relevant(payload, global_ids):
+                        return True
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+
+                self._condition.wait(remaining)
+
+
+    def _receive(self, payload):
+        """ Receive a notification payload from the dispatcher.
+        """
+        with self._condition:
+            self._payloads.append(payload)
+            self._condition.notify_all()
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# Our shared notification state.  '_subscribers' maps each channel name to a
+# list of the callbacks subscribed to that channel.  On PostgreSQL,
+# '_connection' is our shared LISTEN connection (or None if it isn't open),
+# '_listening' is the set of channels we are listening to on that connection,
+# and '_wake_fd' is the writing end of a pipe used to wake up the connection's
+# dispatcher thread.  '_pid' is the ID of the process which owns this state.
+#
+# All of this is protected by '_lock'.
+
+_lock        = threading.RLock()
+_subscribers = {}
+_connection  = None
+_listening   = set()
+_wake_fd     = None
+_pid         = os.getpid()
+
+#############################################################################
+
+def _check_pid():
+    """ Reset our shared state if we are running in a newly-forked process.
+
+        A forked child process can't share its parent's LISTEN connection or
+        dispatcher thread, so it starts afresh with its own.
+    """
+    global _lock, _subscribers, _connection, _listening, _wake_fd, _pid
+
+    if _pid != os.getpid():
+        _lock        = threading.RLock()
+        _subscribers = {}
+        _connection  = None # Don't close it; it belongs to our parent.
+        _listening   = set()
+        _wake_fd     = None
+        _pid         = os.getpid()
+
+#############################################################################
+
+def _remove_subscriber(channel, callback):
+    """ Remove the given callback from the given channel's subscribers.
+
+        Note that the caller must hold '_lock'.
+    """
+    callbacks = _subscribers.get(channel, [])
+    if callback in callbacks:
+        callbacks.remove(callback)
+    if len(callbacks) == 0:
+        _subscribers.pop(channel, None)
+
+#############################################################################
+
+def _listen(channel):
+    """ Make sure our shared connection is listening to the given channel.
+
+        We open the shared connection if it isn't already open.  Note that the
+        caller must hold '_lock'.
+    """
+    if _connection == None:
+        _connect()
+    elif channel not in _listening:
+        cursor = _connection.cursor()
+        cursor.execute("LISTEN " + channel)
+        cursor.close()
+        _listening.add(channel)
+
+        # Running the LISTEN command may have read some notifications from
+        # the connection, so wake up the dispatcher to pass them on.
+
+        os.write(_wake_fd, "x")
+
+#############################################################################
+
+def _connect():
+    """ Open our shared LISTEN connection, and start its dispatcher thread.
+
+        We listen to every channel which currently has a subscriber.  Note that
+        the caller must hold '_lock'.
+    """
+    global _connection, _listening, _wake_fd
+
+    import psycopg2
+    import psycopg2.extensions
+
+    params = connection.settings_dict
+    conn_params = {'database' : params['NAME']}
+    if params['USER']:
+        conn_params['user'] = params['USER']
+    if params['PASSWORD']:
+        conn_params['password'] = params['PASSWORD']
+    if params['HOST']:
+        conn_params['host'] = params['HOST']
+    if params['PORT']:
+        conn_params['port'] = params['PORT']
+
+    conn = psycopg2.connect(**conn_params)
+    try:
+        conn.set_isolation_level(
+                    psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+
+        channels = set(_subscribers.keys())
+        cursor = conn.cursor()
+        for channel in channels:
+            cursor.execute("LISTEN " + channel)
+        cursor.close()
+    except:
+        conn.close()
+        raise
+
+    read_fd,write_fd = os.pipe()
+
+    _connection = conn
+    _listening  = channels
+    _wake_fd    = write_fd
+
+    thread = threading.Thread(target=_run_dispatcher,
+                              args=[conn, read_fd],
+                              name="changeNotifier dispatcher")
+    thread.daemon = True
+    thread.start()
+
+#############################################################################
+
+def _disconnect():
+    """ Close our shared LISTEN connection, if it is open.
+
+        The connection's dispatcher thread will notice that its connection has
+        gone, and will then exit.  Note that the caller must hold '_lock'.
+    """
+    global _connection, _listening, _wake_fd
+
+    if _connection == None:
+        return
+
+    try:
+        _connection.close()
+    except:
+        logger.exception("Unable to close change notification connection")
+
+    os.write(_wake_fd, "x")
+    os.close(_wake_fd)
+
+    _connection = None
+    _listening  = set()
+    _wake_fd    = None
+
+#############################################################################
+
+def _run_dispatcher(conn, read_fd):
+    """ Pass on the notifications received on the given LISTEN connection.
+
+        This is run in a separate thread for each shared connection we open.
+        'read_fd' is the reading end of the pipe used to wake us up.  We keep
+        running until the connection is closed or replaced; if it fails, we
+        reopen it before exiting.
+    """
+    try:
+        while True:
+            try:
+                readable,writable,errors = select.select([conn, read_fd],
+                                                         [], [])
+                if read_fd in readable:
+                    os.read(read_fd, 1024)
+
+                with _lock:
+                    if conn is not _connection:
+                        return # We've been closed or replaced.
+
+                    conn.poll()
+                    notifications = list(conn.notifies)
+                    del conn.notifies[:]
+            except Exception:
+                with _lock:
+                    if conn is not _connection:
+                        return # We were closed while waiting.
+                    logger.exception("Change notification connection failed")
+                    _disconnect()
+                _reconnect()
+                return
+
+            for notification in notifications:
+                _dispatch(notification.channel, notification.payload)
+    finally:
+        os.close(read_fd)
+
+#############################################################################
+
+def _reconnect():
+    """ Reopen our shared LISTEN connection after it has failed.
+
+        We keep trying until the connection has been reopened (either by us or
+        by a new subscriber), and then tell every subscriber that they may
+        have missed some notifications.  If nobody is subscribed any more, we
+        give up, as the connection will be reopened when it is next needed.
+    """
+    while True:
+        time.sleep(RECONNECT_DELAY)
+
+        with _lock:
+            if len(_subscribers) == 0:
+                return
+            if _connection == None:
+                try:
+                    _connect()
+                except Exception:
+                    logger.exception("Unable to reopen change notification " +
+                                     "connection")
+                    continue
+            channels = list(_subscribers.keys())
+
+        for channel in channels:
+            _dispatch(channel, None)
+        return
+
+#############################################################################
+
+def _dispatch(channel, payload):
+    """ Pass a notification on to everyone subscribed to the given channel.
+    """
+    with _lock:
+        callbacks = list(_subscribers.get(channel, []))
+
+    for callback in callbacks:
+        try:
+            callback(payload)
+        except Exception:
+            logger.exception("Change notification callback failed")
+
+#############################################################################
+
+def _build_payloads(global_ids):
+    """ Split a list of global IDs into notification payloads.
+
+        We return a list of JSON-encoded payloads, each of which is no more
+        than MAX_PAYLOAD_SIZE bytes long.  A single global ID which is too
+        long to fit into a payload by itself is sent as EVERYONE instead.
+    """
+    payloads = []
+    chunk    = []
+    size     = 2 # Allow for the enclosing brackets.
+
+    for global_id in global_ids:
+        item_size = len(json.dumps(global_id)) + 2 # Allow for ", ".
+        if item_size + 2 > MAX_PAYLOAD_SIZE:
+            payloads.append(EVERYONE)
+            continue
+
+        if size + item_size > MAX_PAYLOAD_SIZE:
+            payloads.append(json.dumps(chunk))
+            chunk = []
+            size  = 2
+
+        chunk.append(global_id)
+        size = size + item_size
+
+    if len(chunk) > 0:
+        payloads.append(json.dumps(chunk))
+
+    return payloads
+
+#############################################################################
+
+def _is_relevant(payload, global_ids):
+    """ Return True if the given notification payload affects any of our users.
+
+        'payload' is the payload for a change notification, and 'global_ids'
+        is a set of the global IDs of the users we are interested in.
+    """
+    if payload == EVERYONE:
+        return True
+
+    try:
+        affected = json.loads(payload)
+    except json.JSONDecodeError:
+        return True # Be safe.
+
+    for global_id in affected:
+        if global_id in global_ids:
+            return True
+
+    return False
+
@@ -4,9 +4,12 @@
     the database.
 """
 import logging
+import time
+import zlib
 
-from django.conf import settings
-from django.db   import transaction, connection
+from django.conf      import settings
+from django.db        import transaction, connection
+from django.db.models import Max
 
 #############################################################################
 
@@ -53,3 +56,240 @@ class exclusive_access():
         """
         self._transaction.__exit__(exc_type, exc_value, exc_traceback)
 
+
+#############################################################################
+
+class snapshot():
+    """ A context manager that provides a consistent snapshot of the database.
+
+        On PostgreSQL, this context manager starts a read-only transaction
+        with the "REPEATABLE READ" isolation level on entry, and ends it on
+        exit.  Every query made within the context sees the database as it was
+        when the first query was made, without taking any table locks; writers
+        can continue to change the data while we are reading it.
+
+        For other database engines, we simply start an atomic transaction.
+        Note that if we are already within an atomic transaction, the snapshot
+        will use that transaction as-is.
+    """
+    def __init__(self):
+        """ Standard initialiser.
+        """
+        self._transaction = transaction.atomic()
+
+
+    def __enter__(self):
+        """ Enter our context.
+        """
+        outermost = not connection.in_atomic_block
+
+        self._transaction.__enter__()
+
+        if outermost and is_postgres():
+            cursor = connection.cursor()
+            cursor.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, " +
+                           "READ ONLY")
+
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Leave our context.
+        """
+        self._transaction.__exit__(exc_type, exc_value, exc_traceback)
+
+#############################################################################
+
+# The first half of the two-part advisory lock key used to guard update ID
+# allocation.  The second half is derived from the model's table name.
+
+UPDATE_ID_LOCK_NAMESPACE = 0x4D4D
+
+# The number of seconds update_id_high_water() waits before checking again,
+# if it catches a writer between allocating an update ID and locking it.
+
+UPDATE_ID_RETRY_DELAY = 0.001
+
+#############################################################################
+
+def is_postgres():
+    """ Return True if our default database is a PostgreSQL database.
+    """
+    return "postgresql" in settings.DATABASES['default']['ENGINE']
+
+#############################################################################
+
+def update_id_sequence(model, field="update_id"):
+    """ Return the name of the sequence used to allocate update IDs.
+
+        'model' is the Django model to get the update ID sequence for, and
+        'field' is the name of the field holding the update ID.  Each model
+        which uses update IDs has its own sequence, created by a migration.
+    """
+    return "%s_%s_seq" % (model._meta.db_table, field)
+
+#############################################################################
+
+def next_update_id(model, field="update_id"):
+    """ Allocate and return a new update ID for the given model.
+
+        'model' is the Django model to allocate an update ID for, and 'field'
+        is the name of the field which holds the update ID.
+
+        On PostgreSQL, the update ID is taken from the model's update ID
+        sequence, so that concurrent writers never have to wait for each
+        other.  Before allocating the update ID, we take a shared advisory lock
+        for the model; once it has been allocated, we take an exclusive
+        advisory lock on the update ID itself.  Both locks are held until the
+        current transaction finishes, and are used by update_id_high_water()
+        to see which update IDs are still in flight.
+
+        Note that this must be called from within an atomic transaction, and
+        that the record using this update ID must be saved within that same
+        transaction.
+
+        For other database engines (ie, SQLite when running the unit tests),
+        we simply use the current highest update ID plus one.  This is safe
+        because SQLite serialises all writes to the database.
+    """
+    if is_postgres():
+        key_1,key_2 = _update_id_lock_key(model, field)
+
+        cursor = connection.cursor()
+        cursor.execute("SELECT pg_advisory_xact_lock_shared(%s, %s)",
+                       [key_1, key_2])
+        cursor.execute("SELECT nextval(%s)",
+                       [update_id_sequence(model, field)])
+        update_id = cursor.fetchone()[0]
+        cursor.execute("SELECT pg_advisory_xact_lock(%s, %s)",
+                       [key_2, update_id])
+        return update_id
+    else:
+        max_value = model.objects.all().aggregate(max=Max(field))['max']
+        if max_value == None:
+            return 1
+        else:
+            return max_value + 1
+
+#############################################################################
+
+def update_id_high_water(model, field="update_id"):
+    """ Return the highest update ID which is safe to report to a client.
+
+        'model' is the Django model to check, and 'field' is the name of the
+        field which holds the update ID.
+
+        Because update IDs are allocated from a sequence, a transaction can
+        allocate an update ID and then commit after another transaction with a
+        higher update ID has already been committed.  If we simply used the
+        highest visible update ID, a client could skip over the record which
+        was committed late.
+
+        To avoid this, we look at the advisory locks taken by
+        next_update_id() to find the update IDs which have been allocated by
+        transactions which are still running, and return one less than the
+        lowest of these (or the sequence's current value if there are none).
+        This doesn't take any locks itself, so writers never have to wait for
+        us, and we never have to wait for them.  Every update ID up to and
+        including the value we return has either been committed or rolled
+        back; records with a higher update ID should be ignored until the next
+        time this function is called.
+
+        A writer holding the model's shared lock but no update ID lock is
+        between allocating its first update ID and locking it; in this case,
+        we briefly wait and then check again.
+
+        Note that this should be called before starting a snapshot(), so that
+        the snapshot includes every update ID up to the returned value.
+
+        If no update IDs have been allocated for this model, we return None.
+    """
+    if is_postgres():
+        key_1,key_2 = _update_id_lock_key(model, field)
+
+        cursor = connection.cursor()
+        while True:
+            # Note that we have to read the sequence before the locks, so
+            # that every writer which allocated an update ID up to this value
+            # is either finished or still holding its shared lock.
+
+            cursor.execute("SELECT last_value, is_called FROM %s" %
+                           update_id_sequence(model, field))
+            last_value,is_called = cursor.fetchone()
+
+            if not is_called:
+                last_value = last_value - 1
+
+            cursor.execute("SELECT pid, classid, objid FROM pg_locks" +
+                           " WHERE locktype = 'advisory' AND granted" +
+                           " AND objsubid = 2 AND pid <> pg_backend_pid()" +
+                           " AND database = (SELECT oid FROM pg_database" +
+                           " WHERE datname = current_database())" +
+                           " AND ((classid = %s AND objid = %s)" +
+                           " OR classid = %s)",
+                           [key_1, key_2, key_2])
+
+            allocating = set()  # PIDs of writers holding the shared lock.
+            in_flight  = {}     # Maps writer PID to lowest update ID locked.
+            for pid,classid,objid in cursor.fetchall():
+                if classid == key_1 and objid == key_2:
+                    allocating.add(pid)
+                elif pid not in in_flight or objid < in_flight[pid]:
+                    in_flight[pid] = objid
+
+            if allocating.issubset(in_flight):
+                break
+
+            time.sleep(UPDATE_ID_RETRY_DELAY)
+
+        if len(in_flight) > 0:
+            last_value = min(last_value, min(in_flight.values()) - 1)
+
+        if last_value < 1:
+            return None
+        else:
+            return last_value
+    else:
+        return model.objects.all().aggregate(max=Max(field))['max']
+
+#############################################################################
+
+def filter_by_union(queryset, branches):
+    """ Restrict a queryset to the records matched by any of several queries.
+
+        'queryset' is the QuerySet to restrict, and 'branches' is a list of
+        QuerySets for the same model.  We return a copy of 'queryset' which
+        only includes the records matched by at least one of the branches.
+
+        This does the same job as filtering 'queryset' using an OR of the
+        branches' conditions, but the branches are combined using a UNION of
+        their record IDs.  Unlike an OR, this lets the database use a separate
+        index for each branch, and each branch can be ordered and sliced so
+        that only the rows which can possibly be returned are looked at.
+    """
+    qn        = connection.ops.quote_name
+    model     = queryset.model
+    pk_column = "%s.%s" % (qn(model._meta.db_table), qn(model._meta.pk.column))
+
+    selects = []
+    params  = []
+    for i,branch in enumerate(branches):
+        sql,branch_params = branch.values_list("pk", flat=True) \
+                                  .query.sql_with_params()
+        selects.append("SELECT * FROM (%s) AS %s" % (sql, qn("branch_%d" % i)))
+        params.extend(branch_params)
+
+    return queryset.extra(where=["%s IN (%s)" % (pk_column,
+                                                 " UNION ".join(selects))],
+                          params=params)
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _update_id_lock_key(model, field):
+    """ Return the two-part advisory lock key for the given model's update IDs.
+    """
+    name = "%s.%s" % (model._meta.db_table, field)
+    return (UPDATE_ID_LOCK_NAMESPACE, zlib.crc32(name) & 0x7fffffff)
+
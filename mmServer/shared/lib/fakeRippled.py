@@ -0,0 +1,552 @@
+""" mmServer.shared.lib.fakeRippled
+
+    This module implements a fake "rippled" server which runs on the local
+    machine.  This lets us exercise the code which talks to the Ripple network
+    in unit tests and benchmarks, without needing a real rippled server.
+
+    The fake server speaks just enough of the rippled WebSocket API to support
+    the mmServer system: the "sign", "submit", "tx", "ping",
+    "ledger_current" and "ledger_closed" commands.  A simulated ledger closes
+    every 'ledger_interval' seconds, and a submitted transaction is validated
+    once 'validation_delay' ledgers have closed after it was submitted.
+
+    To make the fake server behave more like a real one, we can delay each
+    response, make some requests fail with a "tooBusy" error, make some
+    requests go unanswered, and make some submitted transactions fail once
+    they are validated.  The fake server's settings can be changed while it
+    is running.
+"""
+import base64
+import hashlib
+import logging
+import random
+import socket
+import struct
+import threading
+import time
+
+import simplejson as json
+
+#############################################################################
+
+logger = logging.getLogger("mmServer")
+
+#############################################################################
+
+# The GUID used to calculate the WebSocket handshake response, as defined by
+# RFC 6455.
+
+WEBSOCKET_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+# The result code given to submitted transactions which we decide to fail.
+
+FAILED_TRANSACTION_RESULT = "tecUNFUNDED_PAYMENT"
+
+#############################################################################
+
+class FakeRippledServer(object):
+    """ A fake rippled server, listening for WebSocket connections.
+
+        The following settings can be supplied when the server is created, and
+        can also be changed while the server is running:
+
+            'latency'
+
+                How long to wait before responding to each request.  This can
+                be a number of seconds, a function returning a number of
+                seconds, or a string which is passed to parse_latency().
+
+            'failure_rate'
+
+                The fraction of requests which should fail with a "tooBusy"
+                error.
+
+            'drop_rate'
+
+                The fraction of requests which should never be answered.
+
+            'tx_failure_rate'
+
+                The fraction of submitted transactions which should fail once
+                they have been validated.
+
+            'validation_delay'
+
+                The number of ledgers which must close after a transaction is
+                submitted before that transaction is validated.
+
+            'ledger_interval'
+
+                The number of seconds between each ledger closing.
+
+        Use start() and stop() to start and stop the server, or use the server
+        as a context manager.  Once the server has been started, 'url' will be
+        the WebSocket URL to connect to.
+    """
+    def __init__(self, host="127.0.0.1", port=0, latency=0,
+                 failure_rate=0, drop_rate=0, tx_failure_rate=0,
+                 validation_delay=1, ledger_interval=1.0):
+        """ Standard initialiser.
+
+            'host' and 'port' are the address to listen on.  If 'port' is
+            zero, a free port will be chosen when the server is started.
+        """
+        self.host             = host
+        self.port             = port
+        self.latency          = latency
+        self.failure_rate     = failure_rate
+        self.drop_rate        = drop_rate
+        self.tx_failure_rate  = tx_failure_rate
+        self.validation_delay = validation_delay
+        self.ledger_interval  = ledger_interval
+
+        self.num_requests    = 0 # Number of requests received so far.
+        self.num_connections = 0 # Number of connections accepted so far.
+
+        self._lock         = threading.Lock()
+        self._listener     = None
+        self._threads      = []
+        self._clients      = []
+        self._transactions = {} # Maps hash to (ledger_index, result) tuple.
+        self._started_at   = None
+
+
+    @property
+    def url(self):
+        """ Return the WebSocket URL for connecting to this server.
+        """
+        return "ws://%s:%d" % (self.host, self.port)
+
+
+    def start(self):
+        """ Start listening for connections.
+        """
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((self.host, self.port))
+        self._listener.listen(128)
+
+        self.port        = self._listener.getsockname()[1]
+        self._started_at = time.time()
+
+        thread = threading.Thread(target=self._accept_connections,
+                                  args=[self._listener])
+        thread.daemon = True
+        thread.start()
+        self._threads.append(thread)
+
+
+    def stop(self):
+        """ Stop the server, closing all open connections.
+        """
+        if self._listener != None:
+            try:
+                self._listener.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            self._listener.close()
+            self._listener = None
+
+        with self._lock:
+            clients = self._clients
+            self._clients = []
+
+        for client in clients:
+            client.close()
+
+        # Wait for our threads to finish, so that they aren't left running
+        # when the caller exits.
+
+        for thread in self._threads:
+            thread.join(1.0)
+        self._threads = []
+
+
+    def __enter__(self):
+        """ Enter our context, starting the server.
+        """
+        self.start()
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        """ Leave our context, stopping the server.
+        """
+        self.stop()
+
+
+    def current_ledger(self):
+        """ Return the index of the current (open) ledger.
+        """
+        if self._started_at == None:
+            return 1
+        return 1 + int((time.time() - self._started_at) / self.ledger_interval)
+
+
+    def handle_request(self, request):
+        """ Calculate the response to send back for the given request.
+
+            'request' is a dictionary containing the request sent by the
+            client.  We return a dictionary containing the response to send
+            back, not including the request ID.
+        """
+        command = request.get("command")
+
+        if random.random() < self.failure_rate:
+            return _error("tooBusy", "The server is too busy to help you now.")
+
+        if command == "ping":
+            return _success({})
+        elif command == "ledger_current":
+            return _success({'ledger_current_index' : self.current_ledger()})
+        elif command == "ledger_closed":
+            ledger_index = self.current_ledger() - 1
+            return _success({'ledger_index' : ledger_index,
+                             'ledger_hash'  : _hash(str(ledger_index))})
+        elif command == "sign":
+            return self._sign(request)
+        elif command == "submit":
+            return self._submit(request)
+        elif command == "tx":
+            return self._tx(request)
+        else:
+            return _error("unknownCmd", "Unknown method.")
+
+
+    def _sign(self, request):
+        """ Respond to a "sign" request.
+        """
+        tx_json = request.get("tx_json")
+        if not isinstance(tx_json, dict) or not request.get("secret"):
+            return _error("invalidParams", "Missing field 'tx_json.secret'.")
+
+        tx_json = dict(tx_json)
+        tx_json['Fee']           = "10"
+        tx_json['SigningPubKey'] = _hash(request['secret'])[:66]
+
+        tx_blob = base64.b16encode(json.dumps(tx_json, sort_keys=True))
+        tx_json['hash'] = _hash(tx_blob)
+
+        return _success({'tx_blob' : tx_blob,
+                         'tx_json' : tx_json})
+
+
+    def _submit(self, request):
+        """ Respond to a "submit" request.
+        """
+        try:
+            tx_json = json.loads(base64.b16decode(request.get("tx_blob", "")))
+        except (TypeError, ValueError):
+            return _error("invalidTransaction", "Unable to parse tx_blob.")
+
+        tx_hash = _hash(request['tx_blob'])
+        tx_json['hash'] = tx_hash
+
+        if random.random() < self.tx_failure_rate:
+            result = FAILED_TRANSACTION_RESULT
+        else:
+            result = "tesSUCCESS"
+
+        with self._lock:
+            self._transactions[tx_hash] = (self.current_ledger(), result)
+
+        return _success({'engine_result'         : "tesSUCCESS",
+                         'engine_result_code'    : 0,
+                         'engine_result_message' : "The transaction was " +
+                                                   "applied.",
+                         'tx_blob'               : request['tx_blob'],
+                         'tx_json'               : tx_json})
+
+
+    def _tx(self, request):
+        """ Respond to a "tx" request.
+        """
+        tx_hash = request.get("transaction")
+
+        with self._lock:
+            details = self._transactions.get(tx_hash)
+
+        if details == None:
+            return _error("txnNotFound", "Transaction not found.")
+
+        submitted_ledger,result = details
+
+        # The transaction was added to the ledger which was open when it was
+        # submitted, and is validated once 'validation_delay' ledgers have
+        # closed.
+
+        ledger_index = submitted_ledger + self.validation_delay - 1
+        validated    = self.current_ledger() > ledger_index
+
+        response = {'hash'      : tx_hash,
+                    'validated' : validated,
+                    'meta'      : {'TransactionResult' : result}}
+        if validated:
+            response['ledger_index'] = ledger_index
+
+        return _success(response)
+
+
+    def _accept_connections(self, listener):
+        """ Accept incoming connections until the server is stopped.
+        """
+        while True:
+            try:
+                sock,address = listener.accept()
+            except (socket.error, AttributeError):
+                return # Server has been stopped.
+
+            client = _Client(self, sock)
+            thread = threading.Thread(target=client.run)
+            thread.daemon = True
+
+            with self._lock:
+                self._clients.append(client)
+                self._threads.append(thread)
+                self.num_connections = self.num_connections + 1
+
+            thread.start()
+
+
+    def _count_request(self):
+        """ Record that a request has been received.
+        """
+        with self._lock:
+            self.num_requests = self.num_requests + 1
+
+
+    def _remove_client(self, client):
+        """ Forget about a client whose connection has been closed.
+        """
+        with self._lock:
+            if client in self._clients:
+                self._clients.remove(client)
+
+
+    def _get_latency(self):
+        """ Return the number of seconds to wait before sending a response.
+        """
+        latency = self.latency
+        if isinstance(latency, basestring):
+            latency = parse_latency(latency)
+        if callable(latency):
+            latency = latency()
+        return max(0, latency)
+
+#############################################################################
+
+def parse_latency(spec):
+    """ Parse a string describing a distribution of response times.
+
+        'spec' can be one of the following:
+
+            "<secs>"                   Always wait this many seconds.
+            "uniform:<min>:<max>"      Wait a uniformly-random number of
+                                       seconds between 'min' and 'max'.
+            "exponential:<mean>"       Wait an exponentially-distributed
+                                       number of seconds with the given mean.
+
+        We return a function which returns a random number of seconds drawn
+        from the given distribution.  We raise ValueError if 'spec' is
+        invalid.
+    """
+    parts = spec.split(":")
+    if len(parts) == 1:
+        seconds = float(parts[0])
+        return lambda: seconds
+    elif parts[0] == "uniform" and len(parts) == 3:
+        low  = float(parts[1])
+        high = float(parts[2])
+        return lambda: random.uniform(low, high)
+    elif parts[0] == "exponential" and len(parts) == 2:
+        mean = float(parts[1])
+        return lambda: random.expovariate(1.0 / mean)
+    else:
+        raise ValueError("Invalid latency: %r" % spec)
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _success(result):
+    """ Return a successful response with the given result.
+    """
+    result = dict(result)
+    result['status'] = "success"
+    return {'status' : "success",
+            'type'   : "response",
+            'result' : result}
+
+#############################################################################
+
+def _error(error, error_message):
+    """ Return an error response.
+    """
+    return {'status'        : "error",
+            'type'          : "response",
+            'error'         : error,
+            'error_message' : error_message}
+
+#############################################################################
+
+def _hash(data):
+    """ Return a fake rippled-style hash for the given string.
+    """
+    return hashlib.sha512(data).hexdigest()[:64].upper()
+
+#############################################################################
+
+class _Client(object):
+    """ A single WebSocket connection to our fake rippled server.
+
+        Each request is answered in a separate thread, so that a slow request
+        doesn't hold up any others sent over the same connection.
+    """
+    def __init__(self, server, sock):
+        """ Standard initialiser.
+        """
+        self._server    = server
+        self._socket    = sock
+        self._send_lock = threading.Lock()
+
+
+    def run(self):
+        """ Handle requests from this client until the connection is closed.
+        """
+        try:
+            self._handshake()
+            while True:
+                opcode,payload = self._read_frame()
+                if opcode == 0x8: # Close.
+                    break
+                elif opcode == 0x9: # Ping.
+                    self._send_frame(0xA, payload)
+                elif opcode == 0x1: # Text.
+                    self._server._count_request()
+                    thread = threading.Thread(target=self._respond,
+                                              args=[payload])
+                    thread.daemon = True
+                    thread.start()
+        except (socket.error, EOFError):
+            pass
+        finally:
+            self.close()
+            self._server._remove_client(self)
+
+
+    def close(self):
+        """ Close our connection to the client.
+        """
+        try:
+            self._socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._socket.close()
+
+
+    def _respond(self, payload):
+        """ Calculate and send back the response to the given request.
+        """
+        try:
+            request = json.loads(payload)
+        except ValueError:
+            return
+
+        if random.random() < self._server.drop_rate:
+            return
+
+        time.sleep(self._server._get_latency())
+
+        response = self._server.handle_request(request)
+        if "id" in request:
+            response['id'] = request['id']
+
+        try:
+            self._send_frame(0x1, json.dumps(response))
+        except socket.error:
+            pass
+
+
+    def _handshake(self):
+        """ Perform the WebSocket opening handshake.
+        """
+        data = ""
+        while "\r\n\r\n" not in data:
+            chunk = self._socket.recv(4096)
+            if not chunk:
+                raise EOFError()
+            data = data + chunk
+
+        key = None
+        for line in data.split("\r\n")[1:]:
+            name,sep,value = line.partition(":")
+            if name.strip().lower() == "sec-websocket-key":
+                key = value.strip()
+
+        if key == None:
+            self._socket.sendall("HTTP/1.1 400 Bad Request\r\n\r\n")
+            raise EOFError()
+
+        accept = base64.b64encode(hashlib.sha1(key + WEBSOCKET_GUID).digest())
+
+        self._socket.sendall("HTTP/1.1 101 Switching Protocols\r\n" +
+                             "Upgrade: websocket\r\n" +
+                             "Connection: Upgrade\r\n" +
+                             "Sec-WebSocket-Accept: " + accept + "\r\n" +
+                             "\r\n")
+
+
+    def _read_frame(self):
+        """ Read the next frame from the client.
+
+            We return an (opcode, payload) tuple.  Note that we don't support
+            fragmented messages, as websocket clients don't send them.
+        """
+        header = self._read_bytes(2)
+        opcode = ord(header[0]) & 0x0F
+        masked = ord(header[1]) & 0x80
+        length = ord(header[1]) & 0x7F
+
+        if length == 126:
+            length = struct.unpack(">H", self._read_bytes(2))[0]
+        elif length == 127:
+            length = struct.unpack(">Q", self._read_bytes(8))[0]
+
+        if masked:
+            mask = [ord(c) for c in self._read_bytes(4)]
+        else:
+            mask = [0, 0, 0, 0]
+
+        data = self._read_bytes(length)
+        payload = "".join([chr(ord(c) ^ mask[i % 4])
+                           for i,c in enumerate(data)])
+        return (opcode, payload)
+
+
+    def _send_frame(self, opcode, payload):
+        """ Send an unmasked frame to the client.
+        """
+        length = len(payload)
+        if length < 126:
+            header = struct.pack(">BB", 0x80 | opcode, length)
+        elif length < 65536:
+            header = struct.pack(">BBH", 0x80 | opcode, 126, length)
+        else:
+            header = struct.pack(">BBQ", 0x80 | opcode, 127, length)
+
+        with self._send_lock:
+            self._socket.sendall(header + payload)
+
+
+    def _read_bytes(self, num_bytes):
+        """ Read exactly the given number of bytes from the client.
+        """
+        data = ""
+        while len(data) < num_bytes:
+            chunk = self._socket.recv(num_bytes - len(data))
+            if not chunk:
+                raise EOFError()
+            data = data + chunk
+        return data
@@ -5,7 +5,9 @@
 import datetime
 import logging
 
-from django.utils import timezone
+from django.db        import transaction, connection
+from django.db.models import F, Q, Count
+from django.utils     import timezone
 
 from mmServer.shared.lib    import rippleInterface
 from mmServer.shared.models import *
@@ -16,7 +18,7 @@ logger = logging.getLogger("mmServer")
 
 #############################################################################
 
-def check_pending_messages():
+def check_pending_messages(batch_size=None, after_id=None):
     """ Check any messages with a status of "pending".
 
         We ask the Ripple network for the current status of each of "pending"
@@ -26,10 +28,28 @@ def check_pending_messages():
         If a message was accepted, the associated conversation will also be
         updated to reflect the current unread message count and the details of
         the latest message.
+
+        The pending messages are checked in order of their record ID.  If
+        'after_id' is supplied, only messages with a record ID greater than
+        this will be checked.  If 'batch_size' is supplied, at most this many
+        messages will be checked.
+
+        We return the record ID of the last message we checked, or None if
+        there were no pending messages to check.  This can be passed back as
+        'after_id' to continue checking where the previous batch left off.
     """
-    conversations_to_update = set()
+    last_id = None
+
+    query = Message.objects.filter(status=Message.STATUS_PENDING)
+    if after_id != None:
+        query = query.filter(id__gt=after_id)
+    query = query.order_by("id")
+    if batch_size != None:
+        query = query[:batch_size]
+
+    for msg in query:
+        last_id = msg.id
 
-    for msg in Message.objects.filter(status=Message.STATUS_PENDING):
         response = rippleInterface.request("tx", transaction=msg.hash,
                                                  binary=False)
         if response == None:
@@ -43,14 +63,16 @@ def check_pending_messages():
             if response['error'] == "txnNotFound" and msg.timestamp < cutoff:
                 msg.status = Message.STATUS_FAILED
                 msg.error  = response['error']
-                msg.save()
+                save_message(msg)
                 continue
             else:
                 # Any other error -> try again later.
                 continue
 
         if response.get("result", {}).get("validated", False):
-            # This message has been validated -> update the status.
+            # This message has been validated -> update the status.  If the
+            # message was sent, this also updates the conversation this
+            # message is part of.
 
             trans_result = response['result']['meta']['TransactionResult']
             if trans_result == "tesSUCCESS":
@@ -59,50 +81,190 @@ def check_pending_messages():
             else:
                 msg.status  = Message.STATUS_FAILED
                 msg.error = trans_result
-            msg.save()
-
-            # If the message was sent, update the conversation this message is
-            # part of.  This updates the unread message count, etc, for the
-            # conversation.
-
-            if msg.status == Message.STATUS_SENT:
-                conversations_to_update.add(msg.conversation)
+            save_message(msg)
 
-    for conversation in conversations_to_update:
-        update_conversation(conversation)
+    return last_id
 
 #############################################################################
 
-def update_conversation(conversation):
-    """ Update a conversation to reflect the current state of its messages.
+def save_message(message):
+    """ Save the given message, updating its conversation to match.
 
-        We update the following fields in the Conversation record to reflect
-        the current set of messages associated with that conversation:
+        This saves a new or changed Message record into the database, and then
+        makes the matching changes to the following fields in the Conversation
+        record the message belongs to:
 
-            last_message
+            last_message_1
+            last_message_2
             last_timestamp
             num_unread_1
             num_unread_2
+
+        Rather than recalculating these fields from every message in the
+        conversation, we update them based on just this message.  If a new
+        message is later than the conversation's current last message, it
+        becomes the last message, and a message which changes to or from the
+        "sent" status increments or decrements the recipient's unread message
+        count.  Use rebuild_conversations() to recalculate these fields from
+        scratch.
     """
-    conversation.num_unread_1 = 0
-    conversation.num_unread_2 = 0
-
-    for message in Message.objects.filter(conversation=conversation):
-        if ((conversation.last_timestamp == None) or
-            (message.timestamp > conversation.last_timestamp)):
-            if conversation.global_id_1 == message.sender_global_id:
-                conversation.last_message_1 = message.sender_text
-                conversation.last_message_2 = message.recipient_text
-            else:
-                conversation.last_message_1 = message.recipient_text
-                conversation.last_message_2 = message.sender_text
-            conversation.last_timestamp = message.timestamp
+    with transaction.atomic():
+        if message.id == None:
+            old_status = None
+        else:
+            old_status = Message.objects.select_for_update() \
+                                        .values_list("status", flat=True) \
+                                        .get(id=message.id)
+
+        message.save()
+
+        conversation = message.conversation
+        values       = {}
+
+        # Adjust the recipient's unread message count if the message has
+        # changed to or from the "sent" status.
 
+        delta = 0
+        if old_status == Message.STATUS_SENT:
+            delta = delta - 1
         if message.status == Message.STATUS_SENT:
+            delta = delta + 1
+
+        if delta != 0:
+            if message.sender_global_id == conversation.global_id_1:
+                values['num_unread_2'] = F("num_unread_2") + delta
+            else:
+                values['num_unread_1'] = F("num_unread_1") + delta
+
+        # If this is a new message, make it the conversation's last message
+        # unless there is a later one.
+
+        if old_status == None:
+            if message.sender_global_id == conversation.global_id_1:
+                last_message_1 = message.sender_text
+                last_message_2 = message.recipient_text
+            else:
+                last_message_1 = message.recipient_text
+                last_message_2 = message.sender_text
+
+            is_latest = (Q(last_timestamp__isnull=True) |
+                         Q(last_timestamp__lt=message.timestamp))
+
+            if conversation.apply_update(is_latest,
+                                         last_message_1=last_message_1,
+                                         last_message_2=last_message_2,
+                                         last_timestamp=message.timestamp,
+                                         **values):
+                return
+
+        if len(values) > 0:
+            conversation.apply_update(**values)
+
+#############################################################################
+
+def mark_conversation_read(conversation, global_id):
+    """ Mark every unread message sent to the given user as read.
+
+        'conversation' is the Conversation to update, and 'global_id' is the
+        global ID of the user who has read the conversation.  Each of the
+        user's unread messages in this conversation is marked as read using
+        save_message(), so the user's unread message count is decremented to
+        match; a message which is also being read by someone else at the same
+        time is only counted once.
+    """
+    with transaction.atomic():
+        for message in Message.objects.filter(conversation=conversation,
+                                              recipient_global_id=global_id,
+                                              status=Message.STATUS_SENT):
+            message.conversation = conversation
+            message.status       = Message.STATUS_READ
+            save_message(message)
+
+#############################################################################
+
+def rebuild_conversations():
+    """ Recalculate the summary fields for every conversation.
+
+        This recalculates the last message, last timestamp and unread message
+        counts for every Conversation record from the underlying messages.
+        This shouldn't normally be needed, but can be used to repair the
+        summaries if they ever get out of step with the messages.
+
+        A conversation which has no messages has its last message and last
+        timestamp cleared.
+
+        We return the number of conversations which had to be changed.
+    """
+    # Count the number of sent (but unread) messages from each sender in each
+    # conversation.
+
+    unread = {} # Maps (conversation_id, sender_global_id) to message count.
+    for row in Message.objects.filter(status=Message.STATUS_SENT) \
+                              .values("conversation_id", "sender_global_id") \
+                              .annotate(num_messages=Count("id")):
+        unread[(row['conversation_id'], row['sender_global_id'])] = \
+            row['num_messages']
+
+    # Find the latest message in each conversation.  If several messages have
+    # the same latest timestamp, we use the one with the highest record ID.
+
+    qn  = connection.ops.quote_name
+    sql = ("SELECT m.conversation_id, MAX(m.id)"
+           + " FROM %(table)s AS m"
+           + " JOIN (SELECT conversation_id, MAX(%(timestamp)s) AS ts"
+           + " FROM %(table)s GROUP BY conversation_id) AS latest"
+           + " ON m.conversation_id = latest.conversation_id"
+           + " AND m.%(timestamp)s = latest.ts"
+           + " GROUP BY m.conversation_id") \
+            % {'table'     : qn(Message._meta.db_table),
+               'timestamp' : qn("timestamp")}
+
+    cursor = connection.cursor()
+    cursor.execute(sql)
+
+    last_ids      = dict(cursor.fetchall()) # Maps conversation ID to the ID
+                                            # of its latest message.
+    last_messages = Message.objects.in_bulk(last_ids.values())
+
+    # Now check each conversation in turn, fixing any that don't match.
+
+    num_changed = 0
+    for conversation in Conversation.objects.iterator():
+        values = {}
+
+        num_unread_1 = unread.get((conversation.id, conversation.global_id_2),
+                                  0)
+        num_unread_2 = unread.get((conversation.id, conversation.global_id_1),
+                                  0)
+
+        if conversation.num_unread_1 != num_unread_1:
+            values['num_unread_1'] = num_unread_1
+        if conversation.num_unread_2 != num_unread_2:
+            values['num_unread_2'] = num_unread_2
+
+        message = last_messages.get(last_ids.get(conversation.id))
+        if message == None:
+            last_message_1 = None
+            last_message_2 = None
+            last_timestamp = None
+        else:
+            last_timestamp = message.timestamp
             if message.sender_global_id == conversation.global_id_1:
-                conversation.num_unread_2 = conversation.num_unread_2 + 1
+                last_message_1 = message.sender_text
+                last_message_2 = message.recipient_text
             else:
-                conversation.num_unread_1 = conversation.num_unread_1 + 1
+                last_message_1 = message.recipient_text
+                last_message_2 = message.sender_text
+
+        if conversation.last_message_1 != last_message_1:
+            values['last_message_1'] = last_message_1
+        if conversation.last_message_2 != last_message_2:
+            values['last_message_2'] = last_message_2
+        if conversation.last_timestamp != last_timestamp:
+            values['last_timestamp'] = last_timestamp
 
-    conversation.save()
+        if len(values) > 0:
+            conversation.apply_update(**values)
+            num_changed = num_changed + 1
 
+    return num_changed
@@ -0,0 +1,324 @@
+""" mmServer.shared.lib.nonceCache
+
+    This module keeps track of the nonce values used to make HMAC-authenticated
+    requests, so that a request can't be replayed.
+
+    Every nonce value is stored in the NonceValue database table, which is
+    shared by all of the server's worker processes.  We check and remember a
+    nonce value using a single INSERT: if the nonce has been used before, the
+    INSERT fails.
+
+    On PostgreSQL, the NonceValue table is partitioned by time: each nonce
+    value is inserted into a child table covering NONCE_PARTITION_DAYS days,
+    which inherits from the main NonceValue table.  A nonce value is only
+    checked against the partitions covering the last KEEP_NONCE_VALUES_FOR
+    days, and old nonce values are purged by dropping entire partitions rather
+    than deleting them one row at a time.  Because of this,
+    KEEP_NONCE_VALUES_FOR must be set when running on PostgreSQL.  For other
+    database engines (ie, SQLite when running the unit tests), the nonce
+    values are simply stored in the NonceValue table itself.
+
+    In addition, each process remembers the nonce values it has seen recently
+    in memory, so that a replayed request can be rejected without going to the
+    database at all.  The recently-seen nonces are kept in a number of sets,
+    one for each NONCE_CACHE_BUCKET_SIZE seconds; rather than expiring the
+    nonces one at a time, we simply throw away an entire bucket once it is
+    older than NONCE_CACHE_WINDOW seconds.
+
+    Note that old nonce values are not purged from the database as part of
+    handling a request; the "purge_nonce_values" management command must be
+    run periodically to do this.
+"""
+import datetime
+import logging
+import re
+import threading
+import time
+
+from django.conf            import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db              import IntegrityError, ProgrammingError
+from django.db              import connection, transaction
+
+import django.utils.timezone
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import dbHelpers
+
+#############################################################################
+
+logger = logging.getLogger("mmServer")
+
+#############################################################################
+
+def use_nonce(nonce):
+    """ Record that the given nonce value is being used.
+
+        We return True if the nonce value has not been used before, or False
+        if it has.  Note that a nonce value can only be used once: calling this
+        function twice with the same value will return True and then False.
+    """
+    bucket = _current_bucket()
+
+    with _lock:
+        _expire_buckets(bucket)
+        for nonces in _buckets.values():
+            if nonce in nonces:
+                return False
+
+    if dbHelpers.is_postgres():
+        is_new = _insert_into_partition(nonce)
+    else:
+        is_new = _insert_into_table(nonce)
+
+    if not is_new:
+        return False
+
+    with _lock:
+        _buckets.setdefault(bucket, set()).add(nonce)
+
+    return True
+
+#############################################################################
+
+def purge():
+    """ Purge the old nonce values from the database.
+
+        We remove any nonce values older than settings.KEEP_NONCE_VALUES_FOR
+        days.  On PostgreSQL, any partitions which only hold old nonce values
+        are dropped.  Any old nonce values stored directly in the NonceValue
+        table (rather than in a partition) are deleted.
+
+        We return a (num_partitions, num_deleted) tuple, where 'num_partitions'
+        is the number of partitions which were dropped and 'num_deleted' is the
+        number of individual nonce values which were deleted.
+    """
+    cutoff = _cutoff()
+    if cutoff == None:
+        return (0, 0) # Keep nonce values forever.
+
+    num_partitions = 0
+    if dbHelpers.is_postgres():
+        for name,start,end in _list_partitions():
+            if end <= cutoff:
+                with transaction.atomic():
+                    cursor = connection.cursor()
+                    cursor.execute('DROP TABLE "%s"' % name)
+                num_partitions = num_partitions + 1
+
+        cursor = connection.cursor()
+        cursor.execute('DELETE FROM ONLY "%s" WHERE "timestamp" < %%s'
+                       % NonceValue._meta.db_table, [cutoff])
+        num_deleted = cursor.rowcount
+    else:
+        query       = NonceValue.objects.filter(timestamp__lt=cutoff)
+        num_deleted = query.count()
+        query.delete()
+
+    return (num_partitions, num_deleted)
+
+#############################################################################
+
+def partition_for(timestamp):
+    """ Return the partition which holds nonce values used at the given time.
+
+        We return a (name, start, end) tuple, where 'name' is the name of the
+        partition's database table, and 'start' and 'end' are the range of
+        timestamps held by this partition.  The partition includes the start
+        time but not the end time.
+    """
+    size  = settings.NONCE_PARTITION_DAYS
+    day   = (timestamp - _EPOCH).days // size * size
+    start = _EPOCH + datetime.timedelta(days=day)
+    end   = start + datetime.timedelta(days=size)
+    name  = NonceValue._meta.db_table + "_" + start.strftime("%Y%m%d")
+    return (name, start, end)
+
+#############################################################################
+
+def create_partition(name, start, end):
+    """ Create a new partition of the NonceValue table.
+
+        The partition holds the nonce values used from 'start' up to (but not
+        including) 'end'.  Nothing happens if the partition already exists.
+    """
+    try:
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute('CREATE TABLE IF NOT EXISTS "%s" (' % name +
+                           'CHECK ("timestamp" >= %s AND "timestamp" < %s), ' +
+                           'UNIQUE ("nonce")) ' +
+                           'INHERITS ("%s")' % NonceValue._meta.db_table,
+                           [start, end])
+    except IntegrityError:
+        pass # Someone else created the partition at the same time.
+
+#############################################################################
+
+def clear():
+    """ Forget the nonce values which have been remembered in memory.
+
+        This is used by the unit tests.  Note that the NonceValue table itself
+        is not changed.
+    """
+    with _lock:
+        _buckets.clear()
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# Our in-memory cache of recently-used nonces.  This maps a bucket number
+# (the time the nonces were used, divided by the bucket size) to the set of
+# nonce values used during that time.
+
+_buckets = {} # Maps bucket number to set of nonce values.
+_lock    = threading.Lock()
+
+# The date our partitions are numbered from.
+
+_EPOCH = datetime.datetime(1970, 1, 1, tzinfo=django.utils.timezone.utc)
+
+#############################################################################
+
+def _current_bucket():
+    """ Return the bucket number for the current time.
+    """
+    return int(time.time() / settings.NONCE_CACHE_BUCKET_SIZE)
+
+
+def _expire_buckets(current_bucket):
+    """ Throw away any buckets which are older than our cache window.
+
+        Note that this must be called with our lock held.
+    """
+    num_buckets = settings.NONCE_CACHE_WINDOW // settings.NONCE_CACHE_BUCKET_SIZE
+    for bucket in _buckets.keys():
+        if bucket <= current_bucket - num_buckets:
+            del _buckets[bucket]
+
+#############################################################################
+
+def _cutoff():
+    """ Return the time before which nonce values can be forgotten.
+
+        If nonce values are to be kept forever, we return None.
+    """
+    if settings.KEEP_NONCE_VALUES_FOR == None:
+        return None
+
+    max_age = datetime.timedelta(days=settings.KEEP_NONCE_VALUES_FOR)
+    return django.utils.timezone.now() - max_age
+
+#############################################################################
+
+def _insert_into_table(nonce):
+    """ Insert the given nonce value into the NonceValue table.
+
+        We return True if the nonce value was inserted, or False if it has
+        been used before.
+    """
+    try:
+        with transaction.atomic():
+            nonce_value = NonceValue()
+            nonce_value.nonce     = nonce
+            nonce_value.timestamp = django.utils.timezone.now()
+            nonce_value.save()
+    except IntegrityError:
+        return False
+
+    return True
+
+#############################################################################
+
+def _insert_into_partition(nonce):
+    """ Insert the given nonce value into the current NonceValue partition.
+
+        The nonce value is only inserted if it doesn't already exist in the
+        NonceValue table or in any partition which hasn't yet expired; the
+        check and the insert are made in a single statement.  If the current
+        partition doesn't exist yet, we create it.
+
+        We return True if the nonce value was inserted, or False if it has
+        been used before.
+    """
+    now = django.utils.timezone.now()
+    name,start,end = partition_for(now)
+    sql,params = _build_partition_insert(name, nonce, now)
+
+    for attempt in range(2):
+        try:
+            with transaction.atomic():
+                cursor = connection.cursor()
+                cursor.execute(sql, params)
+                return cursor.rowcount == 1
+        except IntegrityError:
+            # Someone else inserted the same nonce value at the same time.
+            return False
+        except ProgrammingError:
+            # The partition doesn't exist yet -> create it and try again.
+            if attempt > 0:
+                raise
+            create_partition(name, start, end)
+
+#############################################################################
+
+def _build_partition_insert(name, nonce, now):
+    """ Build the SQL statement which inserts a nonce value into a partition.
+
+        'name' is the name of the partition to insert into, 'nonce' is the
+        nonce value, and 'now' is the current time.  We return a (sql, params)
+        tuple.
+
+        The statement only checks the partitions covering the last
+        KEEP_NONCE_VALUES_FOR days.  The cutoff time is passed as a literal
+        value, so PostgreSQL's constraint exclusion skips the older partitions
+        without looking at them.  If KEEP_NONCE_VALUES_FOR isn't set, every
+        partition would have to be checked, so we raise an ImproperlyConfigured
+        exception instead.
+    """
+    if settings.KEEP_NONCE_VALUES_FOR == None:
+        raise ImproperlyConfigured("KEEP_NONCE_VALUES_FOR must be set when " +
+                                   "running on PostgreSQL.")
+
+    cutoff = now - datetime.timedelta(days=settings.KEEP_NONCE_VALUES_FOR)
+
+    sql    = ('INSERT INTO "%s" ("nonce", "timestamp") ' % name +
+              'SELECT %s, %s WHERE NOT EXISTS ' +
+              '(SELECT 1 FROM "%s" WHERE "nonce" = %%s '
+              % NonceValue._meta.db_table +
+              'AND "timestamp" >= %s)')
+    params = [nonce, now, nonce, cutoff]
+
+    return (sql, params)
+
+#############################################################################
+
+def _list_partitions():
+    """ Return a list of the existing partitions of the NonceValue table.
+
+        Each list item is a (name, start, end) tuple, as returned by
+        partition_for().  Note that the end of each partition is calculated
+        using the current value of settings.NONCE_PARTITION_DAYS.
+    """
+    cursor = connection.cursor()
+    cursor.execute("SELECT child.relname FROM pg_inherits " +
+                   "JOIN pg_class AS child ON child.oid=pg_inherits.inhrelid " +
+                   "JOIN pg_class AS parent " +
+                   "ON parent.oid=pg_inherits.inhparent " +
+                   "WHERE parent.relname=%s", [NonceValue._meta.db_table])
+
+    partitions = []
+    for (name,) in cursor.fetchall():
+        match = re.match(r"^%s_(\d{8})$" % NonceValue._meta.db_table, name)
+        if match == None:
+            continue
+
+        start = datetime.datetime.strptime(match.group(1), "%Y%m%d") \
+                                 .replace(tzinfo=django.utils.timezone.utc)
+        end   = start + datetime.timedelta(days=settings.NONCE_PARTITION_DAYS)
+        partitions.append((name, start, end))
+
+    return partitions
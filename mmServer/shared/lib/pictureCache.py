@@ -0,0 +1,441 @@
+""" mmServer.shared.lib.pictureCache
+
+    This module keeps a cache of pre-rendered picture renditions.
+
+    When a client asks for a picture to be scaled to fit within a maximum
+    width and/or height, we resize the picture once and store the resulting
+    image on the local disk.  Subsequent requests for the same rendition are
+    then served directly from the disk, rather than decoding and resizing the
+    picture again.  Only the sizes listed in PICTURE_CACHE_WARM_SIZES are
+    cached; because the sizes are chosen by the client, any other size is
+    rendered afresh for each request rather than filling up the cache.
+
+    Each rendition is identified by the picture ID, the picture's update ID,
+    the requested maximum width and height, and the image format.  Because
+    the update ID changes whenever a picture is changed, a stale rendition is
+    never served; old renditions are deleted as soon as the picture itself is
+    saved.
+
+    The renditions are stored in the PICTURE_CACHE_DIR directory, which is
+    shared by all the server processes on this machine.  The total size of the
+    cached renditions is kept below PICTURE_CACHE_MAX_BYTES by deleting the
+    least recently used renditions.  Each rendition's modification time is
+    updated whenever it is used, so the least recently used renditions are
+    simply the ones with the oldest modification times.  Once the cache is
+    full, we evict renditions until it is down to EVICTION_LOW_WATER of its
+    maximum size, so that we don't have to scan the cache directory again
+    each time a new rendition is added.
+
+    Finally, the common avatar sizes listed in PICTURE_CACHE_WARM_SIZES are
+    rendered as soon as a picture is uploaded, so that the first request for
+    a user's avatar doesn't have to wait for the picture to be resized.
+"""
+import cStringIO
+import errno
+import io
+import logging
+import math
+import os
+import os.path
+import shutil
+import threading
+import uuid
+
+from django.conf              import settings
+from django.db.models.signals import post_save
+from django.dispatch          import receiver
+
+from PIL import Image
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import pictureStore
+
+#############################################################################
+
+logger = logging.getLogger("mmServer")
+
+#############################################################################
+
+# The fraction of PICTURE_CACHE_MAX_BYTES to reduce the cache to when evicting
+# renditions.
+
+EVICTION_LOW_WATER = 0.9
+
+#############################################################################
+
+def get_rendition(picture, max_width, max_height, image_type):
+    """ Return the given picture scaled to fit the given maximum size.
+
+        The parameters are as follows:
+
+            'picture'
+
+                The Picture object to return a rendition of.
+
+            'max_width'
+
+                The maximum width of the rendition, or None if the width
+                isn't limited.
+
+            'max_height'
+
+                The maximum height of the rendition, or None if the height
+                isn't limited.
+
+            'image_type'
+
+                The format to return the rendition in, for example "png".
+
+        We return the rendition's image data as a string.  If the rendition is
+        in the cache, it is returned from there; otherwise, we render it and
+        add it to the cache (if it is one of the cached sizes) before returning
+        it.
+    """
+    if not _is_cached_size(max_width, max_height):
+        return _render(picture, max_width, max_height, image_type)
+
+    path = _rendition_path(picture, max_width, max_height, image_type)
+
+    try:
+        with open(path, "rb") as f:
+            image_data = f.read()
+    except IOError:
+        image_data = None
+
+    if image_data != None:
+        _touch(path)
+        return image_data
+
+    image_data = _render(picture, max_width, max_height, image_type)
+    _store(path, image_data)
+    return image_data
+
+#############################################################################
+
+def get_rendition_path(picture, max_width, max_height, image_type):
+    """ Return the path to a cached rendition of the given picture.
+
+        The parameters are the same as for get_rendition().  If the rendition
+        isn't already in the cache, we render it and add it to the cache.  We
+        return the path to the file holding the cached rendition, or None if
+        the rendition isn't one of the cached sizes or couldn't be added to
+        the cache.
+
+        Note that the rendition may be evicted from the cache at any time, so
+        the caller should be prepared for the file to disappear.
+    """
+    if not _is_cached_size(max_width, max_height):
+        return None
+
+    path = _rendition_path(picture, max_width, max_height, image_type)
+    if os.path.exists(path):
+        _touch(path)
+        return path
+
+    image_data = _render(picture, max_width, max_height, image_type)
+    if _store(path, image_data):
+        return path
+    else:
+        return None
+
+#############################################################################
+
+def warm(picture):
+    """ Pre-render the common renditions of the given picture.
+
+        We add a rendition of the picture to the cache for each of the sizes
+        in settings.PICTURE_CACHE_WARM_SIZES.  If the picture can't be decoded
+        as an image, nothing is cached.
+    """
+    if picture.deleted:
+        return
+
+    image_type = _image_type(picture)
+    if image_type == None:
+        return
+
+    for max_width,max_height in settings.PICTURE_CACHE_WARM_SIZES:
+        try:
+            get_rendition(picture, max_width, max_height, image_type)
+        except (IOError, TypeError, KeyError):
+            logger.warn("Unable to pre-render picture %s" % picture.picture_id)
+            return
+
+#############################################################################
+
+def discard(picture_id, keep_update_id=None):
+    """ Delete the cached renditions of the given picture.
+
+        If 'keep_update_id' is specified, any renditions for that version of
+        the picture are kept.
+    """
+    dir_name = _picture_dir(picture_id)
+    try:
+        file_names = os.listdir(dir_name)
+    except OSError:
+        return # Nothing cached for this picture.
+
+    prefix = None
+    if keep_update_id != None:
+        prefix = "%d-" % keep_update_id
+
+    for file_name in file_names:
+        if prefix != None and file_name.startswith(prefix):
+            continue
+        _remove(os.path.join(dir_name, file_name))
+
+#############################################################################
+
+def clear():
+    """ Delete every cached rendition.
+
+        This is used by the unit tests.
+    """
+    global _total_bytes
+
+    with _lock:
+        shutil.rmtree(settings.PICTURE_CACHE_DIR, ignore_errors=True)
+        _total_bytes = None
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# Our estimate of the total size of the cached renditions, in bytes.  This is
+# calculated by scanning the cache directory the first time a rendition is
+# stored, and is then updated as we add renditions.  Because other processes
+# also add renditions, the directory is scanned again whenever our estimate
+# exceeds the cache's byte budget.
+
+_total_bytes = None
+_lock        = threading.Lock()
+
+#############################################################################
+
+def _image_type(picture):
+    """ Return the image type to use for the given picture.
+
+        The image type is taken from the picture's filename extension.  If the
+        filename doesn't have an extension, we return None.
+    """
+    basename,extension = os.path.splitext(picture.picture_filename)
+    extension = extension.lower()
+    if extension.startswith("."):
+        return extension[1:]
+    else:
+        return None
+
+#############################################################################
+
+def _picture_dir(picture_id):
+    """ Return the directory holding the renditions of the given picture.
+
+        To keep the number of entries in each directory manageable, the
+        picture directories are grouped by the first two characters of their
+        picture ID.
+    """
+    return os.path.join(settings.PICTURE_CACHE_DIR, picture_id[:2], picture_id)
+
+
+def _is_cached_size(max_width, max_height):
+    """ Return True if renditions of the given size should be cached.
+    """
+    return (max_width, max_height) in \
+                [tuple(size) for size in settings.PICTURE_CACHE_WARM_SIZES]
+
+
+def _rendition_path(picture, max_width, max_height, image_type):
+    """ Return the path to the cached rendition with the given details.
+    """
+    if max_width  == None: max_width  = "any"
+    if max_height == None: max_height = "any"
+
+    file_name = "%d-%sx%s.%s" % (picture.update_id, max_width, max_height,
+                                 image_type)
+    return os.path.join(_picture_dir(picture.picture_id), file_name)
+
+#############################################################################
+
+def _render(picture, max_width, max_height, image_type):
+    """ Render the given picture at the given size.
+
+        We return the rendered image data, as a string.
+    """
+    image_data = pictureStore.load_picture_data(picture)
+    return _scale_image(image_data, max_width, max_height, image_type)
+
+#############################################################################
+
+def _scale_image(image_data, max_width, max_height, image_type):
+    """ Scale the given image to fit within the given maximum dimension(s).
+
+        'image_data' is the raw image data to scale, 'max_width' and
+        'max_height' are the maximum width and height of the scaled image (or
+        None if that dimension isn't limited), and 'image_type' is the format
+        to save the scaled image in.
+
+        We return the scaled image data, as a string.
+    """
+    image = Image.open(io.BytesIO(image_data))
+    width,height = image.size
+
+    if max_width != None and max_height != None:
+        if width > height:
+            if max_width != None and width > max_width:
+                scale_factor = float(max_width) / float(width)
+                height       = int(math.ceil(height * scale_factor))
+                width        = max_width
+        else:
+            if max_height != None and height > max_height:
+                scale_factor = float(max_height) / float(height)
+                width        = int(math.ceil(width * scale_factor))
+                height       = max_height
+    elif max_width != None:
+        if width > max_width:
+            scale_factor = float(max_width) / float(width)
+            height       = int(math.ceil(height * scale_factor))
+            width        = max_width
+    elif max_height != None:
+        if height > max_height:
+            scale_factor = float(max_height) / float(height)
+            width        = int(math.ceil(width * scale_factor))
+            height       = max_height
+
+    scaled_image = image.resize((width, height), Image.LANCZOS)
+
+    buffer = cStringIO.StringIO()
+    scaled_image.save(buffer, format=image_type)
+    image_data = buffer.getvalue()
+    buffer.close()
+
+    return image_data
+
+#############################################################################
+
+def _store(path, image_data):
+    """ Store a rendition in the cache.
+
+        The rendition is written to a temporary file which is then renamed,
+        so other processes never see a partially-written rendition.  If the
+        rendition can't be stored, we log a warning and carry on; the cache is
+        purely an optimisation.
+
+        We return True if the rendition was stored, or False if it wasn't.
+    """
+    global _total_bytes
+
+    if len(image_data) > settings.PICTURE_CACHE_MAX_BYTES:
+        return False
+
+    dir_name  = os.path.dirname(path)
+    temp_path = os.path.join(dir_name, "." + uuid.uuid4().hex)
+
+    try:
+        try:
+            os.makedirs(dir_name)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+        with open(temp_path, "wb") as f:
+            f.write(image_data)
+        os.rename(temp_path, path)
+    except (IOError, OSError):
+        logger.exception("Unable to store picture rendition %s" % path)
+        _remove(temp_path)
+        return False
+
+    with _lock:
+        if _total_bytes == None:
+            _total_bytes = _scan()[0]
+        else:
+            _total_bytes = _total_bytes + len(image_data)
+
+        if _total_bytes > settings.PICTURE_CACHE_MAX_BYTES:
+            _total_bytes = _evict()
+
+    return True
+
+#############################################################################
+
+def _scan():
+    """ Scan the cache directory.
+
+        We return a (total_bytes, renditions) tuple, where 'total_bytes' is the
+        total size of the cached renditions and 'renditions' is a list of
+        (mtime, size, path) tuples, one for each cached rendition.
+    """
+    total_bytes = 0
+    renditions  = []
+
+    for dir_name,sub_dirs,file_names in os.walk(settings.PICTURE_CACHE_DIR):
+        for file_name in file_names:
+            if file_name.startswith("."):
+                continue # Ignore partially-written renditions.
+            path = os.path.join(dir_name, file_name)
+            try:
+                info = os.stat(path)
+            except OSError:
+                continue # Deleted by another process.
+            total_bytes = total_bytes + info.st_size
+            renditions.append((info.st_mtime, info.st_size, path))
+
+    return (total_bytes, renditions)
+
+
+def _evict():
+    """ Delete the least recently used renditions until we're within budget.
+
+        If the cache is over budget, we delete renditions until it is down to
+        EVICTION_LOW_WATER of the budget.  We return the total size of the
+        remaining renditions.  Note that this must be called with our lock
+        held.
+    """
+    total_bytes,renditions = _scan()
+    if total_bytes <= settings.PICTURE_CACHE_MAX_BYTES:
+        return total_bytes # Another process has already evicted.
+
+    renditions.sort()
+    low_water = settings.PICTURE_CACHE_MAX_BYTES * EVICTION_LOW_WATER
+
+    for mtime,size,path in renditions:
+        if total_bytes <= low_water:
+            break
+        _remove(path)
+        total_bytes = total_bytes - size
+
+    return total_bytes
+
+#############################################################################
+
+def _touch(path):
+    """ Record that the given rendition has just been used.
+    """
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass # Evicted by another process.
+
+
+def _remove(path):
+    """ Delete the given file, ignoring any errors.
+    """
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+#############################################################################
+
+@receiver(post_save, sender=Picture)
+def _picture_saved(sender, instance, **kwargs):
+    """ Respond to a Picture record being saved.
+
+        We delete any renditions of the previous versions of the picture.
+    """
+    if instance.deleted:
+        discard(instance.picture_id)
+    else:
+        discard(instance.picture_id, keep_update_id=instance.update_id)
@@ -0,0 +1,370 @@
+""" mmServer.shared.lib.pictureStore
+
+    This module stores the image data for uploaded pictures.
+
+    Rather than holding a picture's image data in the Picture record itself,
+    the raw image data is written to a picture store, and the Picture record
+    only holds the SHA-256 hash and size of the image data.  The store is
+    content-addressed: the image data is stored and retrieved using its hash,
+    so identical pictures are only stored once.
+
+    The picture store is pluggable.  The PICTURE_STORE setting holds the full
+    Python path to the picture store class to use; this must be the
+    PictureStore class defined below, or a subclass of it.  The PictureStore
+    class itself simply keeps the image data in memory, which is only useful
+    for testing.  The FileSystemStore stores the image data in files within
+    the PICTURE_STORE_DIR directory.
+
+    Large pictures can be added to the store one chunk at a time, using the
+    Upload object returned by PictureStore.open_upload().  The FileSystemStore
+    writes each chunk to a temporary file as it arrives, so the image data
+    never has to be held in memory all at once.
+
+    Pictures which were uploaded before the picture store existed hold their
+    image data, base64-encoded, in the Picture record's 'picture_data' field.
+    These legacy pictures can still be retrieved; the "migrate_picture_data"
+    management command moves their image data into the picture store.
+"""
+import base64
+import errno
+import hashlib
+import io
+import os
+import os.path
+import threading
+import uuid
+
+from django.conf                 import settings
+from django.utils.module_loading import import_by_path
+
+#############################################################################
+
+class PictureStore(object):
+    """ The base class for a picture store.
+
+        The base class keeps the image data in memory, so anything stored in
+        it is lost when the process exits.  Subclasses override put() and
+        get() to store the image data somewhere more permanent.
+    """
+    def __init__(self, location=None):
+        """ Standard initialiser.
+
+            'location' is the value of the PICTURE_STORE_DIR setting.  This
+            isn't used when the image data is kept in memory.
+        """
+        self._data = {} # Maps hash to image data.
+        self._lock = threading.Lock()
+
+
+    def put(self, data):
+        """ Store the given image data.
+
+            We return the SHA-256 hash of the image data, as a hex string.
+            Storing image data which is already in the store does nothing.
+        """
+        hash = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._data.setdefault(hash, data)
+        return hash
+
+
+    def get(self, hash):
+        """ Return the image data with the given hash.
+
+            We raise a KeyError if the image data isn't in the store.
+        """
+        with self._lock:
+            return self._data[hash]
+
+
+    def path(self, hash):
+        """ Return the path to the file holding the given image data.
+
+            If the picture store doesn't keep image data in local files, we
+            return None.
+        """
+        return None
+
+
+    def open_upload(self):
+        """ Start uploading image data to the store, one chunk at a time.
+
+            We return an Upload object.  By default, the uploaded image data
+            is held in memory until the upload is committed; picture stores
+            can override this to write the image data out as it arrives.
+        """
+        return Upload(self)
+
+#############################################################################
+
+class Upload(object):
+    """ Image data which is being uploaded to a picture store.
+
+        The image data is added using write(), and can be read back using
+        open() to check it.  Once all the image data has been written, call
+        commit() to add it to the picture store, or abort() to throw it away.
+    """
+    def __init__(self, store):
+        """ Standard initialiser.
+
+            'store' is the PictureStore to add the image data to.
+        """
+        self._store  = store
+        self._buffer = io.BytesIO()
+
+
+    def write(self, chunk):
+        """ Add the given chunk of image data to the upload.
+        """
+        self._buffer.write(chunk)
+
+
+    def open(self):
+        """ Return a file-like object for reading back the uploaded data.
+        """
+        return io.BytesIO(self._buffer.getvalue())
+
+
+    def commit(self):
+        """ Add the uploaded image data to the picture store.
+
+            We return a (hash, size) tuple, where 'hash' is the hash of the
+            uploaded image data and 'size' is its size in bytes.
+        """
+        data = self._buffer.getvalue()
+        return (self._store.put(data), len(data))
+
+
+    def abort(self):
+        """ Throw away the uploaded image data.
+        """
+        self._buffer = io.BytesIO()
+
+#############################################################################
+
+class FileSystemStore(PictureStore):
+    """ A picture store which keeps image data in the local filesystem.
+
+        Each piece of image data is stored in a file named after its hash.
+        To keep the number of entries in each directory manageable, the files
+        are grouped into directories using the first few characters of their
+        hash.
+    """
+    def __init__(self, root_dir):
+        """ Standard initialiser.
+
+            'root_dir' is the directory to store the image data in.
+        """
+        self._root_dir = root_dir
+
+
+    def put(self, data):
+        """ Store the given image data.
+        """
+        hash = hashlib.sha256(data).hexdigest()
+        path = self.path(hash)
+        if os.path.exists(path):
+            return hash
+
+        dir_name = os.path.dirname(path)
+        self._make_dirs(dir_name)
+
+        # Write the image data to a temporary file and then rename it, so that
+        # nobody ever sees a partially-written file.
+
+        temp_path = os.path.join(dir_name, "." + uuid.uuid4().hex)
+        try:
+            with open(temp_path, "wb") as f:
+                f.write(data)
+            os.rename(temp_path, path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+        return hash
+
+
+    def get(self, hash):
+        """ Return the image data with the given hash.
+        """
+        try:
+            with open(self.path(hash), "rb") as f:
+                return f.read()
+        except IOError as e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(hash)
+            raise
+
+
+    def path(self, hash):
+        """ Return the path to the file holding the given image data.
+        """
+        return os.path.join(self._root_dir, hash[:2], hash[2:4], hash)
+
+
+    def open_upload(self):
+        """ Start uploading image data to the store, one chunk at a time.
+
+            The image data is written to a temporary file as it arrives, and
+            the file is simply renamed when the upload is committed.
+        """
+        return FileSystemUpload(self)
+
+
+    def _make_dirs(self, dir_name):
+        """ Create the given directory, if it doesn't already exist.
+        """
+        try:
+            os.makedirs(dir_name)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+#############################################################################
+
+class FileSystemUpload(Upload):
+    """ Image data which is being uploaded to a FileSystemStore.
+    """
+    def __init__(self, store):
+        """ Standard initialiser.
+        """
+        self._store = store
+        self._hash  = hashlib.sha256()
+        self._size  = 0
+
+        store._make_dirs(store._root_dir)
+
+        self._temp_path = os.path.join(store._root_dir,
+                                       "." + uuid.uuid4().hex)
+        self._file      = open(self._temp_path, "wb")
+
+
+    def write(self, chunk):
+        """ Add the given chunk of image data to the upload.
+        """
+        self._file.write(chunk)
+        self._hash.update(chunk)
+        self._size = self._size + len(chunk)
+
+
+    def open(self):
+        """ Return a file object for reading back the uploaded data.
+        """
+        self._file.flush()
+        return open(self._temp_path, "rb")
+
+
+    def commit(self):
+        """ Add the uploaded image data to the picture store.
+        """
+        self._file.close()
+
+        hash = self._hash.hexdigest()
+        path = self._store.path(hash)
+        if os.path.exists(path):
+            os.remove(self._temp_path)
+        else:
+            self._store._make_dirs(os.path.dirname(path))
+            os.rename(self._temp_path, path)
+
+        return (hash, self._size)
+
+
+    def abort(self):
+        """ Throw away the uploaded image data.
+        """
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+#############################################################################
+
+def get_store():
+    """ Return the PictureStore object to use for storing image data.
+
+        The picture store is created the first time this function is called,
+        using the PICTURE_STORE and PICTURE_STORE_DIR settings.
+    """
+    global _store, _store_settings
+
+    store_settings = (settings.PICTURE_STORE, settings.PICTURE_STORE_DIR)
+
+    with _lock:
+        if _store == None or _store_settings != store_settings:
+            store_class     = import_by_path(settings.PICTURE_STORE)
+            _store          = store_class(settings.PICTURE_STORE_DIR)
+            _store_settings = store_settings
+        return _store
+
+#############################################################################
+
+def save_picture_data(picture, raw_data):
+    """ Store the image data for the given picture.
+
+        'raw_data' is the picture's raw (not base64-encoded) image data.  We
+        add the image data to the picture store, and update the given Picture
+        object to refer to it.  Note that the Picture object is not saved.
+    """
+    picture.picture_hash = get_store().put(raw_data)
+    picture.picture_size = len(raw_data)
+    picture.picture_data = None
+
+#############################################################################
+
+def save_picture_upload(picture, upload):
+    """ Store the image data for the given picture from the given upload.
+
+        'upload' is an Upload object returned by open_upload() on our picture
+        store, holding the picture's raw image data.  We commit the upload and
+        update the given Picture object to refer to the uploaded image data.
+        Note that the Picture object is not saved.
+    """
+    picture.picture_hash,picture.picture_size = upload.commit()
+    picture.picture_data = None
+
+#############################################################################
+
+def load_picture_data(picture):
+    """ Return the raw image data for the given picture.
+
+        If the picture's image data hasn't been moved into the picture store
+        yet, we decode it from the Picture record itself.  We raise a TypeError
+        if the legacy image data isn't valid base64, or a KeyError if the
+        picture's image data is missing from the picture store.
+    """
+    if picture.picture_hash != None:
+        return get_store().get(picture.picture_hash)
+    else:
+        return base64.b64decode(picture.picture_data)
+
+#############################################################################
+
+def picture_path(picture):
+    """ Return the path to the file holding the given picture's image data.
+
+        If the picture's image data isn't held in a local file, we return
+        None.  This happens if the picture store doesn't use local files, or
+        if the picture's image data hasn't been moved into the picture store.
+    """
+    if picture.picture_hash == None:
+        return None
+
+    path = get_store().path(picture.picture_hash)
+    if path == None or not os.path.exists(path):
+        return None
+
+    return path
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# The PictureStore object returned by get_store(), and the settings which were
+# used to create it.
+
+_store          = None
+_store_settings = None
+_lock           = threading.Lock()
@@ -0,0 +1,226 @@
+""" mmServer.shared.lib.profileCache
+
+    This module authenticates API requests made on behalf of a user.
+
+    Almost every API call is HMAC-authenticated using the account secret from
+    the caller's profile.  Rather than loading the caller's Profile record for
+    every request, each server process keeps a least-recently-used cache
+    mapping global IDs to account secrets.  The cache holds at most
+    PROFILE_CACHE_SIZE entries, and each entry is only trusted for
+    PROFILE_CACHE_TTL seconds.
+
+    Whenever a Profile record is saved or deleted, its entry is removed from
+    the cache in the current process, and a notification is sent to the other
+    server processes (using the changeNotifier module) so that they remove it
+    from their caches too.  This ensures that an old account secret stops
+    being accepted as soon as the new one has been committed.  If the
+    notifications may have been missed, the whole cache is cleared.
+
+    In case another process has changed the account secret and we haven't
+    heard about it yet, if a request's signature doesn't match the cached
+    account secret we reload the account secret from the database and check
+    again.
+"""
+import collections
+import logging
+import os
+import threading
+import time
+
+from django.conf              import settings
+from django.db.models.signals import post_save, post_delete
+from django.http              import HttpResponseForbidden
+from django.dispatch          import receiver
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import utils, changeNotifier
+
+#############################################################################
+
+logger = logging.getLogger(__name__)
+
+#############################################################################
+
+# The name of the channel used to tell the other server processes that a
+# profile has been changed.
+
+CHANNEL = "mmserver_profiles"
+
+#############################################################################
+
+def authenticate(request, global_id, no_profile_response=None):
+    """ Check the HMAC authentication for a request made by the given user.
+
+        If the request was correctly signed using the given user's account
+        secret, we return None.  Otherwise, we return the HttpResponse object
+        which the view should send back to the caller: 'no_profile_response'
+        if there is no profile with the given global ID, or an
+        HttpResponseForbidden if the request wasn't signed correctly.  If
+        'no_profile_response' isn't given, HttpResponseForbidden is used for
+        this too.
+    """
+    entry = _get_entry(global_id)
+
+    if entry != None and entry.from_cache:
+        if not utils.check_hmac_signature(request, entry.account_secret):
+            # The account secret may have changed -> reload it and try again.
+            entry = _get_entry(global_id, reload=True)
+
+    if entry == None:
+        if no_profile_response != None:
+            return no_profile_response
+        return HttpResponseForbidden()
+
+    if not utils.check_hmac_authentication(request, entry.account_secret):
+        return HttpResponseForbidden()
+
+    return None
+
+#############################################################################
+
+def get_account_secret(global_id):
+    """ Return the given user's account secret.
+
+        We return None if there is no profile with the given global ID.
+    """
+    entry = _get_entry(global_id)
+    if entry == None:
+        return None
+    return entry.account_secret
+
+#############################################################################
+
+def invalidate(global_id):
+    """ Remove the given user's cached account secret, if any.
+    """
+    with _lock:
+        _cache.pop(global_id, None)
+
+#############################################################################
+
+def clear():
+    """ Remove every cached account secret.
+
+        This is used by the unit tests.
+    """
+    with _lock:
+        _cache.clear()
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# Our cache of account secrets.  This maps each global ID to an
+# (account_secret, expiry_time) tuple.  The most recently used entries are at
+# the end of the dictionary.
+
+_cache = collections.OrderedDict()
+_lock  = threading.Lock()
+
+# The ID of the process which has subscribed to our change notifications, or
+# None if we haven't subscribed yet.
+
+_subscribed_pid = None
+
+# The details of a user returned by _get_entry().
+
+_Entry = collections.namedtuple("_Entry",
+                                "account_secret from_cache")
+
+#############################################################################
+
+def _get_entry(global_id, reload=False):
+    """ Return the account secret for the given user.
+
+        We return an _Entry object, or None if there is no profile with the
+        given global ID.  If 'reload' is True, we ignore any cached entry and
+        load the details from the database.
+    """
+    now = time.time()
+
+    if not reload:
+        with _lock:
+            cached = _cache.pop(global_id, None)
+            if cached != None:
+                account_secret,expiry_time = cached
+                if expiry_time > now:
+                    _cache[global_id] = cached # Move to the end.
+                    return _Entry(account_secret, True)
+
+    # Make sure we'll hear about any change to the profile before loading it,
+    # so that we can't cache an account secret which is about to be replaced.
+    # If we can't do this, we don't cache the account secret at all.
+
+    can_cache = _subscribe()
+
+    try:
+        account_secret = Profile.objects.values_list("account_secret",
+                                                     flat=True) \
+                                        .get(global_id=global_id)
+    except Profile.DoesNotExist:
+        invalidate(global_id)
+        return None
+
+    if not can_cache:
+        return _Entry(account_secret, False)
+
+    with _lock:
+        _cache.pop(global_id, None)
+        _cache[global_id] = (account_secret, now + settings.PROFILE_CACHE_TTL)
+        while len(_cache) > settings.PROFILE_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+    return _Entry(account_secret, False)
+
+#############################################################################
+
+def _subscribe():
+    """ Subscribe to the profile change notifications, if we haven't already.
+
+        We return True if we are subscribed, or False if we were unable to
+        subscribe.  A newly-forked process subscribes afresh, and clears any
+        account secrets it has inherited from its parent.
+    """
+    global _subscribed_pid
+
+    with _lock:
+        if _subscribed_pid == os.getpid():
+            return True
+
+        try:
+            changeNotifier.subscribe(CHANNEL, _profile_notification)
+        except Exception:
+            logger.exception("Unable to subscribe to profile changes")
+            return False
+
+        _subscribed_pid = os.getpid()
+        _cache.clear()
+        return True
+
+#############################################################################
+
+def _profile_notification(payload):
+    """ Respond to a profile change notification.
+
+        'payload' is the global ID of the changed profile, or None if we may
+        have missed some notifications.
+    """
+    if payload == None:
+        clear()
+    else:
+        invalidate(payload)
+
+#############################################################################
+
+@receiver(post_save,   sender=Profile)
+@receiver(post_delete, sender=Profile)
+def _profile_changed(sender, instance, **kwargs):
+    """ Respond to a Profile record being saved or deleted.
+
+        We remove the profile's cached account secret, in case it has changed,
+        and tell the other server processes to do the same.
+    """
+    invalidate(instance.global_id)
+    changeNotifier.send(CHANNEL, instance.global_id)
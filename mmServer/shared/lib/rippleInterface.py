@@ -2,14 +2,83 @@
 
     This module handles the low-level communication between the mmServer system
     and a remote "rippled" server.
+
+    Rather than opening a new WebSocket connection for every request, we keep
+    a pool of open connections, one for each of the servers listed in the
+    RIPPLED_SERVER_URLS setting.  Each connection can be shared by any number
+    of concurrent requests: every request is given a unique "id" value, which
+    rippled copies into its response, and a background reader thread uses this
+    to hand each response back to the request which is waiting for it.
+
+    The reader thread also sends a "ping" command to the server whenever the
+    connection has been idle for RIPPLED_HEARTBEAT_INTERVAL seconds.  If the
+    server doesn't respond, or the connection fails for any other reason, the
+    connection is closed and any outstanding requests fail immediately.  We
+    then wait before reconnecting to that server, doubling the delay after
+    each failed attempt up to a maximum of RIPPLED_MAX_RECONNECT_DELAY
+    seconds.
+
+    For each server, we keep track of an exponentially-weighted moving average
+    of the time taken to respond to a request, along with the rate at which
+    requests to that server fail.  Requests are sent to the fastest and most
+    reliable servers first.  If a server fails RIPPLED_CIRCUIT_BREAKER_THRESHOLD
+    requests in a row, it is ejected for RIPPLED_CIRCUIT_BREAKER_COOLDOWN
+    seconds before we try it again.
+
+    If the RIPPLED_HEDGE_REQUESTS setting is True and the first server is
+    slower to respond than it usually is (based on the 95th percentile of its
+    recent response times), we send the same request to the next server as
+    well, and use whichever response comes back first.
 """
+import collections
+import logging
+import os
 import random
+import threading
+import time
 
 import websocket
 import simplejson as json
 
 from django.conf import settings
 
+#############################################################################
+
+logger = logging.getLogger("mmServer")
+
+#############################################################################
+
+# The initial number of seconds to wait before reconnecting to a failed
+# server.  This is doubled after each failed attempt to connect.
+
+INITIAL_RECONNECT_DELAY = 0.5
+
+# The weight given to each new sample when updating a server's moving
+# averages.
+
+EWMA_WEIGHT = 0.2
+
+# The number of recent response times we keep for each server, and the number
+# of these we need before we calculate a hedging delay based on them.
+
+NUM_LATENCY_SAMPLES = 100
+MIN_LATENCY_SAMPLES = 10
+
+# The number of seconds to wait before sending a hedged request to a server
+# we don't have enough response times for, and the minimum number of seconds
+# to wait before sending any hedged request.
+
+DEFAULT_HEDGE_DELAY = 1.0
+MIN_HEDGE_DELAY     = 0.05
+
+#############################################################################
+
+class ConnectionUnavailable(Exception):
+    """ Raised when a request can't be sent to a rippled server.
+    """
+    pass
+
+
 #############################################################################
 
 def request(command, **params):
@@ -22,31 +91,493 @@ def request(command, **params):
         respond before returning.  If something goes wrong, we try each server
         in turn until one works.  If no server returns a successful result, we
         return the last failed result.
+
+        Each attempt waits for at most RIPPLED_REQUEST_TIMEOUT seconds for the
+        server to respond.
     """
-    servers = list(settings.RIPPLED_SERVER_URLS)
-    random.shuffle(servers)
+    request = {'command' : command}
+    request.update(params)
 
-    last_response = False
-    for server in servers:
-        try:
-            request = {'command' : command}
-            request.update(params)
+    if settings.RIPPLED_HEDGE_REQUESTS:
+        servers_per_attempt = 2
+    else:
+        servers_per_attempt = 1
 
-            socket = websocket.create_connection(server)
-            socket.send(json.dumps(request))
+    connections = _choose_connections()
 
-            result = socket.recv()
-            socket.close()
-            response = json.loads(result)
+    last_response = None
+    while len(connections) > 0:
+        attempt     = connections[:servers_per_attempt]
+        connections = connections[servers_per_attempt:]
 
+        for response in _send_request(request, attempt):
             if response.get("status") == "success":
                 return response
             else:
                 # Keep trying with the next server.
                 last_response = response
-                continue
-        except:
-            continue
 
     return last_response
 
+#############################################################################
+
+def close_connections():
+    """ Close all of our open connections to the rippled servers.
+
+        The connections will be reopened as required by the next call to
+        request().
+    """
+    with _pool_lock:
+        connections = _pool.values()
+        _pool.clear()
+
+    for connection in connections:
+        connection.close()
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+# Our pool of open connections.  This maps each server URL to the
+# _Connection object used to talk to that server.  '_pool_pid' is the ID of
+# the process which created the pool; a forked child process starts with an
+# empty pool so that it doesn't share sockets with its parent.
+
+_pool_lock = threading.Lock()
+_pool      = {}
+_pool_pid  = None
+
+#############################################################################
+
+def _get_connection(server):
+    """ Return the _Connection object to use for the given server URL.
+    """
+    global _pool_pid
+
+    with _pool_lock:
+        if _pool_pid != os.getpid():
+            _pool.clear()
+            _pool_pid = os.getpid()
+
+        if server not in _pool:
+            _pool[server] = _Connection(server)
+
+        return _pool[server]
+
+def _choose_connections():
+    """ Return the list of _Connection objects to try, in order.
+
+        We omit any servers which have been ejected by the circuit breaker,
+        and sort the rest so that the fastest and most reliable servers are
+        tried first.  Servers we haven't used yet are tried before any others,
+        so that we learn how well they perform.
+    """
+    now = time.time()
+
+    connections = []
+    for server in settings.RIPPLED_SERVER_URLS:
+        connection = _get_connection(server)
+        if connection.stats.is_available(now):
+            connections.append(connection)
+
+    random.shuffle(connections) # Break ties randomly.
+    connections.sort(key=lambda connection: connection.stats.score())
+    return connections
+
+#############################################################################
+
+def _send_request(request, connections):
+    """ Send a request to one or more servers, and wait for the response.
+
+        'request' is a dictionary containing the request to send, and
+        'connections' is a list of the _Connection objects to send it to.
+        The request is sent to the first connection straight away.  If there
+        is a second connection, the same request is also sent to it once the
+        first server has taken longer than its hedging delay to respond, or
+        as soon as the first server fails.
+
+        We return a list of the responses received.  If any server responds
+        successfully, the list will contain just that response.  Otherwise,
+        the list will contain any unsuccessful responses we received before
+        the RIPPLED_REQUEST_TIMEOUT expired.
+    """
+    event     = threading.Event()
+    timeout   = settings.RIPPLED_REQUEST_TIMEOUT
+    deadline  = time.time() + timeout
+    remaining = list(connections)
+    attempts  = [] # List of (connection, pending, request_id) tuples.
+    responses = []
+
+    def start_next_attempt():
+        connection = remaining.pop(0)
+        pending    = _PendingRequest(event)
+        try:
+            request_id = connection.send(request, pending, timeout)
+        except ConnectionUnavailable:
+            connection.stats.record_failure()
+            return
+        attempts.append((connection, pending, request_id))
+
+    start_next_attempt()
+    if len(attempts) > 0 and len(remaining) > 0:
+        hedge_at = attempts[0][1].started + attempts[0][0].stats.hedge_delay()
+    else:
+        hedge_at = None
+
+    try:
+        while True:
+            event.clear()
+
+            for connection,pending,request_id in list(attempts):
+                if not pending.done:
+                    continue
+
+                attempts.remove((connection, pending, request_id))
+                if pending.error != None:
+                    connection.stats.record_failure()
+                    continue
+
+                connection.stats.record_success(pending.finished -
+                                                pending.started)
+                if pending.response.get("status") == "success":
+                    return [pending.response]
+                responses.append(pending.response)
+
+            now = time.time()
+
+            if len(remaining) > 0:
+                if len(attempts) == 0 or (hedge_at != None and now >= hedge_at):
+                    start_next_attempt()
+                    continue
+
+            if len(attempts) == 0:
+                return responses
+
+            if now >= deadline:
+                for connection,pending,request_id in attempts:
+                    connection.stats.record_failure()
+                return responses
+
+            if len(remaining) > 0 and hedge_at != None:
+                event.wait(min(deadline, hedge_at) - now)
+            else:
+                event.wait(deadline - now)
+    finally:
+        # Stop waiting for responses to any requests which are still
+        # outstanding.
+        for connection,pending,request_id in attempts:
+            connection.cancel(request_id)
+
+#############################################################################
+
+class _ServerStats(object):
+    """ Statistics about how well a single rippled server is performing.
+    """
+    def __init__(self):
+        """ Standard initialiser.
+        """
+        self._lock                 = threading.Lock()
+        self._latency              = None
+        self._error_rate           = 0.0
+        self._samples              = collections.deque(
+                                            maxlen=NUM_LATENCY_SAMPLES)
+        self._consecutive_failures = 0
+        self._ejected_until        = 0
+
+
+    def record_success(self, latency):
+        """ Record that the server responded to a request.
+
+            'latency' is the number of seconds it took for the server to
+            respond.
+        """
+        with self._lock:
+            if self._latency == None:
+                self._latency = latency
+            else:
+                self._latency = (EWMA_WEIGHT * latency +
+                                 (1 - EWMA_WEIGHT) * self._latency)
+            self._error_rate = (1 - EWMA_WEIGHT) * self._error_rate
+            self._samples.append(latency)
+            self._consecutive_failures = 0
+
+
+    def record_failure(self):
+        """ Record that the server failed to respond to a request.
+
+            If the server has failed too many requests in a row, we eject it
+            until the circuit breaker's cool-down period has passed.  Note
+            that once a server has been ejected, a single failure after the
+            cool-down period will eject it again.
+        """
+        with self._lock:
+            self._error_rate = (EWMA_WEIGHT +
+                                (1 - EWMA_WEIGHT) * self._error_rate)
+            self._consecutive_failures = self._consecutive_failures + 1
+            if (self._consecutive_failures >=
+                    settings.RIPPLED_CIRCUIT_BREAKER_THRESHOLD):
+                self._ejected_until = (time.time() +
+                                   settings.RIPPLED_CIRCUIT_BREAKER_COOLDOWN)
+
+
+    def is_available(self, now):
+        """ Return True if the server hasn't been ejected at the given time.
+        """
+        return now >= self._ejected_until
+
+
+    def score(self):
+        """ Return a score used to decide which servers to try first.
+
+            Servers with a lower score are tried first.  The score is based
+            on the server's average latency, increased by the rate at which
+            requests to that server fail.
+        """
+        with self._lock:
+            if self._latency == None:
+                return 0.0
+            return self._latency / max(1.0 - self._error_rate, 0.01)
+
+
+    def hedge_delay(self):
+        """ Return the number of seconds to wait before hedging a request.
+
+            This is the 95th percentile of the server's recent response
+            times.
+        """
+        with self._lock:
+            if len(self._samples) < MIN_LATENCY_SAMPLES:
+                return DEFAULT_HEDGE_DELAY
+            samples = sorted(self._samples)
+
+        index = min(int(len(samples) * 0.95), len(samples) - 1)
+        return max(samples[index], MIN_HEDGE_DELAY)
+
+#############################################################################
+
+class _PendingRequest(object):
+    """ A request which is waiting for a response from the rippled server.
+
+        'event' is a threading.Event object which is set once the request has
+        finished.  The same event can be shared by several requests.
+    """
+    def __init__(self, event):
+        """ Standard initialiser.
+        """
+        self.event    = event
+        self.done     = False
+        self.response = None
+        self.error    = None
+        self.started  = time.time()
+        self.finished = None
+
+
+    def finish(self, response=None, error=None):
+        """ Record that the request has finished.
+
+            'response' is the server's response, or 'error' describes why the
+            request failed.
+        """
+        self.response = response
+        self.error    = error
+        self.finished = time.time()
+        self.done     = True
+        self.event.set()
+
+#############################################################################
+
+class _Connection(object):
+    """ A shared, persistent connection to a single rippled server.
+    """
+    def __init__(self, url):
+        """ Standard initialiser.
+
+            'url' is the WebSocket URL for the rippled server.  Note that we
+            don't actually connect to the server until the first request is
+            made.
+        """
+        self.url   = url
+        self.stats = _ServerStats()
+
+        self._lock          = threading.Lock()
+        self._send_lock     = threading.Lock()
+        self._socket        = None
+        self._reader        = None
+        self._pending       = {} # Maps request ID to _PendingRequest object.
+        self._next_id       = 1
+        self._heartbeat_id  = None
+        self._num_failures  = 0
+        self._reconnect_at  = 0
+
+
+    def send(self, request, pending, timeout):
+        """ Send the given request to the server.
+
+            'request' should be a dictionary containing the request to send,
+            'pending' is the _PendingRequest object to finish once the server
+            responds, and 'timeout' is the maximum number of seconds to wait
+            if we have to connect to the server.
+
+            We return the ID allocated to this request.  We raise
+            ConnectionUnavailable if we can't connect to the server.
+        """
+        with self._lock:
+            socket = self._connect(timeout)
+            request_id = self._allocate_id()
+            self._pending[request_id] = pending
+
+        request = dict(request)
+        request['id'] = request_id
+
+        try:
+            with self._send_lock:
+                socket.send(json.dumps(request))
+        except Exception as e:
+            self._disconnect(socket, e)
+
+        return request_id
+
+
+    def cancel(self, request_id):
+        """ Stop waiting for a response to the given request.
+        """
+        with self._lock:
+            self._pending.pop(request_id, None)
+
+
+    def close(self):
+        """ Close our connection to the server, if it is open.
+        """
+        with self._lock:
+            socket = self._socket
+            reader = self._reader
+
+        if socket != None:
+            self._disconnect(socket, "connection closed")
+
+        if reader != None and reader is not threading.current_thread():
+            reader.join(1.0)
+
+
+    def _connect(self, timeout):
+        """ Return our open WebSocket, connecting to the server if necessary.
+
+            Note that this must be called while holding self._lock.
+        """
+        if self._socket != None:
+            return self._socket
+
+        if time.time() < self._reconnect_at:
+            raise ConnectionUnavailable("%s: waiting to reconnect" % self.url)
+
+        try:
+            socket = websocket.create_connection(self.url, timeout=timeout)
+        except Exception as e:
+            self._num_failures = self._num_failures + 1
+            delay = min(INITIAL_RECONNECT_DELAY * 2 ** (self._num_failures - 1),
+                        settings.RIPPLED_MAX_RECONNECT_DELAY)
+            self._reconnect_at = time.time() + delay
+            raise ConnectionUnavailable("%s: %s" % (self.url, e))
+
+        socket.settimeout(settings.RIPPLED_HEARTBEAT_INTERVAL)
+
+        self._socket        = socket
+        self._heartbeat_id  = None
+        self._num_failures  = 0
+        self._reconnect_at  = 0
+
+        self._reader = threading.Thread(target=self._read_responses,
+                                        args=[socket])
+        self._reader.daemon = True
+        self._reader.start()
+
+        return socket
+
+
+    def _disconnect(self, socket, error):
+        """ Close the given WebSocket, failing any outstanding requests.
+
+            'error' describes why the socket is being closed.  If the socket
+            has already been replaced by a new connection, we simply close it.
+        """
+        with self._lock:
+            if self._socket is socket:
+                self._socket = None
+                pending = self._pending
+                self._pending = {}
+            else:
+                pending = {}
+
+        try:
+            socket.close()
+        except:
+            pass
+
+        for request in pending.values():
+            request.finish(error=error)
+
+
+    def _allocate_id(self):
+        """ Return a new unique request ID.
+
+            Note that this must be called while holding self._lock.
+        """
+        request_id = self._next_id
+        self._next_id = self._next_id + 1
+        return request_id
+
+
+    def _read_responses(self, socket):
+        """ Read responses from the given WebSocket until it is closed.
+
+            This is run in a separate thread for each open connection.  Each
+            response is passed back to the request which is waiting for it.
+            If the connection is idle for too long, we send a heartbeat; if we
+            don't get a response to the heartbeat, we close the connection.
+        """
+        while True:
+            try:
+                data = socket.recv()
+            except websocket.WebSocketTimeoutException:
+                with self._lock:
+                    if self._socket is not socket:
+                        return
+                    missed_heartbeat = (self._heartbeat_id != None)
+                    if not missed_heartbeat:
+                        self._heartbeat_id = self._allocate_id()
+                        heartbeat_id = self._heartbeat_id
+
+                if missed_heartbeat:
+                    logger.warn("rippled server %s stopped responding" %
+                                self.url)
+                    self._disconnect(socket, "heartbeat timed out")
+                    return
+
+                try:
+                    with self._send_lock:
+                        socket.send(json.dumps({'command' : "ping",
+                                                'id'      : heartbeat_id}))
+                except Exception as e:
+                    self._disconnect(socket, e)
+                    return
+                continue
+            except Exception as e:
+                self._disconnect(socket, e)
+                return
+
+            try:
+                response = json.loads(data)
+            except ValueError:
+                logger.warn("Invalid response from rippled server %s: %r" %
+                            (self.url, data))
+                continue
+
+            with self._lock:
+                # Any response shows the server is still alive.
+                self._heartbeat_id = None
+                pending = self._pending.pop(response.get("id"), None)
+
+            if pending != None:
+                pending.finish(response=response)
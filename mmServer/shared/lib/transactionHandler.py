@@ -5,10 +5,16 @@
 """
 import datetime
 import logging
+import random
+import zlib
 
-from django.utils import timezone
+from django.conf      import settings
+from django.db        import IntegrityError
+from django.db        import transaction as db_transaction
+from django.db.models import F, Q, Sum, Min, Max
+from django.utils     import timezone
 
-from mmServer.shared.lib    import rippleInterface
+from mmServer.shared.lib    import rippleInterface, dbHelpers
 from mmServer.shared.models import *
 
 #############################################################################
@@ -17,6 +23,38 @@ logger = logging.getLogger("mmServer")
 
 #############################################################################
 
+def check_pending_transactions(batch_size=None, after_id=None):
+    """ Check any transactions with a status of "pending".
+
+        We ask the Ripple network for the current status of each pending
+        transaction, and update the status for any transaction which has
+        either failed or been accepted into the Ripple ledger.  If a
+        transaction succeeded, the balances of the affected accounts will also
+        be updated.
+
+        'batch_size' and 'after_id' work in the same way as the parameters to
+        messageHandler.check_pending_messages(), and we return the record ID
+        of the last transaction we checked, or None if there were no pending
+        transactions to check.
+    """
+    last_id = None
+
+    query = Transaction.objects.filter(status=Transaction.STATUS_PENDING)
+    if after_id != None:
+        query = query.filter(id__gt=after_id)
+    query = query.order_by("id")
+    if batch_size != None:
+        query = query[:batch_size]
+
+    for transaction in query:
+        last_id = transaction.id
+
+        check_pending_ripple_transaction(transaction)
+
+    return last_id
+
+#############################################################################
+
 def check_pending_ripple_transaction(transaction):
     """ Check the given pending transaction in the Ripple network.
 
@@ -46,14 +84,14 @@ def check_pending_ripple_transaction(transaction):
             if transaction.timestamp < cutoff:
                 transaction.status = Transaction.STATUS_FAILED
                 transaction.error  = response['error']
-                transaction.save()
+                save_transaction(transaction)
                 return
 
         # If we get here, we have an ordinary error -> fail the transaction.
 
         transaction.status = Transaction.STATUS_FAILED
         transaction.error  = response['error_message']
-        transaction.save()
+        save_transaction(transaction)
         return
 
     if response['result'].get("validated", False):
@@ -66,21 +104,526 @@ def check_pending_ripple_transaction(transaction):
         else:
             transaction.status  = Transaction.STATUS_FAILED
             transaction.error = trans_result
+        save_transaction(transaction)
+
+#############################################################################
+
+def save_transaction(transaction, shard_key=None):
+    """ Save the given transaction, updating the account balances to match.
+
+        This saves a new or changed Transaction record into the database.  If
+        the transaction has changed to or from the "success" status, we add or
+        subtract the transaction amount to the balance of the credit and debit
+        accounts.  Rather than recalculating the balances from every
+        transaction, we apply the difference using an atomic UPDATE within the
+        same database transaction that saves the Transaction record.  The
+        accounts' TransactionRollup records are updated in the same way.
+
+        Note that the account rows are locked until the database transaction
+        is committed; this stops a checkpoint from being taken while this
+        transaction is still being written.
+
+        If one of the accounts has a sharded balance (see
+        is_sharded_account()), we update and lock one of the account's
+        AccountBalanceShard records rather than the Account record itself.
+        The shard is chosen by hashing 'shard_key', or at random if no shard
+        key is given.
+    """
+    debit_account  = transaction.debit_account
+    credit_account = transaction.credit_account
+
+    with db_transaction.atomic():
+        lock_accounts([debit_account, credit_account])
+        shard_ids = _lock_shards([debit_account, credit_account], shard_key)
+
+        if transaction.id == None:
+            old_status = None
+        else:
+            old_status = Transaction.objects.select_for_update() \
+                                            .values_list("status", flat=True) \
+                                            .get(id=transaction.id)
+
         transaction.save()
 
+        delta = 0
+        if old_status == Transaction.STATUS_SUCCESS:
+            delta = delta - 1
+        if transaction.status == Transaction.STATUS_SUCCESS:
+            delta = delta + 1
+
+        if delta != 0:
+            amount = transaction.amount_in_drops * delta
+            _adjust_balance(credit_account.id, shard_ids, amount)
+            _adjust_balance(debit_account.id, shard_ids, -amount)
+            _adjust_rollups(_calc_rollup_changes([transaction], delta))
+
+#############################################################################
+
+def create_transactions(transactions, shard_key=None):
+    """ Insert the given new transactions, updating the account balances.
+
+        This does the same job as calling save_transaction() for each
+        transaction in turn, but the accounts are only locked once, and the
+        net change to each account's balance is applied using a single UPDATE
+        per account.  Similarly, the net change to each affected
+        TransactionRollup record is applied just once.
+
+        The Transaction records are inserted one at a time, so that each
+        transaction's record ID is set by the time we return.
+    """
+    if len(transactions) == 0:
+        return
+
+    accounts = {}
+    for transaction in transactions:
+        accounts[transaction.debit_account.id]  = transaction.debit_account
+        accounts[transaction.credit_account.id] = transaction.credit_account
+
+    with db_transaction.atomic():
+        lock_accounts(accounts.values())
+        shard_ids = _lock_shards(accounts.values(), shard_key)
+
+        for transaction in transactions:
+            transaction.save()
+
+        deltas     = {}
+        successful = []
+        for transaction in transactions:
+            if transaction.status == Transaction.STATUS_SUCCESS:
+                successful.append(transaction)
+                amount    = transaction.amount_in_drops
+                credit_id = transaction.credit_account.id
+                debit_id  = transaction.debit_account.id
+                deltas[credit_id] = deltas.get(credit_id, 0) + amount
+                deltas[debit_id]  = deltas.get(debit_id, 0) - amount
+
+        for account_id in sorted(deltas.keys()):
+            if deltas[account_id] != 0:
+                _adjust_balance(account_id, shard_ids, deltas[account_id])
+
+        _adjust_rollups(_calc_rollup_changes(successful, 1))
+
+#############################################################################
+
+def get_or_create_account(type, global_id=None):
+    """ Return the Account record with the given type and global ID.
+
+        If there is no such account, we create one with a zero balance.  The
+        Account table is only locked while a new account is being created, so
+        that two requests can't create the same account at once.
+    """
+    try:
+        return Account.objects.get(type=type, global_id=global_id)
+    except Account.DoesNotExist:
+        pass
+
+    with dbHelpers.exclusive_access(Account):
+        try:
+            return Account.objects.get(type=type, global_id=global_id)
+        except Account.DoesNotExist:
+            account = Account()
+            account.type             = type
+            account.global_id        = global_id
+            account.balance_in_drops = 0
+            account.save()
+            return account
+
+#############################################################################
+
+def lock_accounts(accounts):
+    """ Lock the Account records for the given accounts.
+
+        This must be called within an atomic transaction; the accounts remain
+        locked until that transaction is committed or rolled back.  The rows
+        are locked using SELECT ... FOR UPDATE, in order of their record IDs,
+        so that two requests locking the same accounts can't deadlock.
+        Accounts with a sharded balance are not locked, as their balance
+        changes are written to the shards instead.
+
+        We return a dictionary mapping each locked account's record ID to a
+        freshly-loaded copy of its Account record.
+    """
+    account_ids = set()
+    for account in accounts:
+        if not is_sharded_account(account):
+            account_ids.add(account.id)
+
+    locked = {}
+    for account in Account.objects.select_for_update() \
+                                  .filter(id__in=account_ids) \
+                                  .order_by("id"):
+        locked[account.id] = account
+    return locked
+
+#############################################################################
+
+def is_sharded_account(account):
+    """ Return True if the given account's balance is split into shards.
+
+        Only the MessageMe system account, which is credited whenever a message
+        is charged for, has its balance sharded.
+    """
+    return (account.type == Account.TYPE_MESSAGEME and
+            settings.SYSTEM_ACCOUNT_BALANCE_SHARDS > 1)
+
+#############################################################################
+
+def get_account_balance(account):
+    """ Return the current balance for the given account.
+
+        For most accounts, this is simply the balance stored in the Account
+        record.  For an account with a sharded balance, we add in the current
+        value of each of the account's shards.  The account's balance and its
+        shards are read using a single query, so that the result is consistent
+        even if fold_balance_shards() is moving the shards into the account at
+        the same time.
+    """
+    if not is_sharded_account(account):
+        return account.balance_in_drops
+
+    balance,total = Account.objects.filter(id=account.id) \
+                                   .annotate(total=Sum("balance_shards__" +
+                                                       "balance_in_drops")) \
+                                   .values_list("balance_in_drops", "total") \
+                                   .get()
+    return balance + (total or 0)
+
+#############################################################################
+
+def fold_balance_shards(account):
+    """ Fold the given account's balance shards back into the Account record.
+
+        We add the value of each of the account's AccountBalanceShard records
+        to the account's balance, and then reset the shards to zero.  Upon
+        completion, the Account object's 'balance_in_drops' value will hold the
+        account's current balance.
+    """
+    with db_transaction.atomic():
+        locked_account = Account.objects.select_for_update().get(id=account.id)
+        shards = list(AccountBalanceShard.objects.select_for_update()
+                                                 .filter(account=account)
+                                                 .order_by("shard"))
+
+        total = sum([shard.balance_in_drops for shard in shards])
+        if total != 0:
+            AccountBalanceShard.objects.filter(account=account) \
+                                       .update(balance_in_drops=0)
+            locked_account.balance_in_drops = \
+                    locked_account.balance_in_drops + total
+            locked_account.save()
+
+        account.balance_in_drops = locked_account.balance_in_drops
+
+#############################################################################
+
+def calc_account_balance(account):
+    """ Calculate the balance for the given account from its transactions.
+
+        We start with the balance as of the account's latest checkpoint (if
+        any), and add up the successful transactions which have happened since
+        then.  The calculated balance is returned.
+    """
+    checkpoint = account.checkpoints.order_by("-transaction_id").first()
+    if checkpoint == None:
+        return _sum_transactions(account)
+    else:
+        return checkpoint.balance_in_drops \
+             + _sum_transactions(account, after_id=checkpoint.transaction_id)
+
+#############################################################################
+
+def create_checkpoint(account):
+    """ Create a new balance checkpoint for the given account.
+
+        The checkpoint covers every transaction up to (but not including) the
+        account's oldest pending transaction, or every transaction if there are
+        no pending transactions.  We return the newly-created
+        AccountBalanceCheckpoint object, or None if the account has had no
+        transactions settle since its last checkpoint.
+    """
+    with db_transaction.atomic():
+        Account.objects.select_for_update().get(id=account.id)
+        list(AccountBalanceShard.objects.select_for_update()
+                                        .filter(account=account)
+                                        .order_by("shard")
+                                        .values_list("id", flat=True))
+
+        transactions = Transaction.objects.filter(Q(debit_account=account) |
+                                                  Q(credit_account=account))
+
+        oldest_pending = transactions.filter(
+                            status=Transaction.STATUS_PENDING).aggregate(
+                            Min("id"))['id__min']
+        if oldest_pending != None:
+            transactions = transactions.filter(id__lt=oldest_pending)
+
+        up_to_id = transactions.aggregate(Max("id"))['id__max']
+        if up_to_id == None:
+            return None
+
+        last_checkpoint = account.checkpoints.order_by("-transaction_id") \
+                                             .first()
+        if last_checkpoint == None:
+            balance = _sum_transactions(account, up_to_id=up_to_id)
+        elif last_checkpoint.transaction_id >= up_to_id:
+            return None
+        else:
+            balance = last_checkpoint.balance_in_drops \
+                    + _sum_transactions(account,
+                                        after_id=last_checkpoint.transaction_id,
+                                        up_to_id=up_to_id)
+
+        checkpoint = AccountBalanceCheckpoint()
+        checkpoint.account          = account
+        checkpoint.transaction_id   = up_to_id
+        checkpoint.balance_in_drops = balance
+        checkpoint.timestamp        = timezone.now()
+        checkpoint.save()
+
+    return checkpoint
+
 #############################################################################
 
 def update_account_balance(account):
     """ Recalculate the account balance for the given account.
+
+        Account balances are normally kept up to date by save_transaction();
+        this is used to repair a balance which has got out of step with the
+        account's transactions.  We return True if the balance was changed.
+    """
+    with db_transaction.atomic():
+        if is_sharded_account(account):
+            fold_balance_shards(account)
+
+        locked_account = Account.objects.select_for_update().get(id=account.id)
+        balance = calc_account_balance(locked_account)
+
+        account.balance_in_drops = balance
+        if locked_account.balance_in_drops == balance:
+            return False
+
+        locked_account.balance_in_drops = balance
+        locked_account.save()
+        return True
+
+#############################################################################
+
+def rollup_period(timestamp):
+    """ Return the start of the TransactionRollup period for a timestamp.
+
+        The returned datetime is in UTC.
+    """
+    timestamp = timestamp.astimezone(timezone.utc)
+    minute    = timestamp.minute \
+              - timestamp.minute % TransactionRollup.PERIOD_MINUTES
+    return timestamp.replace(minute=minute, second=0, microsecond=0)
+
+#############################################################################
+
+def rebuild_rollups(account):
+    """ Recalculate the TransactionRollup records for the given account.
+
+        The rollups are normally kept up to date by save_transaction() and
+        create_transactions(); this is used to create the rollups for existing
+        transactions, or to repair rollups which have got out of step.  We
+        return the number of TransactionRollup records the account now has.
+    """
+    with db_transaction.atomic():
+        Account.objects.select_for_update().get(id=account.id)
+        TransactionRollup.objects.filter(account=account).delete()
+
+        if not _has_rollups(account):
+            return 0
+
+        transactions = Transaction.objects.filter(
+                                status=Transaction.STATUS_SUCCESS) \
+                                          .filter(Q(debit_account=account) |
+                                                  Q(credit_account=account))
+
+        changes = {}
+        for type,amount,timestamp,debit_id,credit_id in \
+                transactions.values_list("type", "amount_in_drops",
+                                         "timestamp", "debit_account_id",
+                                         "credit_account_id").iterator():
+            period = rollup_period(timestamp)
+            for account_id,direction in \
+                    [(debit_id,  TransactionRollup.DIRECTION_PAID),
+                     (credit_id, TransactionRollup.DIRECTION_RECEIVED)]:
+                if account_id == account.id:
+                    key = (account_id, type, direction, period)
+                    total,count = changes.get(key, (0, 0))
+                    changes[key] = (total + amount, count + 1)
+
+        rollups = []
+        for key in sorted(changes.keys()):
+            rollup = TransactionRollup()
+            rollup.account_id,rollup.type,rollup.direction, \
+                rollup.period_start = key
+            rollup.total_in_drops,rollup.num_transactions = changes[key]
+            rollups.append(rollup)
+        TransactionRollup.objects.bulk_create(rollups)
+
+        return len(rollups)
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _sum_transactions(account, after_id=None, up_to_id=None):
+    """ Return the net total of the successful transactions for an account.
+
+        If 'after_id' is specified, only transactions with a record ID greater
+        than this will be included.  If 'up_to_id' is specified, only
+        transactions with a record ID up to and including this will be
+        included.  We return the total credits minus the total debits.
+    """
+    query = Transaction.objects.filter(status=Transaction.STATUS_SUCCESS)
+    if after_id != None:
+        query = query.filter(id__gt=after_id)
+    if up_to_id != None:
+        query = query.filter(id__lte=up_to_id)
+
+    credits = query.filter(credit_account=account).aggregate(
+                            Sum("amount_in_drops"))['amount_in_drops__sum']
+    debits  = query.filter(debit_account=account).aggregate(
+                            Sum("amount_in_drops"))['amount_in_drops__sum']
+
+    return (credits or 0) - (debits or 0)
+
+#############################################################################
+
+def _lock_shards(accounts, shard_key):
+    """ Lock one balance shard for each of the given sharded accounts.
+
+        We return a dictionary mapping the record ID of each sharded account
+        to the record ID of the AccountBalanceShard record to update.
+    """
+    shard_ids = {}
+    for account in sorted(accounts, key=lambda account: account.id):
+        if is_sharded_account(account) and account.id not in shard_ids:
+            shard_ids[account.id] = _lock_shard(account.id, shard_key)
+    return shard_ids
+
+#############################################################################
+
+def _lock_shard(account_id, shard_key):
+    """ Choose and lock one of the balance shards for the given account.
+
+        We return the record ID of the chosen AccountBalanceShard record,
+        creating it if necessary.
+    """
+    num_shards = settings.SYSTEM_ACCOUNT_BALANCE_SHARDS
+    if shard_key == None:
+        shard = random.randrange(num_shards)
+    else:
+        shard = (zlib.crc32(unicode(shard_key).encode("utf-8")) & 0xffffffff) \
+              % num_shards
+
+    query = AccountBalanceShard.objects.select_for_update() \
+                                       .filter(account_id=account_id,
+                                               shard=shard) \
+                                       .values_list("id", flat=True)
+    try:
+        return query.get()
+    except AccountBalanceShard.DoesNotExist:
+        pass
+
+    try:
+        with db_transaction.atomic():
+            shard_record = AccountBalanceShard()
+            shard_record.account_id       = account_id
+            shard_record.shard            = shard
+            shard_record.balance_in_drops = 0
+            shard_record.save()
+            return shard_record.id
+    except IntegrityError:
+        # Someone else created the shard at the same time -> use theirs.
+        return query.get()
+
+#############################################################################
+
+def _adjust_balance(account_id, shard_ids, amount):
+    """ Add the given amount to an account's balance.
+
+        If the account's balance is sharded, 'shard_ids' will map the account
+        ID to the record ID of the shard to update.
+    """
+    if account_id in shard_ids:
+        AccountBalanceShard.objects.filter(id=shard_ids[account_id]).update(
+                balance_in_drops=F("balance_in_drops") + amount)
+    else:
+        Account.objects.filter(id=account_id).update(
+                balance_in_drops=F("balance_in_drops") + amount)
+
+#############################################################################
+
+def _has_rollups(account):
+    """ Return True if the given account's transactions are rolled up.
+
+        Only user accounts have TransactionRollup records; the totals for the
+        system accounts are never requested, and rolling them up would make
+        every message charge contend for the same rows.
+    """
+    return account.type == Account.TYPE_USER
+
+#############################################################################
+
+def _calc_rollup_changes(transactions, sign):
+    """ Calculate the changes to make to the rollups for some transactions.
+
+        'transactions' is a list of Transaction objects which have just become
+        successful (if 'sign' is 1) or are no longer successful (if 'sign' is
+        -1).  We return a dictionary mapping (account_id, type, direction,
+        period_start) tuples to (amount, count) tuples, where 'amount' and
+        'count' are the changes to make to that TransactionRollup record.
+    """
+    changes = {}
+    for transaction in transactions:
+        period = rollup_period(transaction.timestamp)
+        for account,direction in \
+                [(transaction.debit_account,
+                  TransactionRollup.DIRECTION_PAID),
+                 (transaction.credit_account,
+                  TransactionRollup.DIRECTION_RECEIVED)]:
+            if not _has_rollups(account):
+                continue
+            key = (account.id, transaction.type, direction, period)
+            amount,count = changes.get(key, (0, 0))
+            changes[key] = (amount + transaction.amount_in_drops * sign,
+                            count + sign)
+    return changes
+
+#############################################################################
+
+def _adjust_rollups(changes):
+    """ Apply the given changes to the TransactionRollup records.
+
+        'changes' is a dictionary as returned by _calc_rollup_changes().  Any
+        missing TransactionRollup records are created.
+
+        Note that this must be called within a database transaction, with the
+        affected accounts locked.
     """
-    balance = 0
-    for credit in Transaction.objects.filter(status=Transaction.STATUS_SUCCESS,
-                                             credit_account=account):
-        balance = balance + credit.amount_in_drops
-    for debit in Transaction.objects.filter(status=Transaction.STATUS_SUCCESS,
-                                            debit_account=account):
-        balance = balance - debit.amount_in_drops
+    for key in sorted(changes.keys()):
+        account_id,type,direction,period_start = key
+        amount,count = changes[key]
 
-    account.balance_in_drops = balance
-    account.save()
+        num_updated = TransactionRollup.objects.filter(
+                            account_id=account_id,
+                            type=type,
+                            direction=direction,
+                            period_start=period_start).update(
+                            total_in_drops=F("total_in_drops") + amount,
+                            num_transactions=F("num_transactions") + count)
 
+        if num_updated == 0:
+            rollup = TransactionRollup()
+            rollup.account_id       = account_id
+            rollup.type             = type
+            rollup.direction        = direction
+            rollup.period_start     = period_start
+            rollup.total_in_drops   = amount
+            rollup.num_transactions = count
+            rollup.save()
@@ -16,6 +16,7 @@ from django.utils     import timezone
 from django.http      import HttpResponseServerError
 
 from mmServer.shared.models import *
+from mmServer.shared.lib    import nonceCache
 
 #############################################################################
 
@@ -61,15 +62,8 @@ def calc_unique_picture_id():
     """
     while True:
         picture_id = random_string()
-        try:
-            existing_picture = Picture.objects.get(picture_id=picture_id)
-        except Picture.DoesNotExist:
-            existing_picture = None
-
-        if existing_picture == None:
-            break
-        else:
-            continue # Keep trying until we get a unique global_id.
+        if not Picture.objects.filter(picture_id=picture_id).exists():
+            break # Otherwise, keep trying until we get a unique picture_id.
 
     return picture_id
 
@@ -146,7 +140,7 @@ def has_hmac_headers(request):
 
 #############################################################################
 
-def check_hmac_authentication(request, account_secret):
+def check_hmac_authentication(request, account_secret, body_md5=None):
     """ Return True if the given request's HMAC-authentication is correct.
 
         The parameters are as follows:
@@ -161,13 +155,18 @@ def check_hmac_authentication(request, account_secret):
                 The account secret that should have been used to calculate the
                 HMAC authentication headers.
 
+            'body_md5'
+
+                The MD5 digest of the request body, as a hex string.  This
+                should be supplied if the request body has been read as a
+                stream, rather than via request.body; if it isn't supplied, we
+                calculate the digest from request.body.
+
         If the given request's HMAC-authentication headers are correct for the
         given account secret, we return True.
     """
     headers = normalize_request_headers(request)
 
-    NonceValue.objects.purge()
-
     http_method      = request.method
     url              = request.path
 
@@ -179,45 +178,58 @@ def check_hmac_authentication(request, account_secret):
         logger.warn("HMAC auth failed due to missing HTTP headers.")
         return False
 
-    if content_md5 != hashlib.md5(request.body).hexdigest():
+    if body_md5 == None:
+        body_md5 = hashlib.md5(request.body).hexdigest()
+
+    if content_md5 != body_md5:
         logger.warn("HMAC auth failed due to incorrect Content-MD5 value.")
         return False
 
-    # Check that the nonce value hasn't already been used, and remember it for
-    # later.
+    # Calculate the HMAC-authentication digest, and check that it mathes the
+    # digest value from the header.
 
-    NonceValue.objects.purge()
+    if not check_hmac_signature(request, account_secret):
+        logger.warn("HMAC auth failed because authorization hash " +
+                    "doesn't match.")
+        return False
 
-    try:
-        existing_nonce = NonceValue.objects.get(nonce=nonce)
-    except NonceValue.DoesNotExist:
-        existing_nonce = None
+    # Check that the nonce value hasn't already been used, and remember it for
+    # later.  We do this last so that a request with an invalid signature
+    # can't use up somebody else's nonce value.
 
-    if existing_nonce != None:
+    if not nonceCache.use_nonce(nonce):
         logger.warn("HMAC auth failed because nonce value was reused.")
         return False
 
-    nonce_value = NonceValue()
-    nonce_value.nonce     = nonce
-    nonce_value.timestamp = django.utils.timezone.now()
-    nonce_value.save()
+    # If we get here, the HMAC authentication succeeded.  Whew!
 
-    # Calculate the HMAC-authentication digest, and check that it mathes the
-    # digest value from the header.
+    return True
+
+#############################################################################
+
+def check_hmac_signature(request, account_secret):
+    """ Return True if the given request was signed using the given secret.
+
+        Unlike check_hmac_authentication(), this only checks the HMAC digest in
+        the request's "Authorization" header; the Content-MD5 and nonce values
+        are not checked, and the nonce value is not used up.  No warnings are
+        logged if the digest doesn't match.
+    """
+    headers = normalize_request_headers(request)
+
+    hmac_auth_string = headers.get("AUTHORIZATION")
+    content_md5      = headers.get("CONTENT_MD5")
+    nonce            = headers.get("NONCE")
+
+    if hmac_auth_string == None or content_md5 == None or nonce == None:
+        return False
 
     parts       = [request.method, request.path, content_md5,
                    nonce, account_secret]
     hmac_digest = hashlib.sha1("\n".join(parts)).hexdigest()
     hmac_base64 = base64.b64encode(hmac_digest)
 
-    if hmac_auth_string != "HMAC " + hmac_base64:
-        logger.warn("HMAC auth failed because authorization hash " +
-                    "doesn't match.")
-        return False
-
-    # If we get here, the HMAC authentication succeeded.  Whew!
-
-    return True
+    return hmac_auth_string == "HMAC " + hmac_base64
 
 #############################################################################
 
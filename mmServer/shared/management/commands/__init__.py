@@ -0,0 +1,4 @@
+""" __init__.py
+
+    Empty package initialisation file.
+"""
@@ -0,0 +1,37 @@
+""" mmServer.shared.management.commands.backfill_change_log
+
+    This module defines the "backfill_change_log" management command.  This
+    adds a change log entry for every existing Profile, Picture, Conversation
+    and Message record which doesn't already have one.
+"""
+from django.core.management.base import NoArgsCommand
+
+from mmServer.shared.models import *
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    """ Our "backfill_change_log" management command.
+    """
+    help = "Add change log entries for existing records."
+
+    def handle_noargs(self, **options):
+        """ Run our management command.
+        """
+        for model in [Profile, Picture, Conversation, Message]:
+            object_type = ChangeLogEntry.MODEL_TYPES[model.__name__]
+
+            logged_ids = set(ChangeLogEntry.objects.filter(type=object_type)
+                                            .values_list("object_id",
+                                                         flat=True))
+
+            num_added = 0
+            for instance in model.objects.order_by("update_id").iterator():
+                if instance.id in logged_ids:
+                    continue
+
+                ChangeLogEntry.objects.record(instance)
+                num_added = num_added + 1
+
+            self.stdout.write("Added %d change log entries for %s records." %
+                              (num_added, model.__name__))
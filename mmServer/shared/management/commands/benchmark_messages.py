@@ -0,0 +1,221 @@
+""" mmServer.shared.management.commands.benchmark_messages
+
+    This module defines the "benchmark_messages" management command.  This
+    measures how many messages per second the "POST api/message" endpoint can
+    accept as the number of worker processes sending messages increases.
+
+    Each worker process sends charged messages on behalf of its own set of
+    users, so the only rows the workers share are the MessageMe system
+    account's balance shards.  If charging a message locked entire tables, the
+    throughput would stay flat as workers are added; with row-level locking,
+    it should scale with the number of workers until the database itself
+    becomes the bottleneck.
+
+    Note that this command creates profiles, accounts and messages in the
+    database, so it should be run against a scratch PostgreSQL database, for
+    example:
+
+        MMS_DATABASE_URL=postgres://localhost/mms_bench \
+            python manage.py benchmark_messages --workers=1,2,4,8
+"""
+import multiprocessing
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf                 import settings
+from django.db                   import connection
+from django.test.client          import Client
+from django.test.utils           import override_settings
+from django.utils                import timezone
+
+import simplejson as json
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import utils, transactionHandler
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "benchmark_messages" management command.
+    """
+    help = "Measure how message throughput scales with worker processes."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--workers",
+                    action="store",
+                    dest="workers",
+                    default="1,2,4,8",
+                    help="Comma-separated list of worker process counts " +
+                         "to try."),
+        make_option("--messages",
+                    action="store",
+                    type="int",
+                    dest="num_messages",
+                    default=1000,
+                    help="The number of messages to send for each worker " +
+                         "count."),
+        make_option("--users-per-worker",
+                    action="store",
+                    type="int",
+                    dest="users_per_worker",
+                    default=10,
+                    help="The number of users sending messages in each " +
+                         "worker process."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        try:
+            worker_counts = [int(n) for n in options['workers'].split(",")]
+        except ValueError:
+            raise CommandError("Invalid --workers value.")
+
+        if "postgresql" not in settings.DATABASES['default']['ENGINE']:
+            self.stdout.write("Warning: this database doesn't support " +
+                              "concurrent writers; use PostgreSQL for " +
+                              "meaningful results.")
+
+        num_users = max(worker_counts) * options['users_per_worker']
+        users     = self._create_users(num_users, options['num_messages'])
+
+        for num_workers in worker_counts:
+            elapsed, num_sent, num_failed = \
+                self._run_benchmark(num_workers, users, options)
+
+            self.stdout.write("%2d workers: %d messages in %0.2f seconds " %
+                              (num_workers, num_sent, elapsed) +
+                              "= %0.1f messages/second (%d failed)" %
+                              (num_sent / elapsed, num_failed))
+
+
+    def _create_users(self, num_users, num_messages):
+        """ Create the users who will send messages to each other.
+
+            Each user is given a profile, and an account with enough funds to
+            pay for all the messages they could possibly send.  We return a
+            list of (global_id, account_secret) tuples, one for each user.
+        """
+        holding_account = transactionHandler.get_or_create_account(
+                                        Account.TYPE_RIPPLE_HOLDING)
+
+        users    = []
+        deposits = []
+        for i in range(num_users):
+            profile = Profile()
+            profile.global_id      = utils.random_string()
+            profile.account_secret = utils.random_string()
+            profile.save()
+
+            account = transactionHandler.get_or_create_account(
+                                        Account.TYPE_USER, profile.global_id)
+
+            t = Transaction()
+            t.timestamp               = timezone.now()
+            t.created_by              = account
+            t.status                  = Transaction.STATUS_SUCCESS
+            t.type                    = Transaction.TYPE_DEPOSIT
+            t.amount_in_drops         = num_messages * 1000
+            t.debit_account           = holding_account
+            t.credit_account          = account
+            t.ripple_transaction_hash = None
+            t.message                 = None
+            t.description             = "benchmark_messages"
+            t.error                   = None
+            deposits.append(t)
+
+            users.append((profile.global_id, profile.account_secret))
+
+        transactionHandler.create_transactions(deposits)
+        return users
+
+
+    def _run_benchmark(self, num_workers, users, options):
+        """ Send messages using the given number of worker processes.
+
+            We return an (elapsed, num_sent, num_failed) tuple.
+        """
+        users_per_worker = options['users_per_worker']
+        num_messages     = options['num_messages']
+        results          = multiprocessing.Queue()
+
+        # Make sure the worker processes don't share our database connection.
+
+        connection.close()
+
+        workers = []
+        for i in range(num_workers):
+            worker_users = users[i*users_per_worker:(i+1)*users_per_worker]
+            worker_count = num_messages // num_workers
+            if i < num_messages % num_workers:
+                worker_count = worker_count + 1
+            workers.append(multiprocessing.Process(
+                                target=_send_messages,
+                                args=(worker_users, worker_count, results)))
+
+        start_time = time.time()
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start_time
+
+        num_sent   = 0
+        num_failed = 0
+        for worker in workers:
+            sent, failed = results.get()
+            num_sent   = num_sent + sent
+            num_failed = num_failed + failed
+
+        return elapsed, num_sent, num_failed
+
+#############################################################################
+#                                                                           #
+#                    P R I V A T E   D E F I N I T I O N S                  #
+#                                                                           #
+#############################################################################
+
+def _send_messages(users, num_messages, results):
+    """ Send the given number of messages between the given users.
+
+        This is run within a worker process.  Each user in turn sends a
+        message to the next user in the list.  Upon completion, we add a
+        (num_sent, num_failed) tuple to the 'results' queue.
+    """
+    client     = Client()
+    num_sent   = 0
+    num_failed = 0
+
+    with override_settings(ALLOWED_HOSTS=["*"], DEBUG=False):
+        for i in range(num_messages):
+            sender_global_id, sender_secret = users[i % len(users)]
+            recipient_global_id, ignore     = users[(i + 1) % len(users)]
+
+            request = json.dumps(
+                        {'sender_global_id'      : sender_global_id,
+                         'recipient_global_id'   : recipient_global_id,
+                         'sender_account_id'     : utils.random_string(),
+                         'recipient_account_id'  : utils.random_string(),
+                         'sender_text'           : "benchmark",
+                         'recipient_text'        : "benchmark",
+                         'message_charge'        : 10,
+                         'system_charge'         : 1,
+                         'system_charge_paid_by' : "SENDER",
+                        })
+
+            headers = utils.calc_hmac_headers(method="POST",
+                                              url="/api/message",
+                                              body=request,
+                                              account_secret=sender_secret)
+
+            response = client.post("/api/message", request,
+                                   content_type="application/json",
+                                   **headers)
+            if response.status_code == 202:
+                num_sent = num_sent + 1
+            else:
+                num_failed = num_failed + 1
+
+    connection.close()
+    results.put((num_sent, num_failed))
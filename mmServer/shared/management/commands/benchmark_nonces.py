@@ -0,0 +1,148 @@
+""" mmServer.shared.management.commands.benchmark_nonces
+
+    This module defines the "benchmark_nonces" management command.  This
+    measures how long it takes to check the HMAC authentication for a request
+    as the number of stored nonce values grows.
+
+    For each of the given table sizes, we add nonce values to the NonceValue
+    table (spread evenly across the last few days) until it holds that many
+    nonce values, and then time a number of calls to
+    utils.check_hmac_authentication(), each using a new nonce value.
+
+    Note that this command adds nonce values to the database, so it should be
+    run against a scratch PostgreSQL database, for example:
+
+        MMS_DATABASE_URL=postgres://localhost/mms_bench \
+            python manage.py benchmark_nonces --sizes=0,1000000,10000000
+"""
+import datetime
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db                   import connection
+from django.test.client          import RequestFactory
+from django.utils                import timezone
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import utils, nonceCache, dbHelpers
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "benchmark_nonces" management command.
+    """
+    help = "Measure the cost of HMAC authentication as nonce values grow."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--sizes",
+                    action="store",
+                    dest="sizes",
+                    default="0,100000,1000000",
+                    help="Comma-separated list of NonceValue table sizes " +
+                         "to try."),
+        make_option("--requests",
+                    action="store",
+                    type="int",
+                    dest="num_requests",
+                    default=2000,
+                    help="The number of requests to authenticate at each " +
+                         "table size."),
+        make_option("--days",
+                    action="store",
+                    type="int",
+                    dest="num_days",
+                    default=30,
+                    help="The number of days to spread the nonce values " +
+                         "across."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        try:
+            sizes = [int(n) for n in options['sizes'].split(",")]
+        except ValueError:
+            raise CommandError("Invalid --sizes value.")
+
+        for size in sorted(sizes):
+            self._fill_table(size, options['num_days'])
+
+            timings = self._time_requests(options['num_requests'])
+            timings.sort()
+
+            average = sum(timings) / len(timings)
+            p99     = timings[int(len(timings) * 0.99)]
+
+            self.stdout.write("%10d nonce values: %0.3f ms average, " %
+                              (NonceValue.objects.count(), average * 1000) +
+                              "%0.3f ms 99th percentile" % (p99 * 1000))
+
+
+    def _fill_table(self, size, num_days):
+        """ Add nonce values until the NonceValue table has the given size.
+        """
+        num_to_add = size - NonceValue.objects.count()
+        if num_to_add <= 0:
+            return
+
+        self.stdout.write("Adding %d nonce values..." % num_to_add)
+
+        per_day = num_to_add // num_days + 1
+        today   = timezone.now().replace(hour=0, minute=0, second=0,
+                                         microsecond=0)
+
+        for day in range(num_days):
+            num_values = min(per_day, num_to_add)
+            if num_values <= 0:
+                break
+            num_to_add = num_to_add - num_values
+
+            start = today - datetime.timedelta(days=day)
+            if dbHelpers.is_postgres():
+                name,partition_start,partition_end = \
+                        nonceCache.partition_for(start)
+                nonceCache.create_partition(name, partition_start,
+                                            partition_end)
+
+                cursor = connection.cursor()
+                cursor.execute('INSERT INTO "%s" ("nonce", "timestamp") ' %
+                               name +
+                               "SELECT md5(random()::text || n::text), " +
+                               "%s + (n %% 86400) * interval '1 second' " +
+                               "FROM generate_series(1, %s) AS n",
+                               [start, num_values])
+                cursor.execute('ANALYZE "%s"' % name)
+            else:
+                nonce_values = []
+                for i in range(num_values):
+                    nonce_value = NonceValue()
+                    nonce_value.nonce     = utils.random_string(32, 32)
+                    nonce_value.timestamp = start
+                    nonce_values.append(nonce_value)
+                NonceValue.objects.bulk_create(nonce_values, batch_size=500)
+
+
+    def _time_requests(self, num_requests):
+        """ Time the authentication of the given number of requests.
+
+            We return a list with the time taken, in seconds, to authenticate
+            each request.
+        """
+        factory        = RequestFactory()
+        account_secret = utils.random_string()
+        timings        = []
+
+        for i in range(num_requests):
+            headers = utils.calc_hmac_headers(method="GET",
+                                              url="/api/profile",
+                                              body="",
+                                              account_secret=account_secret)
+            request = factory.get("/api/profile", **headers)
+
+            start_time = time.time()
+            if not utils.check_hmac_authentication(request, account_secret):
+                raise CommandError("Authentication failed!")
+            timings.append(time.time() - start_time)
+
+        return timings
@@ -0,0 +1,181 @@
+""" mmServer.shared.management.commands.benchmark_ripple
+
+    This module defines the "benchmark_ripple" management command.  This
+    measures how quickly we can push payments through the Ripple network: each
+    payment is signed, submitted, and then checked using "tx" until it has
+    been validated.
+
+    By default, the payments are sent to a fake rippled server running within
+    this process.  Use the --use-settings option to send them to the servers
+    listed in the RIPPLED_SERVER_URLS setting instead.
+"""
+import threading
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.conf                 import settings
+from django.test.utils           import override_settings
+
+from mmServer.shared.lib import rippleInterface, fakeRippled
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "benchmark_ripple" management command.
+    """
+    help = "Measure the throughput of payments sent via rippled."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--payments",
+                    action="store",
+                    type="int",
+                    dest="num_payments",
+                    default=200,
+                    help="The number of payments to send."),
+        make_option("--threads",
+                    action="store",
+                    type="int",
+                    dest="num_threads",
+                    default=20,
+                    help="The number of payments to send at once."),
+        make_option("--latency",
+                    action="store",
+                    dest="latency",
+                    default="uniform:0.005:0.05",
+                    help="The fake server's response time."),
+        make_option("--failure-rate",
+                    action="store",
+                    type="float",
+                    dest="failure_rate",
+                    default=0,
+                    help="Fraction of requests the fake server fails."),
+        make_option("--ledger-interval",
+                    action="store",
+                    type="float",
+                    dest="ledger_interval",
+                    default=0.5,
+                    help="The fake server's ledger close interval."),
+        make_option("--use-settings",
+                    action="store_true",
+                    dest="use_settings",
+                    default=False,
+                    help="Use RIPPLED_SERVER_URLS rather than a fake server."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        if options['use_settings']:
+            if not settings.RIPPLED_SERVER_URLS:
+                raise CommandError("RIPPLED_SERVER_URLS is not set.")
+            self._run_benchmark(options)
+            return
+
+        server = fakeRippled.FakeRippledServer(
+                        latency=options['latency'],
+                        failure_rate=options['failure_rate'],
+                        ledger_interval=options['ledger_interval'])
+
+        with server:
+            with override_settings(RIPPLED_SERVER_URLS=[server.url]):
+                try:
+                    self._run_benchmark(options)
+                finally:
+                    rippleInterface.close_connections()
+
+
+    def _run_benchmark(self, options):
+        """ Send our payments, and print out the results.
+        """
+        lock         = threading.Lock()
+        num_payments = options['num_payments']
+        remaining    = [num_payments]
+        latencies    = [] # Time taken to validate each successful payment.
+        failures     = [0]
+
+        def send_payments():
+            while True:
+                with lock:
+                    if remaining[0] == 0:
+                        return
+                    remaining[0] = remaining[0] - 1
+
+                latency = self._send_payment()
+
+                with lock:
+                    if latency == None:
+                        failures[0] = failures[0] + 1
+                    else:
+                        latencies.append(latency)
+
+        threads = []
+        for i in range(options['num_threads']):
+            threads.append(threading.Thread(target=send_payments))
+
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.time() - start_time
+
+        self.stdout.write("Sent %d payments in %0.2f seconds " %
+                          (num_payments, elapsed) +
+                          "(%0.1f payments/second)." %
+                          (num_payments / elapsed))
+        self.stdout.write("%d payments failed." % failures[0])
+
+        if len(latencies) > 0:
+            latencies.sort()
+            for percentile in [50, 95, 99]:
+                index = min(len(latencies) * percentile / 100,
+                            len(latencies) - 1)
+                self.stdout.write("p%d time to validation: %0.3f seconds." %
+                                  (percentile, latencies[index]))
+
+
+    def _send_payment(self):
+        """ Sign, submit and wait for the validation of a single payment.
+
+            We return the number of seconds it took for the payment to be
+            validated, or None if the payment failed.
+        """
+        start_time = time.time()
+
+        response = rippleInterface.request("sign",
+                                           tx_json={'TransactionType' :
+                                                        "Payment",
+                                                    'Account'         :
+                                                        "rBenchmarkSender",
+                                                    'Destination'     :
+                                                        "rBenchmarkRecipient",
+                                                    'Amount'          : "1"},
+                                           secret="sBenchmarkSecret",
+                                           fee_mult_max=1000000)
+        if response == None or response['status'] != "success":
+            return None
+
+        response = rippleInterface.request("submit",
+                                           tx_blob=response['result']['tx_blob'],
+                                           fail_hard=True)
+        if response == None or response['status'] != "success":
+            return None
+
+        tx_hash = response['result']['tx_json']['hash']
+
+        while True:
+            response = rippleInterface.request("tx", transaction=tx_hash,
+                                                     binary=False)
+            if response == None or response['status'] != "success":
+                # Try again later, as the reconciler would.
+                time.sleep(0.1)
+                continue
+
+            if response['result'].get("validated", False):
+                if (response['result']['meta']['TransactionResult'] !=
+                        "tesSUCCESS"):
+                    return None
+                return time.time() - start_time
+
+            time.sleep(0.1)
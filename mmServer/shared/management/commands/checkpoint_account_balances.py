@@ -0,0 +1,68 @@
+""" mmServer.shared.management.commands.checkpoint_account_balances
+
+    This module defines the "checkpoint_account_balances" management command.
+    This folds any balance shards back into their accounts, records a new
+    balance checkpoint for every account, and then checks that each account's
+    stored balance matches its transactions.
+
+    Because each checkpoint records the account's balance as of a given
+    transaction, verifying the balance only involves adding up the
+    transactions since the last checkpoint.  This command should be run
+    periodically (for example, from a cron job) to keep this cheap.
+"""
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import transactionHandler
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "checkpoint_account_balances" management command.
+    """
+    help = "Checkpoint and verify the balance of every account."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--fix",
+                    action="store_true",
+                    dest="fix",
+                    default=False,
+                    help="Repair any account balances which are incorrect."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        num_checkpoints = 0
+        num_mismatched  = 0
+
+        for account_id in Account.objects.order_by("id") \
+                                         .values_list("id", flat=True):
+            with transaction.atomic():
+                account = Account.objects.select_for_update().get(id=account_id)
+
+                if transactionHandler.is_sharded_account(account):
+                    transactionHandler.fold_balance_shards(account)
+
+                if transactionHandler.create_checkpoint(account) != None:
+                    num_checkpoints = num_checkpoints + 1
+
+                balance = transactionHandler.calc_account_balance(account)
+                if balance != account.balance_in_drops:
+                    num_mismatched = num_mismatched + 1
+                    self.stdout.write("Account %d has a balance of %d, " %
+                                      (account.id, account.balance_in_drops) +
+                                      "but its transactions add up to %d." %
+                                      balance)
+                    if options['fix']:
+                        transactionHandler.update_account_balance(account)
+
+        self.stdout.write("Created %d checkpoints." % num_checkpoints)
+        if options['fix']:
+            self.stdout.write("Fixed %d account balances." % num_mismatched)
+        else:
+            self.stdout.write("Found %d incorrect account balances." %
+                              num_mismatched)
@@ -0,0 +1,24 @@
+""" mmServer.shared.management.commands.compact_change_log
+
+    This module defines the "compact_change_log" management command.  This
+    removes change log entries which have been superseded by a later change to
+    the same object, and should be run periodically to keep the change log to
+    a reasonable size.
+"""
+from django.core.management.base import NoArgsCommand
+
+from mmServer.shared.models import *
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    """ Our "compact_change_log" management command.
+    """
+    help = "Remove superseded change log entries."
+
+    def handle_noargs(self, **options):
+        """ Run our management command.
+        """
+        num_deleted = ChangeLogEntry.objects.compact()
+        self.stdout.write("Removed %d superseded change log entries." %
+                          num_deleted)
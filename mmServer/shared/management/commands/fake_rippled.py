@@ -0,0 +1,93 @@
+""" mmServer.shared.management.commands.fake_rippled
+
+    This module defines the "fake_rippled" management command.  This runs a
+    fake rippled server on the local machine, which can be used to try out or
+    load-test the mmServer system without talking to the Ripple network.  To
+    use it, set the RIPPLED_SERVER_URLS setting to the URL printed when the
+    server starts.
+"""
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from mmServer.shared.lib import fakeRippled
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "fake_rippled" management command.
+    """
+    help = "Run a fake rippled server on the local machine."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--port",
+                    action="store",
+                    type="int",
+                    dest="port",
+                    default=5006,
+                    help="The port to listen on."),
+        make_option("--latency",
+                    action="store",
+                    dest="latency",
+                    default="0",
+                    help="The response time, for example \"0.05\", " +
+                         "\"uniform:0.01:0.2\" or \"exponential:0.05\"."),
+        make_option("--failure-rate",
+                    action="store",
+                    type="float",
+                    dest="failure_rate",
+                    default=0,
+                    help="Fraction of requests which fail with \"tooBusy\"."),
+        make_option("--drop-rate",
+                    action="store",
+                    type="float",
+                    dest="drop_rate",
+                    default=0,
+                    help="Fraction of requests which are never answered."),
+        make_option("--tx-failure-rate",
+                    action="store",
+                    type="float",
+                    dest="tx_failure_rate",
+                    default=0,
+                    help="Fraction of submitted transactions which fail."),
+        make_option("--validation-delay",
+                    action="store",
+                    type="int",
+                    dest="validation_delay",
+                    default=1,
+                    help="Number of ledgers before a transaction is " +
+                         "validated."),
+        make_option("--ledger-interval",
+                    action="store",
+                    type="float",
+                    dest="ledger_interval",
+                    default=3.5,
+                    help="Number of seconds between ledger closes."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        try:
+            fakeRippled.parse_latency(options['latency'])
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        server = fakeRippled.FakeRippledServer(
+                        port=options['port'],
+                        latency=options['latency'],
+                        failure_rate=options['failure_rate'],
+                        drop_rate=options['drop_rate'],
+                        tx_failure_rate=options['tx_failure_rate'],
+                        validation_delay=options['validation_delay'],
+                        ledger_interval=options['ledger_interval'])
+
+        with server:
+            self.stdout.write("Fake rippled server listening on %s" %
+                              server.url)
+            try:
+                while True:
+                    time.sleep(1)
+            except KeyboardInterrupt:
+                pass
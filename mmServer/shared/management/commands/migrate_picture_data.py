@@ -0,0 +1,85 @@
+""" mmServer.shared.management.commands.migrate_picture_data
+
+    This module defines the "migrate_picture_data" management command.  This
+    moves the image data for pictures uploaded before the picture store
+    existed out of the Picture table and into the picture store.
+
+    The pictures are processed in batches, in order of their record ID, so
+    that only one batch of image data is held in memory at a time.  The
+    command can safely be run while the server is handling requests, and can
+    be interrupted and re-run at any time; pictures which have already been
+    moved are skipped.
+
+    Note that on PostgreSQL, the space used by the old image data is only
+    reclaimed once the Picture table has been vacuumed.
+"""
+import base64
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db                   import transaction
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import pictureStore
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "migrate_picture_data" management command.
+    """
+    help = "Move legacy picture data into the picture store."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size",
+                    action="store",
+                    type="int",
+                    dest="batch_size",
+                    default=100,
+                    help="The number of pictures to load at once."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        store      = pictureStore.get_store()
+        last_id    = 0
+        num_moved  = 0
+        num_failed = 0
+
+        while True:
+            batch = list(Picture.objects.filter(id__gt=last_id,
+                                                picture_hash__isnull=True,
+                                                picture_data__isnull=False)
+                                        .order_by("id")
+                                        .values_list("id", "picture_data")
+                                        [:options['batch_size']])
+            if len(batch) == 0:
+                break
+
+            with transaction.atomic():
+                for id,picture_data in batch:
+                    last_id = id
+
+                    try:
+                        raw_data = base64.b64decode(picture_data)
+                    except TypeError:
+                        self.stdout.write("Picture %d doesn't hold valid " %
+                                          id + "base64 data; skipping.")
+                        num_failed = num_failed + 1
+                        continue
+
+                    hash = store.put(raw_data)
+
+                    # Only update the picture if it hasn't been changed since
+                    # we loaded it.
+
+                    num_moved = num_moved + \
+                        Picture.objects.filter(id=id,
+                                               picture_hash__isnull=True,
+                                               picture_data=picture_data) \
+                                       .update(picture_hash=hash,
+                                               picture_size=len(raw_data),
+                                               picture_data=None)
+
+        self.stdout.write("Moved %d pictures (%d failed)." %
+                          (num_moved, num_failed))
@@ -0,0 +1,35 @@
+""" mmServer.shared.management.commands.purge_nonce_values
+
+    This module defines the "purge_nonce_values" management command.  This
+    removes any nonce values older than settings.KEEP_NONCE_VALUES_FOR days
+    from the database.  On PostgreSQL, this is done by dropping entire
+    partitions of the NonceValue table.
+
+    This command must be run periodically (for example, from a daily cron
+    job); old nonce values are not purged while handling API requests, so the
+    NonceValue table will keep on growing if this command isn't run.  Nothing
+    is purged if KEEP_NONCE_VALUES_FOR is set to None.
+"""
+from django.conf                 import settings
+from django.core.management.base import NoArgsCommand
+
+from mmServer.shared.lib import nonceCache
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    """ Our "purge_nonce_values" management command.
+    """
+    help = "Remove old nonce values from the database."
+
+    def handle_noargs(self, **options):
+        """ Run our management command.
+        """
+        if settings.KEEP_NONCE_VALUES_FOR == None:
+            self.stdout.write("KEEP_NONCE_VALUES_FOR is not set; nonce " +
+                              "values are being kept forever.")
+            return
+
+        num_partitions,num_deleted = nonceCache.purge()
+        self.stdout.write("Dropped %d partitions and deleted %d nonce values."
+                          % (num_partitions, num_deleted))
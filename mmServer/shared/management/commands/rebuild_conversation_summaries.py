@@ -0,0 +1,23 @@
+""" mmServer.shared.management.commands.rebuild_conversation_summaries
+
+    This module defines the "rebuild_conversation_summaries" management
+    command.  This recalculates the last message and unread message counts for
+    every conversation from the underlying messages, repairing any
+    conversations which have got out of step.
+"""
+from django.core.management.base import NoArgsCommand
+
+from mmServer.shared.lib import messageHandler
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    """ Our "rebuild_conversation_summaries" management command.
+    """
+    help = "Recalculate the summary fields for every conversation."
+
+    def handle_noargs(self, **options):
+        """ Run our management command.
+        """
+        num_changed = messageHandler.rebuild_conversations()
+        self.stdout.write("Updated %d conversations." % num_changed)
@@ -0,0 +1,33 @@
+""" mmServer.shared.management.commands.rebuild_transaction_rollups
+
+    This module defines the "rebuild_transaction_rollups" management command.
+    This recalculates the TransactionRollup records for every user account
+    from the underlying transactions.  It should be run once to create the
+    rollups for transactions made before the rollups existed, and can be run
+    again at any time to repair rollups which have got out of step.
+"""
+from django.core.management.base import NoArgsCommand
+
+from mmServer.shared.models import *
+from mmServer.shared.lib    import transactionHandler
+
+#############################################################################
+
+class Command(NoArgsCommand):
+    """ Our "rebuild_transaction_rollups" management command.
+    """
+    help = "Recalculate the transaction rollups for every user account."
+
+    def handle_noargs(self, **options):
+        """ Run our management command.
+        """
+        num_accounts = 0
+        num_rollups  = 0
+        for account in Account.objects.filter(type=Account.TYPE_USER) \
+                                      .order_by("id").iterator():
+            num_rollups  = num_rollups + \
+                           transactionHandler.rebuild_rollups(account)
+            num_accounts = num_accounts + 1
+
+        self.stdout.write("Rebuilt %d rollups for %d accounts." %
+                          (num_rollups, num_accounts))
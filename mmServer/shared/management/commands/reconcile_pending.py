@@ -0,0 +1,100 @@
+""" mmServer.shared.management.commands.reconcile_pending
+
+    This module defines the "reconcile_pending" management command.  This
+    repeatedly asks the Ripple network for the current status of any pending
+    messages and transactions, and updates them once they have either failed
+    or been accepted into the Ripple ledger.
+
+    This command should be left running in the background alongside the API
+    server; the API endpoints simply return the current status of a message
+    or transaction, and rely on this command to finalize them.
+"""
+import logging
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.conf                 import settings
+from django.db                   import close_old_connections, reset_queries
+
+from mmServer.shared.lib import messageHandler, transactionHandler
+
+#############################################################################
+
+logger = logging.getLogger("mmServer")
+
+#############################################################################
+
+class Command(BaseCommand):
+    """ Our "reconcile_pending" management command.
+    """
+    help = "Check the status of pending messages and transactions."
+
+    option_list = BaseCommand.option_list + (
+        make_option("--batch-size",
+                    action="store",
+                    type="int",
+                    dest="batch_size",
+                    default=None,
+                    help="Maximum number of messages and transactions to " +
+                         "check in each pass."),
+        make_option("--interval",
+                    action="store",
+                    type="float",
+                    dest="interval",
+                    default=None,
+                    help="Number of seconds to wait between passes."),
+        make_option("--once",
+                    action="store_true",
+                    dest="once",
+                    default=False,
+                    help="Make a single pass and then exit."),
+    )
+
+    def handle(self, *args, **options):
+        """ Run our management command.
+        """
+        batch_size = options['batch_size']
+        interval   = options['interval']
+
+        if batch_size == None:
+            batch_size = settings.RECONCILER_BATCH_SIZE
+        if interval == None:
+            interval = settings.RECONCILER_INTERVAL
+
+        # 'message_cursor' and 'transaction_cursor' are the record IDs of the
+        # last message and transaction checked.  Each pass carries on from
+        # where the previous pass left off, so that every pending record gets
+        # checked even when there are more than 'batch_size' of them.
+
+        message_cursor     = None
+        transaction_cursor = None
+
+        while True:
+            try:
+                message_cursor = messageHandler.check_pending_messages(
+                                                    batch_size=batch_size,
+                                                    after_id=message_cursor)
+            except:
+                logger.exception("Unable to check pending messages")
+                message_cursor = None
+
+            try:
+                transaction_cursor = \
+                    transactionHandler.check_pending_transactions(
+                                                batch_size=batch_size,
+                                                after_id=transaction_cursor)
+            except:
+                logger.exception("Unable to check pending transactions")
+                transaction_cursor = None
+
+            if options['once']:
+                break
+
+            time.sleep(interval)
+
+            # Don't let our database connection or the list of queries used
+            # in debug mode build up between passes.
+
+            close_old_connections()
+            reset_queries()
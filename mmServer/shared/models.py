@@ -5,13 +5,12 @@
 """
 import datetime
 
-from django.db   import models
+from django.db   import models, transaction, connection
 from django.conf import settings
 
 import django.utils.timezone
-from django.db.models import Max
 
-from mmServer.shared.lib import dbHelpers
+from mmServer.shared.lib import dbHelpers, changeNotifier
 
 #############################################################################
 
@@ -23,21 +22,67 @@ class ModelWithUpdateID(models.Model):
     def save(self, *args, **kwargs):
         """ Save this record after calculating a new update_id value.
 
-            We set the 'update_id' field to the current highest 'update_id'
-            value in the database table, plus 1.  This indicates that this
-            record has been updated.  The record is then saved into the
-            database.
+            We set the 'update_id' field to a newly-allocated update ID for
+            this model.  This indicates that this record has been updated.
+            The record is then saved into the database.
+
+            Note that the update ID is allocated and the record saved within a
+            single transaction; see dbHelpers.next_update_id() for details.
+            The change is written to the change log within that same
+            transaction, and the users who should see the change are notified
+            once the transaction has been committed.
         """
         model = type(self)
-        with dbHelpers.exclusive_access(model):
-            max_value = model.objects.all().aggregate(Max('update_id'))
-            if max_value['update_id__max'] == None:
-                next_update_id = 1
-            else:
-                next_update_id = max_value['update_id__max'] + 1
-
-            self.update_id = next_update_id
+        with transaction.atomic():
+            self.update_id = dbHelpers.next_update_id(model)
             super(ModelWithUpdateID, self).save(*args, **kwargs)
+            ChangeLogEntry.objects.record(self)
+
+
+    def apply_update(self, condition=None, **values):
+        """ Atomically update some of the fields of this record.
+
+            Unlike save(), this only writes the given field values into the
+            database, and the values can be F() expressions.  This lets us
+            make changes such as incrementing a counter without overwriting
+            any other changes made to this record at the same time.
+
+            If 'condition' is supplied, it should be a Q object; the record
+            will only be updated if it matches this condition.
+
+            As with save(), the record is given a new update ID and the change
+            is written to the change log.  Note that the fields of this object
+            are not changed; reload the record to see the updated values.
+
+            We return True if the record was updated, or False if it didn't
+            match the condition.
+        """
+        model = type(self)
+        with transaction.atomic():
+            query = model.objects.filter(pk=self.pk)
+            if condition != None:
+                query = query.filter(condition)
+
+            values['update_id'] = dbHelpers.next_update_id(model)
+            if query.update(**values) == 0:
+                return False
+
+            ChangeLogEntry.objects.record(self)
+            return True
+
+
+    def change_log_recipients(self):
+        """ Return the global IDs of the users who should see a change to us.
+
+            Each returned global ID will have an entry added to the change log
+            whenever this record is saved, and that user will be notified of
+            the change.
+
+            By default, a change isn't sent to anyone.  Our child models
+            override this to return the list of users who should see a change
+            to this record.
+        """
+        return []
 
 
     class Meta:
@@ -78,23 +123,116 @@ class Profile(ModelWithUpdateID):
     social_security_number_last_4_digits = models.TextField(default="")
     bio                                  = models.TextField(default="")
     bio_visible                          = models.BooleanField(default=False)
-    picture_id                           = models.TextField(default="")
+    picture_id                           = models.TextField(default="",
+                                                            db_index=True)
     picture_id_visible                   = models.BooleanField(default=False)
 
+
+    def __init__(self, *args, **kwargs):
+        """ Standard initialiser.
+
+            We remember the profile's picture settings as they were loaded, so
+            that save() can tell whether they have changed.  Note that we don't
+            load any deferred fields to do this.
+        """
+        super(Profile, self).__init__(*args, **kwargs)
+        self._loaded_picture = self._picture_settings()
+
+
+    def save(self, *args, **kwargs):
+        """ Save this profile.
+
+            If this profile's picture or its visibility has changed, we also
+            add the picture (if any) to the change log.  This ensures that the
+            picture is sent to everyone who can now see it, even if the
+            picture itself hasn't changed.
+        """
+        is_new = self._state.adding
+
+        with transaction.atomic():
+            super(Profile, self).save(*args, **kwargs)
+
+            picture_changed = is_new or \
+                (self._picture_settings() != self._loaded_picture)
+
+            if picture_changed and self.picture_id != "":
+                try:
+                    picture = Picture.objects.defer("picture_data") \
+                                             .get(picture_id=self.picture_id)
+                except Picture.DoesNotExist:
+                    picture = None
+
+                if picture != None:
+                    ChangeLogEntry.objects.record(picture)
+
+        self._loaded_picture = self._picture_settings()
+
+
+    def conversation_partners(self):
+        """ Return the global IDs of everyone this user has a conversation with.
+        """
+        global_ids = []
+        for c in Conversation.objects.filter(global_id_1=self.global_id):
+            global_ids.append(c.global_id_2)
+        for c in Conversation.objects.filter(global_id_2=self.global_id):
+            global_ids.append(c.global_id_1)
+        return global_ids
+
+
+    def change_log_recipients(self):
+        """ Return the global IDs of the users who should see a change to us.
+
+            A profile change is sent to everyone this user has a conversation
+            with.
+        """
+        return self.conversation_partners()
+
+
+    def _picture_settings(self):
+        """ Return this profile's (picture_id, picture_id_visible) values.
+
+            A deferred field which hasn't been loaded is returned as None.
+        """
+        return (self.__dict__.get("picture_id"),
+                self.__dict__.get("picture_id_visible"))
+
 #############################################################################
 
 class Picture(ModelWithUpdateID):
     """ An uploaded picture.
 
-        Note that the 'picture_data' field holds the image data in base64
-        encoding.
+        The picture's image data is held in the picture store; the
+        'picture_hash' field holds the SHA-256 hash used to retrieve it, and
+        'picture_size' holds the size of the image data, in bytes.  See the
+        mmServer.shared.lib.pictureStore module for details.
+
+        Pictures uploaded before the picture store existed have a
+        'picture_hash' of None; for these pictures, the 'picture_data' field
+        holds the image data in base64 encoding.
     """
     id               = models.AutoField(primary_key=True)
     picture_id       = models.TextField(db_index=True, unique=True)
     deleted          = models.BooleanField(default=False)
     account_secret   = models.TextField()
     picture_filename = models.TextField()
-    picture_data     = models.TextField()
+    picture_hash     = models.TextField(null=True)
+    picture_size     = models.IntegerField(null=True)
+    picture_data     = models.TextField(null=True)
+
+
+    def change_log_recipients(self):
+        """ Return the global IDs of the users who should see a change to us.
+
+            A picture change is sent to the owner of every profile which uses
+            this picture, and to everyone they have a conversation with if the
+            picture is visible to other users.
+        """
+        global_ids = []
+        for profile in Profile.objects.filter(picture_id=self.picture_id):
+            global_ids.append(profile.global_id)
+            if profile.picture_id_visible:
+                global_ids.extend(profile.conversation_partners())
+        return global_ids
 
 #############################################################################
 
@@ -114,6 +252,43 @@ class Conversation(ModelWithUpdateID):
     num_unread_2   = models.IntegerField()
 
 
+    def save(self, *args, **kwargs):
+        """ Save this conversation.
+
+            When a new conversation is created, each user can now see the
+            other user's picture (if it is visible), so we add it to the new
+            partner's change log.
+        """
+        is_new = self._state.adding
+
+        with transaction.atomic():
+            super(Conversation, self).save(*args, **kwargs)
+
+            if is_new:
+                partners = {self.global_id_1 : self.global_id_2,
+                            self.global_id_2 : self.global_id_1}
+
+                picture_owners = {} # Maps picture ID to global ID.
+                for global_id,picture_id in \
+                        Profile.objects.filter(global_id__in=partners.keys(),
+                                               picture_id_visible=True) \
+                                       .exclude(picture_id="") \
+                                       .values_list("global_id", "picture_id"):
+                    picture_owners[picture_id] = global_id
+
+                for picture in Picture.objects.defer("picture_data").filter(
+                                    picture_id__in=picture_owners.keys()):
+                    owner = picture_owners[picture.picture_id]
+                    ChangeLogEntry.objects.record(picture,
+                                                  recipients=[partners[owner]])
+
+
+    def change_log_recipients(self):
+        """ Return the global IDs of the users who should see a change to us.
+        """
+        return [self.global_id_1, self.global_id_2]
+
+
     class Meta:
         unique_together = ("global_id_1", "global_id_2")
 
@@ -148,8 +323,8 @@ class Message(ModelWithUpdateID):
     conversation          = models.ForeignKey(Conversation)
     hash                  = models.TextField(null=True, db_index=True)
     timestamp             = models.DateTimeField()
-    sender_global_id      = models.TextField(db_index=True)
-    recipient_global_id   = models.TextField(db_index=True)
+    sender_global_id      = models.TextField()
+    recipient_global_id   = models.TextField()
     sender_account_id     = models.TextField()
     recipient_account_id  = models.TextField()
     sender_text           = models.TextField()
@@ -165,6 +340,134 @@ class Message(ModelWithUpdateID):
                                                 db_index=True)
     error                 = models.TextField(null=True)
 
+
+    def change_log_recipients(self):
+        """ Return the global IDs of the users who should see a change to us.
+        """
+        return [self.sender_global_id, self.recipient_global_id]
+
+
+    class Meta:
+        # These indexes let us find the most recent messages between two
+        # users, or sent or received by a single user, by walking an index in
+        # record ID order.  They also replace the single-column indexes on the
+        # sender and recipient global IDs.
+        index_together = [("sender_global_id", "recipient_global_id", "id"),
+                          ("sender_global_id", "id"),
+                          ("recipient_global_id", "id")]
+
+#############################################################################
+
+class ChangeLogEntryManager(models.Manager):
+    """ A custom manager for the ChangeLogEntry database table.
+    """
+    def record(self, instance, recipients=None):
+        """ Add a change to the given record to the change log.
+
+            'instance' is the Profile, Picture, Conversation or Message record
+            which was changed.  We add one entry to the change log for each of
+            the users who should see the change, all sharing a newly-allocated
+            sequence number, and notify those users of the change.  If
+            'recipients' is supplied, it should be a list of the global IDs of
+            the users to send the change to; otherwise, the change is sent to
+            everyone who should see it.
+
+            Note that this must be called within the same transaction as the
+            change itself; the notification is only delivered once that
+            transaction has been committed.
+        """
+        if recipients == None:
+            recipients = instance.change_log_recipients()
+        recipients = set(recipients)
+        if len(recipients) == 0:
+            return
+
+        # Note that we use the concrete model's name, so that records loaded
+        # with deferred fields are handled correctly.
+
+        model_name  = instance._meta.concrete_model.__name__
+        object_type = ChangeLogEntry.MODEL_TYPES[model_name]
+
+        with transaction.atomic():
+            seq = dbHelpers.next_update_id(ChangeLogEntry, "seq")
+
+            entries = []
+            for global_id in recipients:
+                entry = ChangeLogEntry()
+                entry.global_id = global_id
+                entry.seq       = seq
+                entry.type      = object_type
+                entry.object_id = instance.id
+                entries.append(entry)
+
+            self.bulk_create(entries)
+            changeNotifier.notify(recipients)
+
+
+    def compact(self):
+        """ Collapse repeated changes to the same object.
+
+            Because a sync always returns the current state of each changed
+            object, only the latest change log entry for a given user and
+            object is needed.  We delete all the older entries, and return the
+            number of entries which were deleted.
+        """
+        sql = ("DELETE FROM %(table)s WHERE EXISTS ("
+               + "SELECT 1 FROM %(table)s AS newer"
+               + " WHERE newer.global_id = %(table)s.global_id"
+               + " AND newer.type = %(table)s.type"
+               + " AND newer.object_id = %(table)s.object_id"
+               + " AND newer.seq > %(table)s.seq)") \
+            % {'table' : self.model._meta.db_table}
+
+        cursor = connection.cursor()
+        cursor.execute(sql)
+        return cursor.rowcount
+
+#############################################################################
+
+class ChangeLogEntry(models.Model):
+    """ An entry in the per-user change log.
+
+        Whenever a Profile, Picture, Conversation or Message record is
+        changed, an entry is added to the change log for each user who should
+        see that change.  This lets the "GET /api/changes" endpoint find a
+        user's changes with a single index range scan on (global_id, seq).
+
+        The 'seq' field is allocated in the same way as an update ID, so that
+        the change log can be read up to dbHelpers.update_id_high_water()
+        without missing any entries.
+    """
+    TYPE_PROFILE      = "P"
+    TYPE_PICTURE      = "I"
+    TYPE_CONVERSATION = "C"
+    TYPE_MESSAGE      = "M"
+
+    TYPE_CHOICES = ((TYPE_PROFILE,      "PROFILE"),
+                    (TYPE_PICTURE,      "PICTURE"),
+                    (TYPE_CONVERSATION, "CONVERSATION"),
+                    (TYPE_MESSAGE,      "MESSAGE"))
+
+    MODEL_TYPES = {'Profile'      : TYPE_PROFILE,
+                   'Picture'      : TYPE_PICTURE,
+                   'Conversation' : TYPE_CONVERSATION,
+                   'Message'      : TYPE_MESSAGE}
+
+    id        = models.AutoField(primary_key=True)
+    global_id = models.TextField()
+    seq       = models.IntegerField()
+    type      = models.CharField(max_length=1, choices=TYPE_CHOICES)
+    object_id = models.IntegerField()
+
+    # Use our custom manager for the ChangeLogEntry class.
+
+    objects = ChangeLogEntryManager()
+
+
+    class Meta:
+        index_together = [("global_id", "seq"),
+                          ("global_id", "type", "object_id")]
+
 #############################################################################
 
 class Account(models.Model):
@@ -239,21 +542,91 @@ class Transaction(models.Model):
     description             = models.TextField(null=True)
     error                   = models.TextField(null=True)
 
+    class Meta:
+        # These indexes support paging through an account's successful
+        # transactions in timestamp order.  An account can be on either side
+        # of a transaction, so we need one index for each side.
+        index_together = [("debit_account",  "status", "timestamp", "id"),
+                          ("credit_account", "status", "timestamp", "id")]
+
 #############################################################################
 
-class NonceValueManager(models.Manager):
-    """ A custom manager for the NonceValue database table.
+class AccountBalanceCheckpoint(models.Model):
+    """ A known-good balance for an account as of a given transaction.
+
+        The 'balance_in_drops' field holds the account's balance taking into
+        account every transaction with a record ID up to and including
+        'transaction_id'.  None of these transactions are pending, so the
+        checkpointed balance can never change; to verify the account's current
+        balance, we only need to add up the transactions which came after the
+        account's latest checkpoint.
     """
-    def purge(self):
-        """ Delete all NonceValues older than settings.KEEP_NONCE_VALUES_FOR.
-        """
-        if settings.KEEP_NONCE_VALUES_FOR == None:
-            return # Keep Nonce values forever.
+    id               = models.AutoField(primary_key=True)
+    account          = models.ForeignKey(Account, related_name="checkpoints")
+    transaction_id   = models.IntegerField()
+    balance_in_drops = models.IntegerField()
+    timestamp        = models.DateTimeField()
+
+    class Meta:
+        unique_together = ("account", "transaction_id")
+
+#############################################################################
+
+class AccountBalanceShard(models.Model):
+    """ One part of a heavily-used account's balance.
+
+        Rather than updating a single Account record for every transaction, a
+        heavily-used account (ie, the MessageMe system account) has its
+        balance changes spread across a number of shards.  The account's true
+        balance is the 'balance_in_drops' value in the Account record plus the
+        sum of the account's shards; the shards are periodically folded back
+        into the Account record.
+    """
+    id               = models.AutoField(primary_key=True)
+    account          = models.ForeignKey(Account,
+                                         related_name="balance_shards")
+    shard            = models.IntegerField()
+    balance_in_drops = models.IntegerField()
 
-        max_age = datetime.timedelta(days=settings.KEEP_NONCE_VALUES_FOR)
-        cutoff  = django.utils.timezone.now() - max_age
+    class Meta:
+        unique_together = ("account", "shard")
+
+#############################################################################
+
+class TransactionRollup(models.Model):
+    """ The total of an account's successful transactions over a short period.
+
+        Each TransactionRollup record holds the total value and number of the
+        successful transactions of a given type which were paid or received by
+        a user's account during a single period of PERIOD_MINUTES minutes.
+        'period_start' is the start of the period, in UTC.
+
+        Because the periods are so short, the transactions made on a given
+        date in any timezone whose offset is a multiple of PERIOD_MINUTES can
+        be totalled by adding up the rollups, without looking at the
+        individual transactions.  The rollups are kept up to date by the
+        transactionHandler module as transactions are saved.
+    """
+    PERIOD_MINUTES = 15
+
+    DIRECTION_PAID     = "P"
+    DIRECTION_RECEIVED = "R"
 
-        self.filter(timestamp__lte=cutoff).delete()
+    DIRECTION_CHOICES = ((DIRECTION_PAID,     "PAID"),
+                         (DIRECTION_RECEIVED, "RECEIVED"))
+
+    id               = models.AutoField(primary_key=True)
+    account          = models.ForeignKey(Account, related_name="rollups")
+    type             = models.CharField(max_length=1,
+                                        choices=Transaction.TYPE_CHOICES)
+    direction        = models.CharField(max_length=1,
+                                        choices=DIRECTION_CHOICES)
+    period_start     = models.DateTimeField()
+    total_in_drops   = models.IntegerField()
+    num_transactions = models.IntegerField()
+
+    class Meta:
+        unique_together = ("account", "type", "direction", "period_start")
 
 #############################################################################
 
@@ -265,12 +638,11 @@ class NonceValue(models.Model):
         we keep the Nonce values depends on a custom setting; a period needs to
         be long enough to ensure that HMAC-authenticated requests cannot be
         resent.  A period of a year is probably a good value.
+
+        On PostgreSQL, this table is partitioned by time; see the nonceCache
+        module for details.
     """
     id        = models.AutoField(primary_key=True)
     nonce     = models.TextField(db_index=True, unique=True)
-    timestamp = models.DateTimeField()
-
-    # Use our custom manager for the NonceValue class.
-
-    objects = NonceValueManager()
+    timestamp = models.DateTimeField(db_index=True)
 
@@ -0,0 +1,56 @@
+""" mmServer.testRunner
+
+    This module defines the test runner used to run the mmServer unit tests.
+"""
+import shutil
+import tempfile
+
+from django.conf        import settings
+from django.test.runner import DiscoverRunner
+
+from mmServer.shared.lib import changeNotifier
+
+#############################################################################
+
+class TestRunner(DiscoverRunner):
+    """ Our custom test runner.
+
+        This is the standard Django test runner, with two changes:
+
+        * Uploaded pictures and picture renditions are kept in scratch
+          directories, which are created before the tests are run and removed
+          afterwards.
+
+        * We close the change notifier's shared LISTEN connection before
+          dropping the test database.  PostgreSQL won't drop a database which
+          is still in use.
+    """
+    def setup_test_environment(self, **kwargs):
+        """ Set up the test environment, including our scratch directories.
+        """
+        super(TestRunner, self).setup_test_environment(**kwargs)
+
+        self._scratch_dirs = []
+        for setting,prefix in [("PICTURE_STORE_DIR", "mms-pictures-"),
+                               ("PICTURE_CACHE_DIR", "mms-picture-cache-")]:
+            scratch_dir = tempfile.mkdtemp(prefix=prefix)
+            self._scratch_dirs.append((setting, getattr(settings, setting),
+                                       scratch_dir))
+            setattr(settings, setting, scratch_dir)
+
+
+    def teardown_test_environment(self, **kwargs):
+        """ Remove our scratch directories, and tear down the environment.
+        """
+        for setting,old_value,scratch_dir in self._scratch_dirs:
+            setattr(settings, setting, old_value)
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+
+        super(TestRunner, self).teardown_test_environment(**kwargs)
+
+
+    def teardown_databases(self, old_config, **kwargs):
+        """ Close our LISTEN connection, and then drop the test databases.
+        """
+        changeNotifier.stop()
+        super(TestRunner, self).teardown_databases(old_config, **kwargs)